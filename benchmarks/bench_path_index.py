@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""microbenchmark: blocker lookup via PathClaimIndex vs linear startswith scan
+
+run from repo root: python3 benchmarks/bench_path_index.py
+"""
+
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from replicator.path_index import PathClaimIndex
+
+
+LOOKUPS = 2000
+
+
+def make_claims(n):
+	return [(f"/data/src/{i % 97}/{i}", f"/backup/host{i % 13}/dest/{i}") for i in range(n)]
+
+
+def linear_lookup(claims, src, dest):
+	return [c for c in claims if src.startswith(c[1]) or dest.startswith(c[1]) or c[1].startswith(dest)]
+
+
+def bench(n):
+	claims = make_claims(n)
+	index = PathClaimIndex()
+	for i, (src, dest) in enumerate(claims):
+		index.add_task_claims(i, src, dest)
+	queries = [(f"/data/src/{random.randrange(97)}/q{i}", f"/backup/host{random.randrange(13)}/dest/q{i}") for i in range(LOOKUPS)]
+	t0 = time.perf_counter()
+	for src, dest in queries:
+		index.find_conflicts(src, dest)
+	t_index = (time.perf_counter() - t0) / LOOKUPS
+	t0 = time.perf_counter()
+	for src, dest in queries:
+		linear_lookup(claims, src, dest)
+	t_linear = (time.perf_counter() - t0) / LOOKUPS
+	return t_index, t_linear
+
+
+def main():
+	print(f"{'claims':>8} {'trie, us/lookup':>16} {'linear, us/lookup':>18}")
+	for n in (10, 100, 1000, 10000):
+		t_index, t_linear = bench(n)
+		print(f"{n:>8} {t_index * 1e6:>16.2f} {t_linear * 1e6:>18.2f}")
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""benchmark: single rsync vs sharded rsync (parallel runs by sharding.plan_shards) on generated local tree
+
+run from repo root: python3 benchmarks/bench_sharded.py [work_dir]
+work_dir should be on the disk to be measured, default is temporary directory
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from replicator import sharding
+
+
+TOP_DIRS = 32
+FILES_PER_DIR = 300
+FILE_SIZE = 16 * 1024
+
+
+def make_tree(root):
+	"""top-level dirs of different size, so size-balanced shards differ from shards by count"""
+	for i in range(TOP_DIRS):
+		d = os.path.join(root, f"dir{i:02d}", "sub")
+		os.makedirs(d)
+		for j in range(FILES_PER_DIR * (1 + i % 4) // 2):
+			with open(os.path.join(d, f"f{j}"), "wb") as f:
+				f.write(os.urandom(FILE_SIZE))
+
+
+def run_single(src, dest):
+	subprocess.run(["rsync", "-a", src + "/", dest + "/"], check = True)
+
+
+def run_sharded(src, dest, n, mode):
+	shards = sharding.plan_shards(src + "/", n, mode = mode)
+	lists = []
+	procs = []
+	for i, names in enumerate(shards):
+		path = os.path.join(os.path.dirname(dest), f"shard_{i}")
+		sharding.write_files_from(path, names)
+		lists.append(path)
+		procs.append(subprocess.Popen(["rsync", "-a"] + sharding.SHARD_OPTIONS + [f"--files-from={path}", src + "/", dest + "/"]))
+	returncodes = [p.wait() for p in procs]
+	for path in lists:
+		os.remove(path)
+	assert sharding.combine_returncodes(returncodes) == 0, returncodes
+
+
+def measure(func, dest, *args):
+	shutil.rmtree(dest, ignore_errors = True)
+	os.makedirs(dest)
+	t0 = time.perf_counter()
+	func(*args)
+	return time.perf_counter() - t0
+
+
+def main():
+	if shutil.which("rsync") is None:
+		print("rsync not found")
+		return 1
+	work_dir = tempfile.mkdtemp(dir = sys.argv[1] if len(sys.argv) > 1 else None)
+	try:
+		src = os.path.join(work_dir, "src")
+		dest = os.path.join(work_dir, "dest")
+		make_tree(src)
+		print(f"{'run':>16} {'shards':>7} {'seconds':>9}")
+		print(f"{'single':>16} {1:>7} {measure(run_single, dest, src, dest):>9.2f}")
+		for mode in (sharding.SHARD_DIRS, sharding.SHARD_SIZE):
+			for n in (2, 4, 8):
+				print(f"{'sharded ' + mode:>16} {n:>7} {measure(run_sharded, dest, src, dest, n, mode):>9.2f}")
+	finally:
+		shutil.rmtree(work_dir)
+	return 0
+
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -10,7 +10,7 @@ then
 fi
 
 echo "will deploy dfrsync app to $1"
-for f in "dfrsync" "dfrsync.service" "LICENSE" "manage.py" "README.md" "replicator" "start_server.sh"
+for f in "dfrsync" "dfrsync.service" "dfrsync-worker.service" "LICENSE" "manage.py" "README.md" "replicator" "start_server.sh"
 do
 	echo -n "copying $f... "
 	scp -r "./$f" "$1"
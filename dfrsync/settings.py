@@ -124,6 +124,30 @@ STATIC_URL = 'static/'
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 
+# run task runner and scheduler inside "manage.py runserver" process (development mode).
+# set to False when tasks are run by "manage.py worker", e.g. when UI is served by gunicorn or uvicorn
+REPLICATOR_EMBEDDED_WORKER = True
+
+# lock file which prevents start of second worker ("manage.py worker" or runserver with embedded worker)
+REPLICATOR_WORKER_LOCK_FILE = BASE_DIR / 'worker.lock'
+
+# directory for per-task log files with full rsync output
+REPLICATOR_TASK_LOGS_DIR = BASE_DIR / 'task_logs'
+
+# directory for cached nodes of fingerprints of local src trees (Replication.skip_unchanged), see below
+REPLICATOR_FINGERPRINTS_DIR = BASE_DIR / 'fingerprints'
+
+# keep per-directory nodes of fingerprints in REPLICATOR_FINGERPRINTS_DIR to log which directories of src changed,
+# cache has one node per directory and is rewritten by every run
+REPLICATOR_FINGERPRINT_CHANGED_DIRS = False
+
+# directory for rsync batch files written by tasks of batch leader replications, removed when all followers replayed them
+REPLICATOR_BATCHES_DIR = BASE_DIR / 'batches'
+
+# directory for sockets of ssh master connections, path of unix socket is limited to ~100 chars, so it should be short
+REPLICATOR_SSH_SOCKETS_DIR = '/tmp/dfrsync-ssh'
+
+
 import os
 
 LOGGING = {
@@ -10,12 +10,18 @@ class ReplicatorConfig(AppConfig):
     
     
     def ready(self):
-        from .base import ReplicationTaskRunner, ReplicationScheduler
+        from django.conf import settings
+        from .base import ReplicationTaskRunner, ReplicationScheduler, acquire_worker_lock
         logger.debug(f"ready: starting app {__name__}")
-        # from .signals import signal_reload_shedule_jobs
+        from . import signals
         opts = sys.argv[1:]
-        if "runserver" not in opts:
+        # tasks are run by "manage.py worker", runserver may run them in-process for development
+        if "runserver" not in opts or not getattr(settings, "REPLICATOR_EMBEDDED_WORKER", True):
             return        
+        # same lock as "manage.py worker": if worker (or other runserver) runs, this process only serves UI
+        if not acquire_worker_lock():
+            logger.warning(f"ready: other worker is running, embedded worker is not started, tasks are run by it")
+            return
         ReplicationTaskRunner.launch_startup()
         ReplicationScheduler.launch_startup()
 
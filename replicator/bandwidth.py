@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""global and per-host bandwidth budgets, split between active tasks
+
+budgets are configured in Settings.bandwidth_budgets, one rule per line:
+
+	* = 200M                   global budget for all remote tasks, all day
+	* 09:00-18:00 = 50M        global budget during business hours
+	nas1 = 20M                 budget of link to host nas1
+	nas1 22:00-06:00 = 0       no limit for nas1 at night
+
+rate is in bits per second with optional suffix k, M or G, 0 means no limit.
+rule with time window has precedence over rule without window. local-only tasks do not use budgets.
+"""
+
+
+import re
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+GLOBAL = "*"
+RATE_SUFFIXES = {"": 1, "k": 1000, "m": 1000 ** 2, "g": 1000 ** 3}
+# running task is restarted to take larger share only if its fair share grew this many times,
+# as restart of rsync costs new scan of file list
+REBALANCE_FACTOR = 2.0
+RULE_RE = re.compile(r"^\s*(\S+)\s*(?:(\d{1,2}):(\d\d)\s*-\s*(\d{1,2}):(\d\d))?\s*=\s*(\S+)\s*$")
+
+
+def parse_rate(text):
+	"""parse rate in bits per second: 50M, 1.5G, 800k, 50Mbit/s. return None for 0 (no limit)"""
+	text = text.strip().lower()
+	for unit in ("bit/s", "bps", "b/s"):
+		if text.endswith(unit):
+			text = text[:-len(unit)]
+			break
+	if text in ("", "unlimited", "none"):
+		return None
+	suffix = text[-1] if text[-1] in RATE_SUFFIXES else ""
+	value = float(text[:len(text) - len(suffix)])
+	if value <= 0:
+		return None
+	return value * RATE_SUFFIXES[suffix]
+
+
+def window_contains(window, minute):
+	"""window is tuple (start, end) in minutes since midnight, it may wrap over midnight"""
+	start, end = window
+	if start <= end:
+		return start <= minute < end
+	return minute >= start or minute < end
+
+
+def to_bwlimit(rate_bps):
+	"""convert rate in bits per second to value of rsync --bwlimit, which is in units of 1024 bytes per second"""
+	return max(1, int(rate_bps / 8 / 1024))
+
+
+
+class BudgetRule(object):
+	__slots__ = ("scope", "window", "rate_bps")
+
+	def __init__(self, scope, window, rate_bps):
+		self.scope = scope
+		self.window = window
+		self.rate_bps = rate_bps
+
+
+	@staticmethod
+	def parse_rules(text):
+		"""parse budget rules, invalid lines are logged and skipped"""
+		rules = []
+		for line in text.splitlines():
+			if len(line.strip()) == 0 or line.strip().startswith("#"):
+				continue
+			m = RULE_RE.match(line)
+			try:
+				if m is None:
+					raise ValueError("expected: scope [HH:MM-HH:MM] = rate")
+				window = None
+				if m.group(2) is not None:
+					window = (int(m.group(2)) * 60 + int(m.group(3)), int(m.group(4)) * 60 + int(m.group(5)))
+				rules.append(BudgetRule(m.group(1), window, parse_rate(m.group(6))))
+			except ValueError as e:
+				logger.error(f"parse_rules: invalid bandwidth budget line {line}, ignoring: {e}")
+		return rules
+
+
+	@staticmethod
+	def get_budget(rules, scope, now):
+		"""return budget of scope (GLOBAL or host) at local time now in bits per second, None if there is no limit"""
+		minute = now.hour * 60 + now.minute
+		budget = None
+		for rule in rules:
+			if rule.scope != scope:
+				continue
+			if rule.window is None:
+				budget = rule.rate_bps
+			elif window_contains(rule.window, minute):
+				return rule.rate_bps
+		return budget
+
+
+
+class BandwidthManager(object):
+	"""keeps bandwidth allocated to running remote tasks
+
+	budget of each scope (global and host) is split equally between tasks contending in it: running tasks and pending
+	tasks which could start now (demand, set by runner every dispatch pass), but not more than slots of scope
+	(max_running_tasks, or limit of host). task starts only when its full share is left of budget, so sum of shares never
+	exceeds budget. rate of running rsync can not be changed, so get_outdated reports tasks which should be restarted
+	with new --bwlimit: their budget changed (time window started or ended, settings were changed), their share is larger
+	than fair share because other tasks wait, or their fair share grew REBALANCE_FACTOR times as other tasks finished.
+	"""
+
+	def __init__(self):
+		# owner -> (host, rate_bps or None, budgets of scopes at allocation)
+		self.allocations = {}
+		# owner -> host of pending remote tasks which could start now
+		self.demand = {}
+
+
+	def __len__(self):
+		return len(self.allocations)
+
+
+	def set_demand(self, demand):
+		self.demand = {owner: host for owner, host in demand.items() if owner not in self.allocations}
+
+
+	def get_scope_usage(self, scope):
+		"""return tuple (number of tasks, allocated rate) in scope"""
+		count, allocated = 0, 0.0
+		for host, rate_bps, budgets in self.allocations.values():
+			if scope == GLOBAL or host == scope:
+				count += 1
+				allocated += rate_bps or 0.0
+		return count, allocated
+
+
+	def get_fair_share(self, budget, scope, slots, owner):
+		"""equal share of budget between running and waiting tasks in scope, owner included"""
+		count = self.get_scope_usage(scope)[0] + sum(1 for host in self.demand.values() if scope == GLOBAL or host == scope)
+		if owner not in self.allocations and owner not in self.demand:
+			count += 1
+		if slots > 0:
+			count = min(count, slots)
+		return budget / max(1, count)
+
+
+	@staticmethod
+	def get_budgets(rules, host, now):
+		return (BudgetRule.get_budget(rules, GLOBAL, now), BudgetRule.get_budget(rules, host, now))
+
+
+	def get_scopes(self, host, budgets, max_running_tasks, host_limit):
+		"""tuples (scope, budget, slots) of scopes of host which have budget. task can not run on host more tasks than globally"""
+		slots = (max_running_tasks, host_limit if host_limit > 0 else max_running_tasks)
+		return [(scope, budget, n) for scope, budget, n in zip((GLOBAL, host), budgets, slots) if budget is not None]
+
+
+	def get_rate(self, owner, host, rules, now, max_running_tasks = 0, host_limit = 0):
+		"""rate for new task going to remote host in bits per second, None if there is no limit,
+		0 if its fair share is not left of budget yet"""
+		if host is None:
+			return None
+		rates = []
+		for scope, budget, slots in self.get_scopes(host, self.get_budgets(rules, host, now), max_running_tasks, host_limit):
+			share = self.get_fair_share(budget, scope, slots, owner)
+			left = budget - self.get_scope_usage(scope)[1]
+			# tolerance for rounding of shares
+			rates.append(min(share, left) if left >= share * 0.999 else 0.0)
+		return min(rates) if len(rates) != 0 else None
+
+
+	def allocate(self, owner, host, rules, now, max_running_tasks = 0, host_limit = 0):
+		"""allocate bandwidth to task going to remote host, return rate in bits per second or None if there is no limit.
+		return 0 and allocate nothing if budget is used up"""
+		if host is None:
+			return None
+		rate_bps = self.get_rate(owner, host, rules, now, max_running_tasks = max_running_tasks, host_limit = host_limit)
+		if rate_bps is not None and rate_bps <= 0:
+			logger.debug(f"allocate: no bandwidth left for {owner}, host {host}")
+			return 0.0
+		self.allocations[owner] = (host, rate_bps, self.get_budgets(rules, host, now))
+		self.demand.pop(owner, None)
+		logger.debug(f"allocate: allocated {rate_bps} bit/s to {owner}, host {host}")
+		return rate_bps
+
+
+	def get_outdated(self, rules, now, max_running_tasks = 0, get_host_limit = None):
+		"""owners whose allocation was made by budgets other than current ones, or differs from their current fair share.
+		get_host_limit is function host -> limit of running tasks of host"""
+		outdated = []
+		for owner, (host, rate_bps, budgets) in self.allocations.items():
+			if budgets != self.get_budgets(rules, host, now):
+				outdated.append(owner)
+				continue
+			if rate_bps is None:
+				continue
+			host_limit = get_host_limit(host) if get_host_limit is not None else 0
+			share = min(self.get_fair_share(budget, scope, slots, owner) for scope, budget, slots in self.get_scopes(host, budgets, max_running_tasks, host_limit))
+			if rate_bps > share * 1.001 or share >= rate_bps * REBALANCE_FACTOR:
+				outdated.append(owner)
+		return outdated
+
+
+	def release(self, owner):
+		self.allocations.pop(owner, None)
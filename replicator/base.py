@@ -2,20 +2,67 @@
 # -*- coding: utf-8 -*-
 
 
+import os
 import time
+import fcntl
+import datetime
 import logging
 import traceback
 import threading
-import schedule
+import collections
+import heapq
+import itertools
+from concurrent.futures import ThreadPoolExecutor
 
+from django.utils import timezone
+from django.db import connection
+from django.db.models import F
+from asgiref.sync import sync_to_async
 
 
-from .models import ReplicationTask, ReplicationSchedule
-from .base_functions import run_command
+
+from .models import Replication, ReplicationTask, ReplicationSchedule, Settings
+from .path_index import PathClaimIndex
+from .bandwidth import BandwidthManager, BudgetRule, to_bwlimit
+from .host_health import HostHealth
+from .ssh_pool import SshControlPool
+from .engine import AsyncioEngine, ProcessControl, run_steps_async
+from .predictor import DEFAULT_DURATION_S, get_etas
 
 logger = logging.getLogger(__name__)
 
 
+# lock file of worker, it is kept open while worker runs in this process
+worker_lock_file = None
+
+
+def acquire_worker_lock():
+	"""take REPLICATOR_WORKER_LOCK_FILE, so only one process (manage.py worker or runserver with embedded worker)
+	runs task runner and scheduler. return True if lock is held by this process, False if other process holds it"""
+	global worker_lock_file
+	if worker_lock_file is not None:
+		return True
+	from django.conf import settings
+	lock_file_path = getattr(settings, "REPLICATOR_WORKER_LOCK_FILE", "worker.lock")
+	lock_file = open(lock_file_path, "w")
+	try:
+		fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+	except OSError:
+		lock_file.close()
+		logger.info(f"acquire_worker_lock: lock file {lock_file_path} is locked by other worker")
+		return False
+	worker_lock_file = lock_file
+	return True
+
+
+def release_worker_lock():
+	global worker_lock_file
+	if worker_lock_file is not None:
+		worker_lock_file.close()
+		worker_lock_file = None
+
+
+
 class MetaSingleton(type):
 	"""Meta class for singleton"""
 	
@@ -33,15 +80,157 @@ class MetaSingleton(type):
 
 
 
+class TaskState(object):
+	"""compact in-memory record of task, kept by ReplicationTaskRunner instead of ReplicationTask ORM object"""
+	__slots__ = ("id", "replication_id", "replication_name", "src", "dest", "host", "schedule_descr", "date_created",
+		"priority", "sort_key", "expected_s",
+		"start", "end", "running", "complete", "cancelled", "error", "state", "task",
+		"control", "suspended_by", "preempted_by",
+		"timeout_s", "stall_timeout_s", "launched_at", "released",
+		"bwlimit", "bandwidth_restart",
+		"not_before", "probe", "deferrals", "host_retries",
+		"batch_of", "coalesced_count")
+	
+	
+	def __init__(self, task):
+		self.id = task.id
+		self.replication_id = task.replication_id
+		self.replication_name = task.replication.name
+		self.src = task.replication.src
+		self.dest = task.replication.dest
+		try:
+			self.host = task.replication.remote_host
+		except Exception as e:
+			logger.error(f"TaskState: could not get remote host of task {task}, error: {e}")
+			self.host = None
+		# (host, port) to check before launch, or None
+		self.probe = task.replication.get_probe_target() if task.replication.check_ping and self.host is not None else None
+		# task is deferred while its host is down, at most host_retries times (Replication.retries), then it fails
+		self.deferrals = 0
+		self.host_retries = task.replication.retries
+		self.schedule_descr = task.schedule.hr_schedule if task.schedule is not None else None
+		self.date_created = task.date_created
+		self.not_before = task.not_before
+		# id of batch leader task, this task waits until it finishes
+		self.batch_of = task.batch_of_id
+		# triggers absorbed by this pending task in this process, added to ReplicationTask.coalesced_count when task starts
+		self.coalesced_count = 0
+		self.priority = task.replication.priority
+		self.timeout_s = task.replication.get_timeout_s()
+		# predicted duration, None if unknown
+		self.expected_s = task.replication.est_duration_s
+		self.stall_timeout_s = task.replication.stall_timeout * 60
+		self.sort_key = None
+		self.launched_at = None
+		# True if paths and slot of task were released by watchdog before its worker finished
+		self.released = False
+		# --bwlimit allocated from bandwidth budget, KiB/s
+		self.bwlimit = None
+		# True if task was cancelled to be queued again with --bwlimit of changed budget
+		self.bandwidth_restart = False
+		# ReplicationTask object while task is running in this process
+		self.task = None
+		# ProcessControl of processes of running task
+		self.control = None
+		# id of higher priority task which suspended or cancelled this task
+		self.suspended_by = None
+		self.preempted_by = None
+		self.update_from_task(task)
+	
+	
+	def __str__(self):
+		return f"ReplicationTask {self.id} for replica Replication {self.replication_name}"
+	
+	
+	def update_from_task(self, task):
+		self.start = task.start
+		self.end = task.end
+		self.running = task.running
+		self.complete = task.complete
+		self.cancelled = task.cancelled
+		self.error = task.error
+		self.state = task.state
+	
+	
+	@property
+	def pending(self):
+		return self.start is None and not self.running and not self.cancelled and not self.complete
+	
+	
+	@property
+	def took_timedelta(self):
+		if self.start is None or self.end is None:
+			return "N/A"
+		return self.end - self.start
+	
+	
+
 class ReplicationTaskRunner(object, metaclass = MetaSingleton):
-	"""manages running tasks"""
-	running_tasks = []
-	TASK_CHECK_DELAY = 1.0
-	TASK_START_DELAY = 0.5
-	LOOP_DELAY = 1.0
-	LOOP_DELAY_ON_BLOCKER = 0.1
-	MAX_TASKS_FOR_REPLICA = 2
+	"""manages running tasks
+	
+	_run_loop sleeps on condition until woken up by an event - task added, task finished or task cancelled
+	(blocker released), then makes one dispatch pass.
+	tasks run in bounded pool of worker threads, or all in one asyncio event loop if Settings.runner_engine is asyncio.
+	number of slots is limited globally (Settings.max_running_tasks) and per remote host
+	(Settings.max_tasks_per_host, Settings.host_limits), task without free slot waits in queue.
+	if Settings.preemption_mode is enabled, task without free slot on its host may suspend (SIGSTOP) running task
+	of lower priority on same host until it finishes, or cancel it - then new task for its replication is queued.
+	watchdog (check_timeouts) kills task which runs longer than Replication.timeout or has no output for
+	Replication.stall_timeout, and releases its paths and slot right away, without waiting for its worker.
+	remote task gets equal share of global and per-host bandwidth budget (Settings.bandwidth_budgets) between active tasks
+	as --bwlimit when it starts, task waits in queue until its share is left of budget. when budget or share changes
+	(time window, settings, tasks waiting or finished), running tasks are restarted with new --bwlimit (check_bandwidth_budgets).
+	task failed by transient error (see rsync_errors.py) is retried by new task with exponential backoff:
+	new task waits in queue until its not_before.
+	reachability of remote hosts is shared by all tasks (HostHealth). task is launched only when its host is known
+	to be up, task for host known to be down is deferred until circuit of host is half-open again. task is deferred
+	at most Replication.retries times, then it fails as unreachable and is retried like any failed task.
+	task of replication with batch followers (Replication.batch_leader) is queued together with task for every follower.
+	follower task waits until leader task finishes, then replays its rsync batch to its own dest.
+	trigger of replication which already has pending task does not create new task: pending task absorbs it
+	and counts it in coalesced_count (see coalesce_trigger).
+	tasks to host with warm ssh master (SshControlPool) go ahead of tasks to other hosts queued up to
+	HOST_GROUP_WINDOW_S later, so consecutive tasks to same host reuse one master.
+	runner keeps only small TaskState for pending and running tasks (tasks), ReplicationTask is loaded from DB
+	by worker thread and dropped when task is done. finished tasks are kept in bounded ring recent_tasks.
+	pending tasks wait in heap queue ordered by virtual deadline: creation time plus delay of replication priority class,
+	so task of lower priority ages and will not starve behind stream of higher priority tasks. delay growing with expected
+	duration of task (see predictor.py) is added to its deadline, so of tasks of same class queued together shortest
+	expected go first. this delay is bounded below gap between priority classes, so it never reverses them.
+	ReplicationTask table is durable queue: any process may create pending task (see enqueue_task), process which runs
+	_run_loop (manage.py worker, or runserver with REPLICATOR_EMBEDDED_WORKER) loads new pending tasks every QUEUE_POLL_DELAY.
+	"""
+	QUEUE_POLL_DELAY = 2.0
+	PROGRESS_SAVE_DELAY = 2.0
+	last_loaded_id = 0
+	last_progress_save = 0.0
+	HOST_GROUP_WINDOW_S = 60.0
+	HOST_GROUP_LOOKAHEAD = 16
+	PRIORITY_DELAY_S = {Replication.PRIORITY_HIGH: 0.0, Replication.PRIORITY_NORMAL: 600.0, Replication.PRIORITY_LOW: 3600.0}
+	# delay of shortest job first term is always less than SJF_MAX_DELAY_S, which is below smallest gap between
+	# priority classes, so expected duration orders tasks only within class. it is half of it at SJF_SCALE_S
+	SJF_MAX_DELAY_S = 300.0
+	SJF_SCALE_S = 600.0
+	tasks = {}
+	queue = []
+	recent_tasks = collections.deque(maxlen = 100)
+	path_index = PathClaimIndex()
+	bandwidth = BandwidthManager()
+	# replication id -> TaskState of its pending task, which absorbs new triggers
+	pending_by_replication = {}
 	thread = None
+	executor = None
+	executor_size = 0
+	running_count = 0
+	running_on_host = {}
+	abandoned_count = 0
+	TIMEOUT_KILL_GRACE_S = 10.0
+	lock = threading.RLock()
+	condition = threading.Condition(lock)
+	dispatch_required = False
+	requeue_replication_ids = []
+	retry_candidate_ids = []
+	deferred_until = None
 	
 	
 	def __str__(self):
@@ -49,26 +238,152 @@ class ReplicationTaskRunner(object, metaclass = MetaSingleton):
 	
 	
 	@staticmethod
-	def create_new_task(replication, schedule = None):
-		new_task = ReplicationTask.objects.create(replication = replication, dry_run = replication.dry_run, schedule = schedule)
+	def create_new_task(replication, schedule = None, **kwargs):
+		new_task = ReplicationTask.objects.create(replication = replication, dry_run = replication.dry_run, schedule = schedule, **kwargs)
 		logger.info(f"create_new_task: created new task {new_task}")
 		return new_task
 	
 	
+	@classmethod
+	def is_running_here(cls):
+		"""True if _run_loop is running in this process"""
+		return cls.thread is not None
+	
+	
+	@classmethod
+	def coalesce_trigger(cls, replication):
+		"""if replication already has pending task, count trigger to it and return True, otherwise return False.
+		in process of runner pending task is found in memory and counted there, DB is not used"""
+		if not cls.is_running_here():
+			task_id = ReplicationTask.objects.filter(replication = replication, start__isnull = True, cancelled = False, complete = False,
+				batch_of__isnull = True).order_by("id").values_list("id", flat = True).first()
+			if task_id is None:
+				return False
+			# row of task is updated, not created - worker adds counter to it when task starts
+			return ReplicationTask.objects.filter(pk = task_id, start__isnull = True, cancelled = False).update(coalesced_count = F("coalesced_count") + 1) == 1
+		with cls.lock:
+			state = cls.pending_by_replication.get(replication.id)
+			if state is None or not state.pending or state.id not in cls.tasks:
+				return False
+			state.coalesced_count += 1
+			if state.not_before is not None:
+				# trigger wants replication now, it does not wait for backoff of retry
+				state.not_before = None
+		return True
+	
+	
 	@classmethod
 	def add_task_for_replication(cls, replication, schedule = None):
+		"""queue task for replication and tasks for its batch followers. return new task, or None if trigger was
+		absorbed by pending task of replication"""
+		if cls.coalesce_trigger(replication):
+			logger.info(f"add_task_for_replication: replication {replication} already has pending task, trigger coalesced, schedule: {schedule}")
+			cls.wakeup()
+			return None
 		new_task = cls.create_new_task(replication, schedule = schedule)
-		cls.running_tasks.append(new_task)
-		same_replica_tasks = cls.get_same_replica_tasks(new_task)
-		if len(same_replica_tasks) >= cls.MAX_TASKS_FOR_REPLICA:
-			logger.info(f"add_task_for_replication: will instantly cancel new task {new_task} because there are already {cls.MAX_TASKS_FOR_REPLICA} same replication tasks")
-			new_task.comment = "Cancelled due to existing pending task"
-			cls.cancel_replication_task(new_task)
-			new_task.save()
-		logger.info(f"add_task_for_replication: added new task {new_task}, schedule: {schedule}")
+		batch_tasks = [cls.create_new_task(follower, schedule = schedule, batch_of = new_task) for follower in replication.get_batch_followers()]
+		if not cls.is_running_here():
+			logger.info(f"add_task_for_replication: task {new_task} queued in DB for worker, schedule: {schedule}, batch tasks: {len(batch_tasks)}")
+			return new_task
+		cls.add_task_state(new_task)
+		for task in batch_tasks:
+			cls.add_task_state(task)
+		logger.info(f"add_task_for_replication: added new task {new_task}, schedule: {schedule}, batch tasks: {len(batch_tasks)}")
+		cls.wakeup()
 		return new_task
 	
 	
+	@classmethod
+	def add_tasks_for_replications(cls, triggers):
+		"""queue tasks for burst of triggers - list of tuples (replication, schedule). tasks are created by one bulk insert
+		(and one more for tasks of batch followers), triggers of same replication are coalesced. return list of new tasks"""
+		new_tasks = {}
+		for replication, schedule in triggers:
+			if replication.id in new_tasks:
+				new_tasks[replication.id].coalesced_count += 1
+			elif not cls.coalesce_trigger(replication):
+				new_tasks[replication.id] = ReplicationTask(replication = replication, dry_run = replication.dry_run, schedule = schedule)
+		if len(new_tasks) == 0:
+			return []
+		if connection.features.can_return_rows_from_bulk_insert:
+			tasks = ReplicationTask.objects.bulk_create(new_tasks.values())
+			batch_tasks = [ReplicationTask(replication = follower, dry_run = follower.dry_run, schedule = task.schedule, batch_of = task)
+				for task in tasks for follower in task.replication.get_batch_followers()]
+			if len(batch_tasks) != 0:
+				batch_tasks = ReplicationTask.objects.bulk_create(batch_tasks)
+		else:
+			# ids of new rows are needed for queue, DB does not return them from bulk insert
+			tasks, batch_tasks = [], []
+			for task in new_tasks.values():
+				task.save()
+				tasks.append(task)
+				batch_tasks += [cls.create_new_task(follower, schedule = task.schedule, batch_of = task) for follower in task.replication.get_batch_followers()]
+		logger.info(f"add_tasks_for_replications: created {len(tasks)} tasks and {len(batch_tasks)} batch tasks for {len(triggers)} triggers")
+		if cls.is_running_here():
+			for task in tasks + batch_tasks:
+				cls.add_task_state(task)
+			cls.wakeup()
+		return tasks
+	
+	
+	@classmethod
+	def add_task_state(cls, task):
+		state = TaskState(task)
+		with cls.lock:
+			cls.tasks[state.id] = state
+			cls.enqueue_task_state(state)
+			if state.batch_of is None and state.replication_id not in cls.pending_by_replication:
+				cls.pending_by_replication[state.replication_id] = state
+		return state
+	
+	
+	@classmethod
+	def load_queued_tasks(cls):
+		"""load pending tasks created by other processes since last call, sync cancellation of pending and running tasks"""
+		new_tasks = ReplicationTask.objects.select_related("replication", "schedule").filter(id__gt = cls.last_loaded_id, start__isnull = True, cancelled = False, complete = False).order_by("id")
+		loaded = 0
+		for task in new_tasks:
+			cls.last_loaded_id = max(cls.last_loaded_id, task.id)
+			if task.id in cls.tasks:
+				continue
+			cls.add_task_state(task)
+			loaded += 1
+		with cls.lock:
+			pending_ids = [s.id for s in cls.tasks.values() if s.pending]
+			running_ids = [s.id for s in cls.tasks.values() if s.running and s.control is not None and not s.control.cancelled]
+		if len(pending_ids) != 0:
+			for task in ReplicationTask.objects.filter(id__in = pending_ids, cancelled = True):
+				state = cls.tasks.get(task.id)
+				if state is not None:
+					logger.info(f"load_queued_tasks: task {task} was cancelled by other process")
+					state.update_from_task(task)
+					cls.evict_task_state(state)
+					loaded += 1
+		if len(running_ids) != 0:
+			for task_id in ReplicationTask.objects.filter(id__in = running_ids, cancel_requested = True).values_list("id", flat = True):
+				state = cls.tasks.get(task_id)
+				if state is not None and state.control is not None:
+					logger.info(f"load_queued_tasks: cancel of running task {state} was requested by other process")
+					state.control.cancel(reason = "cancelled by user")
+		if loaded != 0:
+			logger.debug(f"load_queued_tasks: loaded {loaded} changes from DB queue")
+		return loaded
+	
+	
+	@classmethod
+	def recover_interrupted_tasks(cls):
+		"""mark tasks, which were running when previous runner process stopped, as failed"""
+		interrupted = ReplicationTask.objects.filter(running = True, complete = False)
+		for task in interrupted:
+			logger.error(f"recover_interrupted_tasks: task {task} was interrupted by restart of runner, marking as failed")
+			task.error = True
+			task.running = False
+			task.complete = True
+			task.end = timezone.now()
+			task.add_error_text("Interrupted by restart of task runner")
+			task.save()
+	
+	
 	@classmethod
 	def get_job_for_schedule(cls, schedule):
 		try:
@@ -80,107 +395,623 @@ class ReplicationTaskRunner(object, metaclass = MetaSingleton):
 			logger.error(f"get_job_for_schedule: got error {e}, traceback: {traceback.format_exc()}")
 	
 	
-	# TODO: under development
+	@classmethod
+	def get_task_states(cls):
+		"""return list of TaskState: pending and running tasks, then recently finished, newest first"""
+		with cls.lock:
+			return list(cls.tasks.values()) + list(reversed(cls.recent_tasks))
+	
+	
+	@classmethod
+	def evict_task_state(cls, state):
+		"""move state of finished or cancelled task from tasks to recent_tasks"""
+		with cls.lock:
+			cls.tasks.pop(state.id, None)
+			cls.forget_pending(state)
+			cls.recent_tasks.append(state)
+	
+	
 	@classmethod
 	def cancel_replication_task(cls, task):
-		# logger.info(f"cancel_replication_task: task will be cancelled: {task}")
-		if task in cls.running_tasks and not task.running:
-			logger.debug(f"cancel_replication_task: will cancel task {task}")
-			# task.set_cancel_required()
-			task.cancel()
-			task.save()
-			logger.debug(f"cancel_replication_task: task cancelled {task}")
-			return True
-		else:
-			logger.info(f"cancel_replication_task: could not cancel task {task} - it is already running or not in running_tasks list")
-			return False
+		"""cancel pending task, or terminate processes of running task"""
+		if not cls.is_running_here():
+			# runner of worker process will pick up cancellation from DB
+			cancelled = ReplicationTask.objects.filter(pk = task.id, start__isnull = True, complete = False).update(cancelled = True)
+			if cancelled == 0:
+				cancelled = ReplicationTask.objects.filter(pk = task.id, complete = False).update(cancel_requested = True)
+			logger.info(f"cancel_replication_task: task {task} cancelled in DB: {cancelled == 1}")
+			return cancelled == 1
+		with cls.lock:
+			state = cls.tasks.get(task.id)
+			if state is not None and not state.running:
+				logger.debug(f"cancel_replication_task: will cancel task {task}")
+				task.coalesced_count += state.coalesced_count
+				task.cancel()
+				state.update_from_task(task)
+				cls.remove_finished_batch(state)
+				cls.evict_task_state(state)
+				logger.debug(f"cancel_replication_task: task cancelled {task}")
+				cls.wakeup()
+				return True
+			elif state is not None and state.control is not None:
+				logger.info(f"cancel_replication_task: task {task} is running, will terminate its processes")
+				state.control.cancel(reason = "cancelled by user")
+				ReplicationTask.objects.filter(pk = task.id).update(cancel_requested = True)
+				return True
+			else:
+				logger.info(f"cancel_replication_task: could not cancel task {task} - it is not in tasks list")
+				return False
 	
 	
 	@classmethod
-	def find_blockers_for_task(cls, task):
-		# logger.debug(f"find_blockers_for_task: starting")
-		blockers = []
-		for r_task in cls.running_tasks:
-			if r_task.complete or r_task.cancelled or r_task == task:
-				# logger.debug(f"find_blockers_for_task: ignoring task {r_task} as blocker for {task}")
-				continue
-			if not r_task.running and (task.id < r_task.id):
-				# logger.debug(f"find_blockers_for_task: ignoring task {r_task} as blocker for {task} - it is newer")
-				continue
-			if r_task.running or (not r_task.running and (task.id > r_task.id)):
-				# dest r_task overwrites task src
-				if task.replication.src.startswith(r_task.replication.dest):
-					# logger.debug(f"find_blockers_for_task: task {r_task} is blocker for {task} because its dest overwrites task src")
-					blockers.append(r_task)
-				# dest overwrites dest
-				if task.replication.dest.startswith(r_task.replication.dest) or r_task.replication.dest.startswith(task.replication.dest):
-					# logger.debug(f"find_blockers_for_task: task {r_task} is blocker for {task} because its dest overwrites task dest or vice versa")
-					blockers.append(r_task)
-		logger.debug(f"find_blockers_for_task: for task {task} found blockers {[str(b) for b in blockers]}")
+	def find_blockers_for_task(cls, state, pending_index = None):
+		"""return list of running tasks (and tasks from pending_index, if specified) which conflict with task by src/dest paths"""
+		blockers = cls.path_index.find_conflicts(state.src, state.dest)
+		if pending_index is not None:
+			blockers |= pending_index.find_conflicts(state.src, state.dest)
+		blockers.discard(state)
+		blockers = sorted(blockers, key = lambda b: b.id)
+		logger.debug(f"find_blockers_for_task: for task {state} found blockers {[str(b) for b in blockers]}")
 		return blockers
 				
 		
 	@classmethod
-	def get_same_replica_tasks(cls, task):
-		same_replica_tasks = []
-		for r_task in cls.running_tasks:
-			if r_task.cancelled or r_task.complete or task == r_task:
-				logger.debug(f"get_same_replica_tasks: ignored task {r_task} for target task {task} as either cancelled or complete")
-				continue
-			if r_task.replication == task.replication:
-				same_replica_tasks.append(r_task)
-		logger.debug(f"get_same_replica_tasks: will return {[str(s) for s in same_replica_tasks]} for task {task}")
-		return same_replica_tasks
-				
+	def forget_pending(cls, state):
+		"""task is not pending anymore, next trigger of its replication creates new task"""
+		if cls.pending_by_replication.get(state.replication_id) is state:
+			del cls.pending_by_replication[state.replication_id]
+	
 	
-	# TODO: under testing
 	@classmethod
-	def get_next_task_to_run(cls, task):
-		"""return next task to run if task is not None, else first task to run"""
-		# logger.debug(f"get_next_task_to_run: input_task: {task}, tasks: {[str(t.id) + '-' + t.state for t in cls.running_tasks]}")
-		ind = cls.running_tasks.index(task) if task is not None else 0
-		for task in cls.running_tasks[ind:]:
-			if task.complete or task.running or task.cancelled:
+	def get_sort_key(cls, date_created, priority, expected_s):
+		"""virtual deadline of task: creation time plus delay of priority class plus delay growing with expected duration,
+		bounded by SJF_MAX_DELAY_S, so of tasks of same class created about same time shorter go first.
+		task with unknown duration counts as DEFAULT_DURATION_S"""
+		expected_s = DEFAULT_DURATION_S if expected_s is None else max(0.0, expected_s)
+		sjf_delay_s = cls.SJF_MAX_DELAY_S * expected_s / (expected_s + cls.SJF_SCALE_S)
+		return date_created.timestamp() + cls.PRIORITY_DELAY_S.get(priority, 0.0) + sjf_delay_s
+	
+	
+	@classmethod
+	def get_task_etas(cls, tasks, slots, now = None):
+		"""expected (start, end) of active ReplicationTask objects read from DB, pending tasks are taken in order of queue.
+		return dict task id -> (start, end), see predictor.get_etas"""
+		now = timezone.now() if now is None else now
+		running = [(t.id, t.start, t.replication.est_duration_s) for t in tasks if t.running and t.start is not None]
+		pending = sorted((t for t in tasks if t.pending and not t.cancelled),
+			key = lambda t: (cls.get_sort_key(t.date_created, t.replication.priority, t.replication.est_duration_s), t.id))
+		return get_etas(running, [(t.id, t.replication.est_duration_s, t.not_before) for t in pending], slots, now)
+	
+	
+	@classmethod
+	def enqueue_task_state(cls, state):
+		if state.sort_key is None:
+			state.sort_key = cls.get_sort_key(state.date_created, state.priority, state.expected_s)
+		heapq.heappush(cls.queue, (state.sort_key, state.id, state))
+	
+	
+	@classmethod
+	def pop_queue(cls):
+		"""return pending task with lowest sort_key, or None. cancelled and already launched tasks are dropped from queue"""
+		while len(cls.queue) != 0:
+			state = heapq.heappop(cls.queue)[2]
+			if state.pending and state.id in cls.tasks:
+				return state
+		return None
+	
+	
+	@classmethod
+	def pop_next_pending_task(cls):
+		"""return next pending task, or None. if next task goes to host without warm ssh master,
+		task to host with warm master queued less than HOST_GROUP_WINDOW_S later is returned instead"""
+		state = cls.pop_queue()
+		if state is None or state.host is None or SshControlPool.is_warm(state.host):
+			return state
+		popped = [state]
+		grouped = None
+		while len(cls.queue) != 0 and len(popped) < cls.HOST_GROUP_LOOKAHEAD and cls.queue[0][0] <= state.sort_key + cls.HOST_GROUP_WINDOW_S:
+			next_state = cls.pop_queue()
+			if next_state is None:
+				break
+			popped.append(next_state)
+			if next_state.host is not None and SshControlPool.is_warm(next_state.host):
+				grouped = next_state
+				break
+		if grouped is None:
+			grouped = state
+		for s in popped:
+			if s is not grouped:
+				cls.enqueue_task_state(s)
+		return grouped
+	
+	
+	@classmethod
+	def get_executor(cls, max_workers):
+		"""return pool of worker threads, pool is re-created if max_workers changed"""
+		max_workers = max(1, max_workers)
+		if cls.executor is None or cls.executor_size != max_workers:
+			if cls.executor is not None:
+				# already running tasks will complete in old pool
+				cls.executor.shutdown(wait = False)
+			cls.executor = ThreadPoolExecutor(max_workers = max_workers, thread_name_prefix = "ReplicationTask")
+			cls.executor_size = max_workers
+			logger.info(f"get_executor: created pool of {max_workers} workers")
+		return cls.executor
+	
+	
+	@classmethod
+	def has_free_slot(cls, state, settings):
+		if cls.running_count >= settings.max_running_tasks:
+			return False
+		if state.host is None:
+			return True
+		host_limit = settings.get_host_limit(state.host)
+		return host_limit <= 0 or cls.running_on_host.get(state.host, 0) < host_limit
+	
+	
+	@classmethod
+	def take_slot(cls, state):
+		cls.running_count += 1
+		if state.host is not None:
+			cls.running_on_host[state.host] = cls.running_on_host.get(state.host, 0) + 1
+	
+	
+	@classmethod
+	def release_slot(cls, state):
+		cls.running_count -= 1
+		if state.host is not None:
+			cls.running_on_host[state.host] -= 1
+			if cls.running_on_host[state.host] <= 0:
+				del cls.running_on_host[state.host]
+	
+	
+	@classmethod
+	def find_preemption_victim(cls, state):
+		"""return running task of lower priority on same host, which may be preempted by task, or None.
+		lowest priority and most recently launched task is preferred"""
+		victims = [s for s in cls.tasks.values() if s.running and s.host == state.host and s.priority > state.priority
+			and s.control is not None and not s.control.cancelled and s.suspended_by is None and s.preempted_by is None]
+		if len(victims) == 0:
+			return None
+		return max(victims, key = lambda s: (s.priority, s.id))
+	
+	
+	@classmethod
+	def preempt_for_task(cls, state, settings):
+		"""free slot on host of task by preemption of lower priority task, return True if slot is free right now"""
+		if settings.preemption_mode == Settings.PREEMPTION_OFF or state.host is None:
+			return False
+		if any(s.preempted_by == state.id for s in cls.tasks.values()):
+			# already waiting for cancelled task to terminate
+			return False
+		victim = cls.find_preemption_victim(state)
+		if victim is None:
+			return False
+		if settings.preemption_mode == Settings.PREEMPTION_SUSPEND:
+			logger.info(f"preempt_for_task: suspending task {victim} for task {state}")
+			victim.control.suspend()
+			victim.suspended_by = state.id
+			victim.state = "suspended"
+			# suspended task keeps its paths claimed, but not its slot
+			cls.release_slot(victim)
+			return cls.has_free_slot(state, settings)
+		logger.info(f"preempt_for_task: cancelling task {victim} for task {state}, it will be queued again")
+		victim.preempted_by = state.id
+		victim.control.cancel(reason = f"preempted by task {state.id}")
+		return False
+	
+	
+	@classmethod
+	def resume_suspended_tasks(cls, state):
+		"""resume tasks suspended by finished task"""
+		for s in cls.tasks.values():
+			if s.suspended_by == state.id:
+				logger.info(f"resume_suspended_tasks: resuming task {s} suspended by task {state}")
+				s.suspended_by = None
+				s.state = "running"
+				cls.take_slot(s)
+				s.control.resume()
+	
+	
+	@classmethod
+	def requeue_preempted_tasks(cls):
+		"""queue new tasks for replications whose tasks were cancelled by preemption or by change of bandwidth budget"""
+		with cls.lock:
+			replication_ids, cls.requeue_replication_ids = cls.requeue_replication_ids, []
+		for replication in Replication.objects.filter(id__in = replication_ids):
+			logger.info(f"requeue_preempted_tasks: queueing again replication {replication}")
+			cls.add_task_for_replication(replication)
+	
+	
+	@classmethod
+	def schedule_retries(cls):
+		"""queue retries of failed tasks, if their failure is transient and replication has retries left"""
+		with cls.lock:
+			task_ids, cls.retry_candidate_ids = cls.retry_candidate_ids, []
+		for task in ReplicationTask.objects.select_related("replication", "schedule").filter(id__in = task_ids):
+			reason = task.get_retry_reason()
+			if reason is None:
 				continue
-			# logger.debug(f"get_next_task_to_run: input_task: {task}, returning {task}")
-			return task
+			if task.attempt > task.replication.rsync_retries:
+				logger.info(f"schedule_retries: task {task} failed ({reason}), but no retries left")
+				continue
+			delay = task.replication.get_retry_delay(task.attempt)
+			new_task = cls.create_new_task(task.replication, schedule = task.schedule, attempt = task.attempt + 1,
+				retry_of = task.retry_of or task, not_before = timezone.now() + datetime.timedelta(seconds = delay),
+				comment = f"Retry {task.attempt} of task {task.id}: {reason}")
+			logger.info(f"schedule_retries: task {task} failed ({reason}), retry {new_task} in {delay:.0f} s")
+			cls.add_task_state(new_task)
+	
+	
+	@classmethod
+	def submit_task(cls, state, settings):
+		if settings.runner_engine == Settings.ENGINE_ASYNCIO:
+			AsyncioEngine.submit(cls._run_task_async(state))
+		else:
+			# worker of abandoned task may still hang, pool should have enough threads for all slots anyway
+			cls.get_executor(settings.max_running_tasks + cls.abandoned_count).submit(cls._run_task, state)
+	
+	
+	@staticmethod
+	def load_task(state):
+		return ReplicationTask.objects.select_related("replication", "schedule").get(pk = state.id)
+	
+	
+	@staticmethod
+	def mark_task_failed(task, error):
+		task.error = True
+		task.running = False
+		task.complete = True
+		task.add_error_text(f"Runner error: {error}")
+		task.save()
+	
+	
+	@classmethod
+	def _run_task(cls, state):
+		task = None
+		try:
+			task = cls.load_task(state)
+			task.control = state.control
+			task.bwlimit = state.bwlimit
+			task.coalesced_count += state.coalesced_count
+			state.task = task
+			if task.cancelled:
+				logger.info(f"_run_task: NOT running task {task} - because it is cancelled")
+			else:
+				task.run()
+		except Exception as e:
+			logger.error(f"_run_task: task {state} got error {e}, traceback: {traceback.format_exc()}")
+			if task is not None:
+				cls.mark_task_failed(task, e)
+		finally:
+			cls.on_task_finished(state, task)
+	
+	
+	@classmethod
+	async def _run_task_async(cls, state):
+		"""asyncio version of _run_task, runs in loop of AsyncioEngine"""
+		task = None
+		try:
+			task = await sync_to_async(cls.load_task)(state)
+			task.control = state.control
+			task.bwlimit = state.bwlimit
+			task.coalesced_count += state.coalesced_count
+			state.task = task
+			if task.cancelled:
+				logger.info(f"_run_task_async: NOT running task {task} - because it is cancelled")
+			else:
+				await run_steps_async(task.steps())
+		except Exception as e:
+			logger.error(f"_run_task_async: task {state} got error {e}, traceback: {traceback.format_exc()}")
+			if task is not None:
+				await sync_to_async(cls.mark_task_failed)(task, e)
+		finally:
+			cls.on_task_finished(state, task)
+	
+	
+	@classmethod
+	def launch_task(cls, state, settings):
+		logger.info(f"launch_task: launching task {state}")
+		# mark task as running right now, so next dispatch pass will not launch it again before its thread saves start
+		with cls.lock:
+			state.running = True
+			state.state = "running"
+			state.control = ProcessControl()
+			state.launched_at = time.monotonic()
+			cls.forget_pending(state)
+			state.bwlimit = cls.allocate_bandwidth(state, settings)
+			cls.path_index.add_task_claims(state, state.src, state.dest)
+			cls.take_slot(state)
+		cls.submit_task(state, settings)
+	
+	
+	@classmethod
+	def allocate_bandwidth(cls, state, settings):
+		"""return --bwlimit for task from current bandwidth budgets, or None if there is no limit"""
+		if state.host is None:
+			return None
+		rules = BudgetRule.parse_rules(settings.bandwidth_budgets)
+		rate_bps = cls.bandwidth.allocate(state.id, state.host, rules, timezone.localtime(),
+			max_running_tasks = settings.max_running_tasks, host_limit = settings.get_host_limit(state.host))
+		return to_bwlimit(rate_bps) if rate_bps is not None else None
+	
+	
+	@classmethod
+	def has_bandwidth(cls, state, settings):
+		"""False if share of remote task is not left of budget of its global or host scope"""
+		if state.host is None:
+			return True
+		rules = BudgetRule.parse_rules(settings.bandwidth_budgets)
+		return cls.bandwidth.get_rate(state.id, state.host, rules, timezone.localtime(), max_running_tasks = settings.max_running_tasks,
+			host_limit = settings.get_host_limit(state.host)) != 0
+	
+	
+	@classmethod
+	def update_bandwidth_demand(cls, settings, now):
+		"""pending remote tasks which could start now contend for bandwidth budgets with running tasks.
+		deferred tasks, tasks without free slot and tasks blocked by paths of running or earlier pending tasks do not contend"""
+		demand = {}
+		if len(settings.bandwidth_budgets.strip()) != 0:
+			pending_index = PathClaimIndex()
+			seen = set()
+			for sort_key, task_id, state in sorted(cls.queue, key = lambda item: item[:2]):
+				if task_id in seen or not state.pending or task_id not in cls.tasks:
+					continue
+				seen.add(task_id)
+				if state.host is None or (state.not_before is not None and state.not_before > now) or not cls.has_free_slot(state, settings):
+					continue
+				if len(cls.path_index.find_conflicts(state.src, state.dest)) == 0 and len(pending_index.find_conflicts(state.src, state.dest)) == 0:
+					demand[state.id] = state.host
+				pending_index.add_task_claims(state, state.src, state.dest)
+		cls.bandwidth.set_demand(demand)
+	
+	
+	@classmethod
+	def check_bandwidth_budgets(cls):
+		"""restart running tasks whose --bwlimit was allocated by budget which is not in effect anymore,
+		or differs from their fair share of budget now, they are queued again"""
+		settings = Settings.get_settings()
+		rules = BudgetRule.parse_rules(settings.bandwidth_budgets)
+		with cls.lock:
+			outdated = set(cls.bandwidth.get_outdated(rules, timezone.localtime(), max_running_tasks = settings.max_running_tasks,
+				get_host_limit = settings.get_host_limit))
+			states = [s for s in cls.tasks.values() if s.id in outdated and s.running and s.control is not None
+				and not s.control.cancelled and s.suspended_by is None and not s.released]
+		for state in states:
+			logger.info(f"check_bandwidth_budgets: bandwidth share of task {state} changed, restarting it with new --bwlimit")
+			state.bandwidth_restart = True
+			state.control.cancel(reason = "bandwidth share changed, task is queued again with new --bwlimit")
+	
+	
+	@classmethod
+	def release_task(cls, state):
+		"""release paths, slot and bandwidth of task, resume tasks suspended by it"""
+		cls.path_index.remove_task_claims(state, state.src, state.dest)
+		cls.bandwidth.release(state.id)
+		if state.suspended_by is None:
+			cls.release_slot(state)
+		state.suspended_by = None
+		cls.resume_suspended_tasks(state)
+		if state.preempted_by is not None or state.bandwidth_restart:
+			# DB is not used here, it may be called from event loop thread
+			cls.requeue_replication_ids.append(state.replication_id)
+	
+	
+	@classmethod
+	def remove_finished_batch(cls, state):
+		"""remove batch file of leader task when leader and all its followers are finished"""
+		leader_id = state.batch_of if state.batch_of is not None else state.id
+		others = [s for s in cls.tasks.values() if s is not state and (s.id == leader_id or s.batch_of == leader_id)]
+		if len(others) == 0 and (state.batch_of is not None or os.path.exists(ReplicationTask.get_batch_file_path(leader_id))):
+			ReplicationTask.remove_batch_files(leader_id)
+	
+	
+	@classmethod
+	def on_task_finished(cls, state, task = None):
+		with cls.lock:
+			cls.remove_finished_batch(state)
+			if state.released:
+				# already released and evicted by watchdog
+				cls.abandoned_count -= 1
+			else:
+				cls.release_task(state)
+				if state.preempted_by is None and not state.bandwidth_restart and task is not None and task.error:
+					cls.retry_candidate_ids.append(state.id)
+			if task is not None:
+				state.update_from_task(task)
+			else:
+				state.running = False
+				state.complete = True
+			state.task = None
+			if not state.released:
+				cls.evict_task_state(state)
+		logger.debug(f"on_task_finished: task {state} finished, its blockers and slot are released")
+		cls.wakeup()
+	
+	
+	@staticmethod
+	def get_timeout_reason(state, now):
+		"""return reason to kill task, or None if task is within its timeouts"""
+		control = state.control
+		if state.timeout_s > 0 and state.launched_at is not None and now - state.launched_at - control.suspended_s > state.timeout_s:
+			return f"timeout, running longer than {state.timeout_s // 60} min"
+		if state.stall_timeout_s > 0 and control.last_activity is not None and now - control.last_activity > state.stall_timeout_s:
+			return f"stalled, no output and no progress for {state.stall_timeout_s // 60} min"
 		return None
 	
 	
 	@classmethod
-	def launch_task(cls, task):
-		if hasattr(task, "cancel_required"):
-			logger.debug(f"launch_task: cancel_required: {task.cancel_required}")
-		if task.cancelled:
-			logger.debug(f"launch_task: NOT launching task {task} - because it is cancelled")
-			return
-		logger.info(f"launch_task: launching task {task}")
-		task.launch()
+	def check_timeouts(cls):
+		"""watchdog: kill tasks which exceeded their timeout or stall timeout"""
+		now = time.monotonic()
+		with cls.lock:
+			states = [s for s in cls.tasks.values() if s.running and s.control is not None and not s.control.cancelled and s.suspended_by is None]
+		for state in states:
+			reason = cls.get_timeout_reason(state, now)
+			if reason is not None:
+				cls.abandon_task(state, reason)
 	
 	
 	@classmethod
-	def _run_loop(cls):
-		logger.info(f"_run_loop: starting loop ReplicationTaskRunner")
-		while True:
-			if len(cls.running_tasks) == 0:
-				# logger.debug(f"_run_loop: running_tasks is empty")
-				time.sleep(cls.LOOP_DELAY)
+	def abandon_task(cls, state, reason):
+		"""kill processes of task, mark it failed and release its paths and slot right now.
+		worker of task is not waited for - process may hang in uninterruptible IO (stuck NFS mount) even after SIGKILL"""
+		logger.error(f"abandon_task: task {state} will be killed: {reason}")
+		state.control.timed_out = True
+		state.control.cancel(reason = reason, grace_period = cls.TIMEOUT_KILL_GRACE_S)
+		end = timezone.now()
+		with cls.lock:
+			cls.release_task(state)
+			state.released = True
+			cls.abandoned_count += 1
+			cls.retry_candidate_ids.append(state.id)
+			state.running = False
+			state.complete = True
+			state.error = True
+			state.end = end
+			state.state = "killed by watchdog"
+			cls.evict_task_state(state)
+		ReplicationTask.objects.filter(pk = state.id, complete = False).update(error = True, running = False, complete = True,
+			end = end, comment = f"Killed by watchdog: {reason}")
+		cls.wakeup()
+	
+	
+	@classmethod
+	def save_progress(cls):
+		"""save live progress of running tasks to DB, so it can be shown by any web process"""
+		with cls.lock:
+			running_tasks = [s.task for s in cls.tasks.values() if s.task is not None and s.task.output_parser is not None]
+		for task in running_tasks:
+			parser = task.output_parser
+			if parser.progress_percent is None:
 				continue
-			# TODO: check this!
-			next_task = cls.get_next_task_to_run(None)
-			while next_task is not None:
-				blockers = cls.find_blockers_for_task(next_task)
-				if len(blockers) != 0:
-					logger.debug(f"task {next_task} has blockers {[str(b) for b in blockers]}, will try next task")
-					time.sleep(cls.LOOP_DELAY_ON_BLOCKER)
-					next_task = cls.get_next_task_to_run(next_task)
+			# filter by complete, so final results saved by task itself are not overwritten
+			ReplicationTask.objects.filter(pk = task.id, complete = False).update(progress_percent = parser.progress_percent,
+				bytes_per_s = parser.bytes_per_s, bytes_copied = parser.bytes_done)
+		cls.last_progress_save = time.monotonic()
+	
+	
+	@classmethod
+	def wakeup(cls):
+		"""request dispatch pass from _run_loop"""
+		with cls.condition:
+			cls.dispatch_required = True
+			cls.condition.notify()
+	
+	
+	@classmethod
+	def defer_task(cls, state, not_before):
+		"""keep task in queue until not_before, deferred task does not reserve its paths"""
+		state.not_before = not_before
+		if cls.deferred_until is None or not_before < cls.deferred_until:
+			cls.deferred_until = not_before
+	
+	
+	@classmethod
+	def fail_unreachable_task(cls, state):
+		"""pending task whose host stayed down through all its deferrals fails as unreachable,
+		so it is shown as failed and retried by schedule_retries like task which could not reach host itself"""
+		error_text = f"Replication is remote, but could not reach {state.host}, will not replicate (deferred {state.host_retries} times)"
+		logger.error(f"fail_unreachable_task: task {state}: {error_text}")
+		end = timezone.now()
+		with cls.lock:
+			state.error = True
+			state.complete = True
+			state.end = end
+			state.state = "error, host unreachable"
+			cls.retry_candidate_ids.append(state.id)
+			cls.evict_task_state(state)
+		ReplicationTask.objects.filter(pk = state.id, complete = False).update(error = True, complete = True, end = end, error_text = error_text)
+	
+	
+	@classmethod
+	def dispatch_pending_tasks(cls):
+		"""one pass over all pending tasks, launches every task without blockers, returns list of launched tasks
+		
+		blocked task keeps its paths claimed in pending_index until end of pass, so newer tasks will not overtake it
+		"""
+		launched_tasks = []
+		pending_index = PathClaimIndex()
+		settings = Settings.get_settings()
+		skipped_tasks = []
+		now = timezone.now()
+		with cls.lock:
+			cls.deferred_until = None
+			cls.update_bandwidth_demand(settings, now)
+			while cls.running_count < settings.max_running_tasks:
+				state = cls.pop_next_pending_task()
+				if state is None:
+					break
+				if state.batch_of is not None and state.batch_of in cls.tasks:
+					# batch of leader task is not written yet, runner is woken up when leader finishes
+					skipped_tasks.append(state)
+					continue
+				if state.not_before is not None and state.not_before > now:
+					cls.defer_task(state, state.not_before)
+					skipped_tasks.append(state)
 					continue
+				if state.probe is not None:
+					reachable = HostHealth.get_cached(*state.probe)
+					if reachable is None:
+						# probe is shared by all tasks to host, dispatch pass is requested when it is done
+						HostHealth.probe(*state.probe).add_done_callback(lambda f: cls.wakeup())
+						skipped_tasks.append(state)
+						continue
+					if not reachable:
+						state.deferrals += 1
+						if state.deferrals > state.host_retries:
+							cls.fail_unreachable_task(state)
+							continue
+						down_s = HostHealth.get_down_seconds(*state.probe) or 0.0
+						logger.info(f"dispatch_pending_tasks: host {state.host} of task {state} is down, deferring task for {down_s:.0f} s ({state.deferrals} of {state.host_retries})")
+						cls.defer_task(state, now + datetime.timedelta(seconds = down_s))
+						skipped_tasks.append(state)
+						continue
+				blockers = cls.find_blockers_for_task(state, pending_index = pending_index)
+				if len(blockers) != 0:
+					logger.debug(f"dispatch_pending_tasks: task {state} has blockers {[str(b) for b in blockers]}, will try next task")
+					pending_index.add_task_claims(state, state.src, state.dest)
+					skipped_tasks.append(state)
+				elif not cls.has_bandwidth(state, settings):
+					logger.debug(f"dispatch_pending_tasks: bandwidth budget of task {state} is used up, will try next task")
+					pending_index.add_task_claims(state, state.src, state.dest)
+					skipped_tasks.append(state)
+				elif not cls.has_free_slot(state, settings) and not cls.preempt_for_task(state, settings):
+					logger.debug(f"dispatch_pending_tasks: no free slot for host of task {state}, will try next task")
+					pending_index.add_task_claims(state, state.src, state.dest)
+					skipped_tasks.append(state)
 				else:
-					logger.debug(f"_run_loop: task {next_task} has no blockers, launching")
-					cls.launch_task(next_task)
-					time.sleep(cls.TASK_START_DELAY)
-					next_task = cls.get_next_task_to_run(next_task)
-			time.sleep(cls.LOOP_DELAY)
+					logger.debug(f"dispatch_pending_tasks: task {state} has no blockers, launching")
+					cls.launch_task(state, settings)
+					launched_tasks.append(state)
+			for state in skipped_tasks:
+				cls.enqueue_task_state(state)
+		return launched_tasks
+	
+	
+	@classmethod
+	def _run_loop(cls):
+		logger.info(f"_run_loop: starting loop ReplicationTaskRunner")
+		while True:
+			with cls.condition:
+				woken_up = cls.condition.wait_for(lambda: cls.dispatch_required, timeout = cls.QUEUE_POLL_DELAY)
+				cls.dispatch_required = False
+			try:
+				if len(cls.requeue_replication_ids) != 0:
+					cls.requeue_preempted_tasks()
+				if len(cls.retry_candidate_ids) != 0:
+					cls.schedule_retries()
+				loaded = cls.load_queued_tasks()
+				deferred_due = cls.deferred_until is not None and timezone.now() >= cls.deferred_until
+				if woken_up or loaded != 0 or deferred_due:
+					cls.dispatch_pending_tasks()
+				if cls.running_count != 0:
+					cls.check_timeouts()
+					cls.check_bandwidth_budgets()
+				if cls.running_count != 0 and time.monotonic() - cls.last_progress_save >= cls.PROGRESS_SAVE_DELAY:
+					cls.save_progress()
+			except Exception as e:
+				logger.error(f"_run_loop: got error {e}, traceback: {traceback.format_exc()}")
 	
 	
 	@classmethod
@@ -189,6 +1020,7 @@ class ReplicationTaskRunner(object, metaclass = MetaSingleton):
 			logger.info(f"start_loop_subthread: ReplicationTaskRunner thread is None, launching _run_loop")
 			cls.thread = threading.Thread(target = cls._run_loop)
 			cls.thread.start()
+			cls.wakeup()
 			return
 		logger.debug(f"start_loop_subthread: ReplicationTaskRunner thread already running: {cls.thread}")
 
@@ -196,29 +1028,77 @@ class ReplicationTaskRunner(object, metaclass = MetaSingleton):
 	@classmethod
 	def launch_startup(cls):
 		logger.info(f"launch_startup: starting ReplicationTaskRunner")
+		cls.recover_interrupted_tasks()
 		cls.start_loop_subthread()
 
 	
 
-class ReplicationScheduler(object, metaclass = MetaSingleton):
-	"""manages Replication schedule table, starts new tasks
+class ScheduleJob(object):
+	"""job of ReplicationScheduler for one enabled ReplicationSchedule. seq identifies its current entry in heap.
+	catchup_runs - missed runs still to be fired, while there are any, next_run is slot of catch-up run"""
+	__slots__ = ("schedule", "signature", "next_run", "last_run", "seq", "catchup_runs")
 	
-	all ReplicationSchedule should be already created via ReplicationSchedule.objects.create()
 	
+	def __init__(self, schedule, last_run = None):
+		self.schedule = schedule
+		self.signature = schedule.signature
+		self.last_run = last_run
+		self.next_run = None
+		self.seq = None
+		self.catchup_runs = []
+	
+	
+	def __str__(self):
+		return f"ScheduleJob for {self.schedule}, next run {self.next_run}"
+	
+	
+
+class ReplicationScheduler(object, metaclass = MetaSingleton):
+	"""runs tasks of enabled ReplicationSchedule rows at their times
+	
+	every schedule is job with time of its next run (see ReplicationSchedule.get_next_run), jobs are in min-heap
+	ordered by next run. _run_loop sleeps on condition exactly until first job is due (at most MAX_SLEEP_S,
+	so change of wall clock is noticed), fires due jobs and pushes them back with their next run.
+	job is added, replaced or removed in O(log n): new heap entry gets new seq, entries with seq other than seq
+	of their job are stale and are dropped when they reach top of heap.
+	changes of schedules and replications are applied one job at a time: in this process by signals (signals.py),
+	changes made by other processes are picked up every SYNC_DELAY_S by date_modified. due jobs are checked
+	against DB before they fire, so schedule deleted or changed in other process does not run by its old job.
+	last and next fire of every schedule are saved to DB. on start runs missed since last fire are handled
+	by Settings.misfire_policy, catch-up runs of all schedules are at least Settings.misfire_catchup_interval apart.
 	"""
 	
 	thread = None
-	schedule = None
-	LOOP_DELAY = 1.0
+	MAX_SLEEP_S = 60.0
+	SYNC_DELAY_S = 10.0
+	# changes saved but not yet committed when previous sync ran are seen by next one
+	SYNC_OVERLAP_S = 60.0
+	PREVIEW_RUNS = 10
+	# missed runs of schedule are looked for at most this many
+	MAX_CATCHUP_RUNS = 100
+	catchup_interval_s = 60
+	next_catchup_slot = None
+	last_sync = None
+	jobs = {}
+	heap = []
+	seq = itertools.count()
+	condition = threading.Condition(threading.RLock())
 	
 
 	@classmethod
 	def _run_loop(cls):
 		logger.info(f"_run_loop: starting ReplicationScheduler inner cycle")
 		while True:
-			schedule.run_pending()
-			# logger.debug(f"run_pending: current jobs: {schedule.jobs}")
-			time.sleep(cls.LOOP_DELAY)
+			with cls.condition:
+				sleep_s = min(cls.get_sleep_seconds(), cls.SYNC_DELAY_S)
+				if sleep_s > 0:
+					cls.condition.wait(timeout = sleep_s)
+			try:
+				if cls.last_sync is None or (timezone.now() - cls.last_sync).total_seconds() >= cls.SYNC_DELAY_S:
+					cls.sync_changes()
+				cls.run_pending()
+			except Exception as e:
+				logger.error(f"_run_loop: got error {e}, traceback: {traceback.format_exc()}")
 	
 	
 	@classmethod
@@ -238,26 +1118,304 @@ class ReplicationScheduler(object, metaclass = MetaSingleton):
 		cls.start_loop_subthread()
 	
 	
+	@classmethod
+	def is_valid_entry(cls, entry):
+		job = cls.jobs.get(entry[2])
+		return job is not None and job.seq == entry[1]
+	
+	
+	@classmethod
+	def push_job(cls, job):
+		"""push job to heap with its next_run, its previous entry becomes stale"""
+		job.seq = next(cls.seq)
+		if job.next_run is not None:
+			heapq.heappush(cls.heap, (job.next_run, job.seq, job.schedule.id))
+		if len(cls.heap) > 2 * len(cls.jobs) + 64:
+			# too many stale entries, O(n) rebuild is amortized by updates which made them
+			cls.heap = [e for e in cls.heap if cls.is_valid_entry(e)]
+			heapq.heapify(cls.heap)
+	
+	
+	@classmethod
+	def get_sleep_seconds(cls):
+		"""seconds until first job is due, at most MAX_SLEEP_S"""
+		with cls.condition:
+			while len(cls.heap) != 0 and not cls.is_valid_entry(cls.heap[0]):
+				heapq.heappop(cls.heap)
+			if len(cls.heap) == 0:
+				return cls.MAX_SLEEP_S
+			return min(cls.MAX_SLEEP_S, (cls.heap[0][0] - timezone.now()).total_seconds())
+	
+	
+	@classmethod
+	def make_job(cls, schedule, last_run = None, now = None):
+		"""return job for schedule with its next run, or None if schedule is disabled or will not run anymore"""
+		if not schedule.enabled or not schedule.replication.enabled:
+			return None
+		job = ScheduleJob(schedule, last_run = last_run)
+		job.next_run = schedule.get_next_run(now, last_run = last_run)
+		if job.next_run is None:
+			logger.info(f"make_job: schedule {schedule} will not run anymore")
+			return None
+		return job
+	
+	
+	@classmethod
+	def get_catchup_slot(cls, now):
+		"""time of next catch-up run, slots of all schedules are catchup_interval_s apart"""
+		slot = now if cls.next_catchup_slot is None else max(now, cls.next_catchup_slot)
+		cls.next_catchup_slot = slot + datetime.timedelta(seconds = cls.catchup_interval_s)
+		return slot
+	
+	
+	@classmethod
+	def apply_misfire_policy(cls, job, policy, now):
+		"""runs of job missed while scheduler was not running become its catch-up runs, depending on policy"""
+		missed = job.schedule.get_missed_runs(now, limit = cls.MAX_CATCHUP_RUNS)
+		if len(missed) == 0:
+			return
+		if policy == Settings.MISFIRE_SKIP:
+			logger.info(f"apply_misfire_policy: skipping {len(missed)} missed runs of {job.schedule}, first at {missed[0]}")
+			return
+		job.catchup_runs = missed if policy == Settings.MISFIRE_ALL else missed[-1:]
+		job.next_run = cls.get_catchup_slot(now)
+		logger.info(f"apply_misfire_policy: {len(missed)} missed runs of {job.schedule}, {len(job.catchup_runs)} catch-up runs from {job.next_run}")
+	
+	
+	@staticmethod
+	def save_fire_times(schedules):
+		"""save last_fire and next_fire of schedules in one query. bulk_update does not change date_modified and sends no signals"""
+		if len(schedules) == 0:
+			return
+		try:
+			ReplicationSchedule.objects.bulk_update(schedules, ["last_fire", "next_fire"])
+		except Exception as e:
+			logger.error(f"save_fire_times: could not save fire times of {len(schedules)} schedules: {e}")
+	
+	
+	@classmethod
+	def add_job(cls, schedule):
+		"""add job of schedule, or replace existing job of it if schedule changed. return job or None"""
+		with cls.condition:
+			old_job = cls.jobs.get(schedule.id)
+			if old_job is not None and old_job.signature == schedule.signature:
+				# nothing which decides next run changed, job keeps its place in heap
+				old_job.schedule = schedule
+				return old_job
+			cls.jobs.pop(schedule.id, None)
+			job = cls.make_job(schedule, last_run = old_job.last_run if old_job is not None else None)
+			if job is not None:
+				cls.jobs[schedule.id] = job
+				cls.push_job(job)
+				logger.debug(f"add_job: added {job}")
+			cls.condition.notify()
+		next_fire = job.next_run if job is not None else None
+		if schedule.next_fire != next_fire:
+			schedule.next_fire = next_fire
+			cls.save_fire_times([schedule])
+		return job
+	
+	
+	@classmethod
+	def remove_job(cls, schedule_id):
+		"""remove job of schedule, its heap entry becomes stale"""
+		with cls.condition:
+			job = cls.jobs.pop(schedule_id, None)
+			cls.condition.notify()
+		logger.debug(f"remove_job: removed {job}")
+		return job
+	
+	
+	@classmethod
+	def update_replication_jobs(cls, replication):
+		"""replication was saved (it may be enabled or disabled), update jobs of its schedules"""
+		for s in ReplicationSchedule.objects.filter(replication = replication):
+			s.replication = replication
+			cls.add_job(s)
+	
+	
+	@classmethod
+	def sync_changes(cls, now = None):
+		"""apply changes of schedules and replications saved since last sync, return number of changed schedules.
+		cost depends on number of changes, not on number of schedules"""
+		now = timezone.now() if now is None else now
+		since = cls.last_sync - datetime.timedelta(seconds = cls.SYNC_OVERLAP_S) if cls.last_sync is not None else None
+		cls.last_sync = now
+		if since is None:
+			return 0
+		changed = ReplicationSchedule.objects.select_related("replication").filter(date_modified__gte = since) | \
+			ReplicationSchedule.objects.select_related("replication").filter(replication__date_modified__gte = since)
+		count = 0
+		for s in changed:
+			job = cls.jobs.get(s.id)
+			if job is None or job.signature != s.signature:
+				count += 1
+			cls.add_job(s)
+		if count != 0:
+			logger.info(f"sync_changes: {count} changed schedules applied")
+		return count
+	
+	
+	@classmethod
+	def refresh_due_jobs(cls, due_jobs):
+		"""re-read schedules of due jobs in one query, return jobs which should fire.
+		job of deleted, disabled or changed schedule is removed or rescheduled instead"""
+		if len(due_jobs) == 0:
+			return []
+		try:
+			schedules = ReplicationSchedule.objects.select_related("replication").in_bulk([job.schedule.id for job in due_jobs])
+		except Exception as e:
+			logger.error(f"refresh_due_jobs: could not read schedules, jobs will fire as loaded: {e}")
+			return due_jobs
+		jobs = []
+		for job in due_jobs:
+			s = schedules.get(job.schedule.id)
+			if s is None:
+				logger.info(f"refresh_due_jobs: schedule of {job} was deleted")
+				cls.remove_job(job.schedule.id)
+			elif s.signature != job.signature:
+				logger.info(f"refresh_due_jobs: schedule of {job} was changed, rescheduling")
+				cls.add_job(s)
+			else:
+				job.schedule = s
+				jobs.append(job)
+		return jobs
+	
+	
+	@classmethod
+	def pop_due_jobs(cls, now):
+		due_jobs = []
+		with cls.condition:
+			while len(cls.heap) != 0 and cls.heap[0][0] <= now:
+				entry = heapq.heappop(cls.heap)
+				if cls.is_valid_entry(entry):
+					due_jobs.append(cls.jobs[entry[2]])
+		return due_jobs
+	
+	
+	@classmethod
+	def fire_jobs(cls, jobs):
+		"""queue tasks of due jobs, jobs due at once (burst) are queued together"""
+		for job in jobs:
+			if len(job.catchup_runs) != 0:
+				logger.info(f"fire_jobs: running schedule {job.schedule}, catch-up of run missed at {job.catchup_runs[0]}")
+			else:
+				logger.info(f"fire_jobs: running schedule {job.schedule}, due at {job.next_run}")
+		try:
+			if len(jobs) == 1:
+				ReplicationTaskRunner.add_task_for_replication(jobs[0].schedule.replication, schedule = jobs[0].schedule)
+			else:
+				ReplicationTaskRunner.add_tasks_for_replications([(job.schedule.replication, job.schedule) for job in jobs])
+		except Exception as e:
+			logger.error(f"fire_jobs: could not add tasks for {len(jobs)} schedules: {e}, traceback: {traceback.format_exc()}")
+	
+	
+	@classmethod
+	def run_pending(cls, now = None):
+		"""fire all due jobs and push them back with their next run, return list of fired jobs"""
+		now = timezone.now() if now is None else now
+		due_jobs = cls.refresh_due_jobs(cls.pop_due_jobs(now))
+		if len(due_jobs) != 0:
+			cls.fire_jobs(due_jobs)
+		fired_schedules = []
+		for job in due_jobs:
+			with cls.condition:
+				if cls.jobs.get(job.schedule.id) is not job:
+					# job was replaced or removed while it fired
+					continue
+				# scheduled time of catch-up run is its missed run, it keeps phase of every N days schedule
+				job.last_run = job.catchup_runs.pop(0) if len(job.catchup_runs) != 0 else job.next_run
+				if len(job.catchup_runs) != 0:
+					job.next_run = cls.get_catchup_slot(now)
+				else:
+					# runs missed while loop was late are skipped
+					job.next_run = job.schedule.get_next_run(max(now, job.last_run), last_run = job.last_run)
+				job.schedule.last_fire = job.last_run
+				job.schedule.next_fire = job.next_run
+				fired_schedules.append(job.schedule)
+				if job.next_run is None:
+					del cls.jobs[job.schedule.id]
+					continue
+				cls.push_job(job)
+		cls.save_fire_times(fired_schedules)
+		return due_jobs
+	
+	
+	@classmethod
+	def get_next_runs(cls, n = None, schedules = None, now = None):
+		"""preview: list of tuples (time, schedule) of next n runs of all schedules.
+		runs of jobs are used if schedules are not specified and scheduler runs in this process, otherwise runs of schedules from DB"""
+		n = cls.PREVIEW_RUNS if n is None else n
+		if schedules is None and cls.thread is not None:
+			with cls.condition:
+				heap = [(job.next_run, job.seq, job.schedule) for job in cls.jobs.values()]
+		else:
+			if schedules is None:
+				schedules = ReplicationSchedule.objects.select_related("replication").filter(enabled = True, replication__enabled = True)
+			heap = []
+			for s in schedules:
+				job = cls.make_job(s, now = now)
+				if job is not None:
+					heap.append((job.next_run, len(heap), s))
+		heapq.heapify(heap)
+		runs = []
+		while len(heap) != 0 and len(runs) < n:
+			run, i, s = heapq.heappop(heap)
+			runs.append((run, s))
+			next_run = s.get_next_run(run, last_run = run)
+			if next_run is not None:
+				heapq.heappush(heap, (next_run, i, s))
+		return runs
+	
+	
 	@classmethod
 	def load_all_schedules(cls):
-		all_schedules = ReplicationSchedule.objects.all().filter(enabled = True).filter(replication__enabled = True)
-		logger.debug(f"load_all_schedules: all enabled schedules: {[str(s) for s in all_schedules]} (total: {len(all_schedules)})")
-		for s in all_schedules:
-			s.load_schedule_object()
-		logger.info(f"load_all_schedules: all jobs loaded to scheduler. current jobs: {schedule.jobs}")
+		"""build jobs of all enabled schedules, heap is built in O(n). last runs and catch-up runs of existing jobs are kept,
+		schedules without job continue from their saved last fire, misfire policy is applied to their missed runs"""
+		all_schedules = ReplicationSchedule.objects.select_related("replication").filter(enabled = True, replication__enabled = True)
+		settings = Settings.get_settings()
+		now = timezone.now()
+		changed = []
+		with cls.condition:
+			cls.catchup_interval_s = max(0, settings.misfire_catchup_interval)
+			old_jobs = cls.jobs
+			cls.jobs = {}
+			cls.heap = []
+			for s in all_schedules:
+				old_job = old_jobs.get(s.id)
+				job = cls.make_job(s, last_run = old_job.last_run if old_job is not None else s.last_fire, now = now)
+				if job is None:
+					continue
+				if old_job is None:
+					cls.apply_misfire_policy(job, settings.misfire_policy, now)
+				elif old_job.signature == job.signature and len(old_job.catchup_runs) != 0:
+					job.catchup_runs = old_job.catchup_runs
+					job.next_run = old_job.next_run
+				job.seq = next(cls.seq)
+				cls.jobs[s.id] = job
+				cls.heap.append((job.next_run, job.seq, s.id))
+				if s.next_fire != job.next_run:
+					s.next_fire = job.next_run
+					changed.append(s)
+			heapq.heapify(cls.heap)
+			cls.last_sync = now
+			cls.condition.notify()
+		cls.save_fire_times(changed)
+		logger.info(f"load_all_schedules: {len(cls.jobs)} jobs loaded to scheduler")
 	
 	
 	@classmethod
 	def clear_all_schedules(cls):
-		schedule.clear()
+		with cls.condition:
+			cls.jobs = {}
+			cls.heap = []
+			cls.last_sync = None
+			cls.next_catchup_slot = None
+			cls.condition.notify()
 		logger.info(f"clear_all_schedules: all jobs cleared")
 	
 	
 	@classmethod
 	def reload_all_schedules(cls):
-		logger.debug(f"reload_all_schedules: starting ReplicationScheduler")
-		cls.clear_all_schedules()
+		logger.debug(f"reload_all_schedules: reloading all schedules")
 		cls.load_all_schedules()
-	
-	
-	
@@ -15,15 +15,63 @@ def run_command(cmdstring):
 	return result
 
 
-def run_command_with_returncode(cmdstring, shell = False):
-	"""run command using subprocess, return tuple (cmd_output, returncode)"""
+OUTPUT_CHUNK_SIZE = 64 * 1024
+
+
+def run_command_with_returncode(cmdstring, shell = False, on_output = None, on_start = None):
+	"""run command using subprocess, return tuple (cmd_output, returncode)
+	
+	if on_output is specified, output is not collected: on_output(chunk) is called for every chunk of bytes
+	as soon as it is read, and cmd_output is empty string.
+	if on_start is specified, command is started in new session (its own process group), on_start(pid) is called
+	after start - pid is also id of process group, which may be signalled as whole"""
 	import subprocess
 	import shlex
 	
 	if len(cmdstring) == 0:
-		return -1
+		return "", -1
 	args = shlex.split(cmdstring)
-	run_proc = subprocess.Popen(args, stdout = subprocess.PIPE, stderr = subprocess.STDOUT, shell = shell)
-	result = subprocess.Popen.communicate(run_proc)[0].decode("utf-8")
-	return result, run_proc.returncode
+	run_proc = subprocess.Popen(args, stdout = subprocess.PIPE, stderr = subprocess.STDOUT, shell = shell, start_new_session = on_start is not None)
+	if on_start is not None:
+		on_start(run_proc.pid)
+	if on_output is None:
+		result = subprocess.Popen.communicate(run_proc)[0].decode("utf-8")
+		return result, run_proc.returncode
+	while True:
+		chunk = run_proc.stdout.read1(OUTPUT_CHUNK_SIZE)
+		if not chunk:
+			break
+		on_output(chunk)
+	run_proc.stdout.close()
+	return "", run_proc.wait()
+
+
+async def async_run_command_with_returncode(cmdstring, shell = False, on_output = None, on_start = None):
+	"""run command using asyncio subprocess, output is read without blocking event loop, return tuple (cmd_output, returncode)
+	
+	on_output and on_start work as in run_command_with_returncode"""
+	import asyncio
+	import shlex
+	
+	if len(cmdstring) == 0:
+		return "", -1
+	new_session = on_start is not None
+	if shell:
+		run_proc = await asyncio.create_subprocess_shell(cmdstring, stdout = asyncio.subprocess.PIPE, stderr = asyncio.subprocess.STDOUT, start_new_session = new_session)
+	else:
+		args = shlex.split(cmdstring)
+		run_proc = await asyncio.create_subprocess_exec(*args, stdout = asyncio.subprocess.PIPE, stderr = asyncio.subprocess.STDOUT, start_new_session = new_session)
+	if on_start is not None:
+		on_start(run_proc.pid)
+	chunks = []
+	while True:
+		chunk = await run_proc.stdout.read(OUTPUT_CHUNK_SIZE)
+		if not chunk:
+			break
+		if on_output is None:
+			chunks.append(chunk)
+		else:
+			on_output(chunk)
+	returncode = await run_proc.wait()
+	return b"".join(chunks).decode("utf-8"), returncode
 	
\ No newline at end of file
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""cron expressions: "minute hour day-of-month month day-of-week", as in crontab(5)
+
+every field is *, number, range a-b, step */n or a-b/n, or comma-separated list of them.
+months and days of week may be names (jan, mon), day of week 0 and 7 is sunday.
+aliases @hourly, @daily (@midnight), @weekly, @monthly, @yearly (@annually) are supported.
+if both day of month and day of week are restricted (do not start with *), day matches if any of them matches.
+"""
+
+
+import datetime
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+ALIASES = {
+	"@hourly": "0 * * * *",
+	"@daily": "0 0 * * *",
+	"@midnight": "0 0 * * *",
+	"@weekly": "0 0 * * 0",
+	"@monthly": "0 0 1 * *",
+	"@yearly": "0 0 1 1 *",
+	"@annually": "0 0 1 1 *",
+}
+MONTH_NAMES = {name: i + 1 for i, name in enumerate(("jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec"))}
+DOW_NAMES = {name: i for i, name in enumerate(("sun", "mon", "tue", "wed", "thu", "fri", "sat"))}
+# (name, min, max, names)
+FIELDS = (("minute", 0, 59, {}), ("hour", 0, 23, {}), ("day of month", 1, 31, {}), ("month", 1, 12, MONTH_NAMES), ("day of week", 0, 7, DOW_NAMES))
+# next run is searched at most this far, expression like "0 0 30 2 *" never matches
+MAX_YEARS = 5
+
+
+def parse_value(text, names):
+	text = text.lower()
+	if text in names:
+		return names[text]
+	return int(text)
+
+
+def parse_field(text, low, high, names):
+	"""return sorted list of values matched by field"""
+	values = set()
+	for part in text.split(","):
+		step = 1
+		if "/" in part:
+			part, step_text = part.split("/", 1)
+			step = int(step_text)
+			if step < 1:
+				raise ValueError(f"invalid step {step_text}")
+		if part == "*":
+			start, end = low, high
+		elif "-" in part:
+			start_text, end_text = part.split("-", 1)
+			start, end = parse_value(start_text, names), parse_value(end_text, names)
+		else:
+			start = parse_value(part, names)
+			# "5/15" means from 5 to end with step 15
+			end = high if step != 1 else start
+		if start < low or end > high or start > end:
+			raise ValueError(f"value out of range {low}-{high}: {part}")
+		values.update(range(start, end + 1, step))
+	return sorted(values)
+
+
+
+class CronExpression(object):
+	"""parsed cron expression, raises ValueError if expression is invalid"""
+
+	def __init__(self, text):
+		self.text = text.strip()
+		expanded = ALIASES.get(self.text.lower(), self.text)
+		parts = expanded.split()
+		if len(parts) != 5:
+			raise ValueError(f"cron expression should have 5 fields (minute hour dom month dow), got {len(parts)}: {text}")
+		fields = []
+		for part, (name, low, high, names) in zip(parts, FIELDS):
+			try:
+				fields.append(parse_field(part, low, high, names))
+			except ValueError as e:
+				raise ValueError(f"invalid {name} field {part}: {e}")
+		self.minutes, self.hours, self.days, self.months, dows = fields
+		self.dows = sorted({d % 7 for d in dows})
+		# as in vixie cron, field starting with * (also */n) is not restriction
+		self.dom_restricted = not parts[2].startswith("*")
+		self.dow_restricted = not parts[4].startswith("*")
+
+
+	def __str__(self):
+		return self.text
+
+
+	def day_matches(self, date):
+		dom_ok = date.day in self.days
+		# cron counts days of week from sunday, python from monday
+		dow_ok = (date.weekday() + 1) % 7 in self.dows
+		if self.dom_restricted and self.dow_restricted:
+			return dom_ok or dow_ok
+		return dom_ok and dow_ok
+
+
+	def next_after(self, after):
+		"""return first naive datetime strictly after naive datetime after, which matches expression, or None"""
+		dt = after.replace(second = 0, microsecond = 0) + datetime.timedelta(minutes = 1)
+		limit = after.year + MAX_YEARS
+		while dt.year <= limit:
+			if dt.month not in self.months:
+				next_months = [m for m in self.months if m > dt.month]
+				if len(next_months) != 0:
+					dt = dt.replace(month = next_months[0], day = 1, hour = 0, minute = 0)
+				else:
+					dt = dt.replace(year = dt.year + 1, month = self.months[0], day = 1, hour = 0, minute = 0)
+				continue
+			if not self.day_matches(dt.date()):
+				dt = datetime.datetime.combine(dt.date() + datetime.timedelta(days = 1), datetime.time())
+				continue
+			if dt.hour not in self.hours:
+				next_hours = [h for h in self.hours if h > dt.hour]
+				if len(next_hours) != 0:
+					dt = dt.replace(hour = next_hours[0], minute = 0)
+				else:
+					dt = datetime.datetime.combine(dt.date() + datetime.timedelta(days = 1), datetime.time())
+				continue
+			next_minutes = [m for m in self.minutes if m >= dt.minute]
+			if len(next_minutes) != 0:
+				return dt.replace(minute = next_minutes[0])
+			dt = dt.replace(minute = 0) + datetime.timedelta(hours = 1)
+		return None
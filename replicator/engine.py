@@ -0,0 +1,414 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""execution engines for ReplicationTask steps
+
+task logic is written once as generator of steps (see ReplicationTask.steps()): every blocking operation is yielded
+as request (RunCommand, Sleep, Ping, Probe, OpenSshMaster, Call, Parallel), engine executes request and sends result back to generator.
+run_steps() executes requests in current thread (one thread per running task),
+run_steps_async() executes them in asyncio event loop of AsyncioEngine (one thread for all running tasks).
+"""
+
+
+import os
+import sys
+import time
+import signal
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .base_functions import run_command_with_returncode, async_run_command_with_returncode
+from .host_health import HostHealth
+from .ssh_pool import SshControlPool
+
+logger = logging.getLogger(__name__)
+
+
+
+class TaskCancelled(Exception):
+	"""thrown into steps generator when its ProcessControl is cancelled"""
+	pass
+
+
+
+class ProcessControl(object):
+	"""control of processes of one task: cancel (SIGTERM to process group, then SIGKILL after grace period),
+	suspend (SIGSTOP) and resume (SIGCONT). every command of task runs in its own process group.
+	while command with streamed output runs, last_activity is time of its last output, otherwise it is None"""
+	CANCEL_GRACE_PERIOD_S = 30.0
+
+
+	def __init__(self):
+		self.pids = set()
+		self.cancelled = False
+		self.reason = None
+		self.suspended = False
+		self.timed_out = False
+		self.last_activity = None
+		self.watched = 0
+		self.suspend_start = None
+		self.suspended_s = 0.0
+		self.cancel_event = threading.Event()
+		self.lock = threading.Lock()
+
+
+	def add_pid(self, pid):
+		with self.lock:
+			self.pids.add(pid)
+			cancelled = self.cancelled
+		if cancelled:
+			# cancelled while command was starting
+			self.signal(signal.SIGTERM, [pid])
+
+
+	def remove_pid(self, pid):
+		with self.lock:
+			self.pids.discard(pid)
+
+
+	def signal(self, signum, pids = None):
+		with self.lock:
+			pids = list(self.pids) if pids is None else pids
+		for pid in pids:
+			try:
+				os.killpg(pid, signum)
+				logger.debug(f"signal: sent signal {signum} to process group {pid}")
+			except ProcessLookupError:
+				pass
+			except Exception as e:
+				logger.error(f"signal: could not send signal {signum} to process group {pid}: {e}")
+
+
+	def check_cancelled(self):
+		if self.cancelled:
+			raise TaskCancelled(self.reason or "task cancelled")
+
+
+	def cancel(self, reason = None, grace_period = None):
+		"""terminate processes, kill them if they are still alive after grace period"""
+		grace_period = self.CANCEL_GRACE_PERIOD_S if grace_period is None else grace_period
+		self.reason = reason
+		self.cancelled = True
+		self.cancel_event.set()
+		self.signal(signal.SIGTERM)
+		# stopped process will handle SIGTERM only after SIGCONT
+		self.signal(signal.SIGCONT)
+		self.suspended = False
+		if len(self.pids) != 0:
+			timer = threading.Timer(grace_period, self.kill)
+			timer.daemon = True
+			timer.start()
+
+
+	def kill(self):
+		with self.lock:
+			pids = list(self.pids)
+		if len(pids) != 0:
+			logger.info(f"kill: processes {pids} still alive after grace period, sending SIGKILL")
+			self.signal(signal.SIGKILL, pids)
+
+
+	def watch(self):
+		"""command with streamed output started, its output is watched by last_activity"""
+		with self.lock:
+			self.watched += 1
+			self.last_activity = time.monotonic()
+
+
+	def unwatch(self):
+		with self.lock:
+			self.watched -= 1
+			if self.watched == 0:
+				self.last_activity = None
+
+
+	def suspend(self):
+		self.suspended = True
+		self.suspend_start = time.monotonic()
+		self.signal(signal.SIGSTOP)
+
+
+	def resume(self):
+		self.suspended = False
+		self.signal(signal.SIGCONT)
+		now = time.monotonic()
+		if self.suspend_start is not None:
+			self.suspended_s += now - self.suspend_start
+			self.suspend_start = None
+		# time of suspension is not a stall
+		if self.last_activity is not None:
+			self.last_activity = now
+
+
+
+class RunCommand(object):
+	"""request to run command, result is tuple (cmd_output_text, returncode)
+
+	if on_output is specified, it is called with every chunk of output and cmd_output_text is empty.
+	on_output must not use DB - in asyncio engine it is called in event loop thread.
+	if control (ProcessControl) is specified, command runs in its own process group, which may be cancelled or suspended.
+	"""
+	__slots__ = ("cmdstring", "shell", "on_output", "control")
+
+	def __init__(self, cmdstring, shell = False, on_output = None, control = None):
+		self.cmdstring = cmdstring
+		self.shell = shell
+		self.on_output = on_output
+		self.control = control
+
+
+	def __str__(self):
+		return f"RunCommand {self.cmdstring}"
+
+
+
+class Sleep(object):
+	"""request to sleep, result is None. sleep is interrupted by cancellation of control"""
+	__slots__ = ("seconds", "control")
+
+	def __init__(self, seconds, control = None):
+		self.seconds = seconds
+		self.control = control
+
+
+
+class Ping(object):
+	"""request to ping host via ICMP, result is result of ping3.ping()"""
+	__slots__ = ("host",)
+
+	def __init__(self, host):
+		self.host = host
+
+
+
+class Probe(object):
+	"""request to check that host accepts TCP connections on port, result is True or False. see HostHealth"""
+	__slots__ = ("host", "port")
+
+	def __init__(self, host, port):
+		self.host = host
+		self.port = port
+
+
+
+class OpenSshMaster(object):
+	"""request to get master connection to host from SshControlPool, result is SshMaster or None"""
+	__slots__ = ("user", "host", "port", "persist_s")
+
+	def __init__(self, user, host, port, persist_s):
+		self.user = user
+		self.host = host
+		self.port = port
+		self.persist_s = persist_s
+
+
+
+class Call(object):
+	"""request to call blocking function (IO, not DB) outside of engine loop, result is its return value"""
+	__slots__ = ("func", "args")
+
+	def __init__(self, func, *args):
+		self.func = func
+		self.args = args
+
+
+
+class Parallel(object):
+	"""request to execute several requests at once, result is list of their results.
+	if request failed, its exception is in list instead of result"""
+	__slots__ = ("requests",)
+
+	def __init__(self, requests):
+		self.requests = requests
+
+
+
+def watch_output(on_output, control):
+	"""wrap on_output so every chunk of output updates last_activity of control"""
+	if on_output is None:
+		return None
+	control.watch()
+	def f(chunk):
+		control.last_activity = time.monotonic()
+		on_output(chunk)
+	return f
+
+
+def execute_request(request):
+	control = getattr(request, "control", None)
+	if control is not None:
+		control.check_cancelled()
+	if isinstance(request, RunCommand):
+		if control is None:
+			return run_command_with_returncode(request.cmdstring, shell = request.shell, on_output = request.on_output)
+		pids = []
+		def on_start(pid):
+			pids.append(pid)
+			control.add_pid(pid)
+		on_output = watch_output(request.on_output, control)
+		try:
+			result = run_command_with_returncode(request.cmdstring, shell = request.shell, on_output = on_output, on_start = on_start)
+		finally:
+			if on_output is not None:
+				control.unwatch()
+			for pid in pids:
+				control.remove_pid(pid)
+		control.check_cancelled()
+		return result
+	if isinstance(request, Sleep):
+		if control is None:
+			time.sleep(request.seconds)
+		else:
+			control.cancel_event.wait(request.seconds)
+			control.check_cancelled()
+		return None
+	if isinstance(request, Ping):
+		import ping3
+		return ping3.ping(request.host)
+	if isinstance(request, Probe):
+		return HostHealth.check(request.host, request.port)
+	if isinstance(request, OpenSshMaster):
+		return SshControlPool.open_master(request.user, request.host, request.port, request.persist_s)
+	if isinstance(request, Call):
+		return request.func(*request.args)
+	if isinstance(request, Parallel):
+		if len(request.requests) == 0:
+			return []
+		with ThreadPoolExecutor(max_workers = len(request.requests), thread_name_prefix = "Parallel") as pool:
+			futures = [pool.submit(execute_request, r) for r in request.requests]
+		return [f.exception() if f.exception() is not None else f.result() for f in futures]
+	raise ValueError(f"execute_request: unsupported request {request}")
+
+
+async def execute_request_async(request):
+	control = getattr(request, "control", None)
+	if control is not None:
+		control.check_cancelled()
+	if isinstance(request, RunCommand):
+		if control is None:
+			return await async_run_command_with_returncode(request.cmdstring, shell = request.shell, on_output = request.on_output)
+		pids = []
+		def on_start(pid):
+			pids.append(pid)
+			control.add_pid(pid)
+		on_output = watch_output(request.on_output, control)
+		try:
+			result = await async_run_command_with_returncode(request.cmdstring, shell = request.shell, on_output = on_output, on_start = on_start)
+		finally:
+			if on_output is not None:
+				control.unwatch()
+			for pid in pids:
+				control.remove_pid(pid)
+		control.check_cancelled()
+		return result
+	if isinstance(request, Sleep):
+		if control is None:
+			await asyncio.sleep(request.seconds)
+			return None
+		# cancel_event is threading.Event, so sleep is done by short steps
+		deadline = time.monotonic() + request.seconds
+		while not control.cancelled and time.monotonic() < deadline:
+			await asyncio.sleep(min(0.5, deadline - time.monotonic()))
+		control.check_cancelled()
+		return None
+	if isinstance(request, Ping):
+		import ping3
+		# ping3 is blocking, it runs in default executor of loop which has bounded number of threads
+		return await asyncio.get_running_loop().run_in_executor(None, ping3.ping, request.host)
+	if isinstance(request, Probe):
+		return await asyncio.wrap_future(HostHealth.probe(request.host, request.port))
+	if isinstance(request, OpenSshMaster):
+		return await asyncio.get_running_loop().run_in_executor(None, SshControlPool.open_master,
+			request.user, request.host, request.port, request.persist_s)
+	if isinstance(request, Call):
+		return await asyncio.get_running_loop().run_in_executor(None, request.func, *request.args)
+	if isinstance(request, Parallel):
+		return await asyncio.gather(*(execute_request_async(r) for r in request.requests), return_exceptions = True)
+	raise ValueError(f"execute_request_async: unsupported request {request}")
+
+
+def advance_steps(steps, result = None, error = None):
+	"""send result (or throw error) to steps generator, return tuple (done, next request or return value)"""
+	try:
+		if error is not None:
+			return False, steps.throw(error)
+		return False, steps.send(result)
+	except StopIteration as e:
+		return True, e.value
+
+
+def run_steps(steps):
+	"""run steps generator in current thread, return its return value"""
+	result, error = None, None
+	while True:
+		done, value = advance_steps(steps, result, error)
+		if done:
+			return value
+		result, error = None, None
+		try:
+			result = execute_request(value)
+		except Exception as e:
+			error = e
+
+
+async def run_steps_async(steps):
+	"""run steps generator in event loop, return its return value
+
+	code of generator itself uses DB, so it is advanced in single shared thread via sync_to_async,
+	requests are awaited in event loop.
+	"""
+	from asgiref.sync import sync_to_async
+	advance = sync_to_async(advance_steps, thread_sensitive = True)
+	result, error = None, None
+	while True:
+		done, value = await advance(steps, result, error)
+		if done:
+			return value
+		result, error = None, None
+		try:
+			result = await execute_request_async(value)
+		except Exception as e:
+			error = e
+
+
+
+class AsyncioEngine(object):
+	"""one asyncio event loop in one thread, supervises commands of all tasks submitted to it"""
+	loop = None
+	thread = None
+	lock = threading.Lock()
+
+
+	@staticmethod
+	def setup_child_watcher(loop):
+		"""on python < 3.12 default ThreadedChildWatcher starts one thread per child process,
+		PidfdChildWatcher waits for children in event loop itself"""
+		if sys.version_info >= (3, 12) or not hasattr(os, "pidfd_open"):
+			return
+		import warnings
+		with warnings.catch_warnings():
+			warnings.simplefilter("ignore", DeprecationWarning)
+			watcher = asyncio.PidfdChildWatcher()
+			asyncio.set_child_watcher(watcher)
+			watcher.attach_loop(loop)
+		logger.debug(f"setup_child_watcher: using PidfdChildWatcher")
+
+
+	@classmethod
+	def get_loop(cls):
+		with cls.lock:
+			if cls.loop is None:
+				cls.loop = asyncio.new_event_loop()
+				cls.setup_child_watcher(cls.loop)
+				cls.thread = threading.Thread(target = cls.loop.run_forever, name = "AsyncioEngine", daemon = True)
+				cls.thread.start()
+				logger.info(f"get_loop: started event loop thread {cls.thread}")
+		return cls.loop
+
+
+	@classmethod
+	def submit(cls, coroutine):
+		"""schedule coroutine in engine loop from any thread, return concurrent.futures.Future"""
+		return asyncio.run_coroutine_threadsafe(coroutine, cls.get_loop())
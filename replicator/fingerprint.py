@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""fingerprint of local source tree: Merkle summary of metadata (type, size, mtime, inode) of every entry
+
+files are not read, every entry is only stat-ed. hash of directory is made of its own entries and hashes
+of its subdirectories, so change anywhere in tree changes hashes of all directories on path to root.
+
+hashing is not incremental: every walk stats every entry of tree, no subtree is skipped. mtime (and ctime)
+of directory changes only when entries are added, removed or renamed in it, not when file in it is modified
+in place, so unchanged mtime and inode of directory do not prove that its subtree is unchanged - skipping by
+them would miss modified files. cost of walk is one lstat per entry, far less than rsync run, which also
+stats every file. tree is walked with explicit stack, so its depth is not limited by recursion limit, and only
+hashers of directories on current path are kept in memory.
+
+optionally (cache_path) nodes of previous walk are kept in cache file to report directories whose own entries
+changed (added, removed or modified files). cache has one node per directory and is rewritten by every walk,
+so it is off by default, see REPLICATOR_FINGERPRINT_CHANGED_DIRS.
+"""
+
+
+import os
+import json
+import stat
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+CACHE_VERSION = 1
+
+
+def get_fingerprint_root(src):
+	"""return local path to fingerprint for rsync src, or None if src can not be fingerprinted (remote, glob, several paths)"""
+	if not src.startswith("/") or any(c in src for c in "*?[ "):
+		return None
+	root = src.rstrip("/") or "/"
+	if not os.path.lexists(root):
+		return None
+	return root
+
+
+def entry_record(name, st):
+	return f"{name}\0{stat.S_IFMT(st.st_mode)}\0{stat.S_IMODE(st.st_mode)}\0{st.st_size}\0{st.st_mtime_ns}\0{st.st_ino}\n"
+
+
+
+class TreeFingerprint(object):
+	"""walks whole tree and computes its fingerprint, nodes are cached in JSON file at cache_path (None - no cache)
+
+	cache maps relative path of directory to [entries digest, hash of directory]. it is used to find changed
+	directories, not to skip walking of unchanged ones (see module docstring). without cache nodes are not kept
+	and changed is always empty.
+	"""
+
+	def __init__(self, cache_path = None):
+		self.cache_path = cache_path
+		self.nodes = {}
+		self.new_nodes = {}
+		self.changed = []
+		self.load()
+
+
+	def load(self):
+		if self.cache_path is None or not os.path.exists(self.cache_path):
+			return
+		try:
+			with open(self.cache_path, "r") as f:
+				data = json.load(f)
+			if data.get("version") == CACHE_VERSION:
+				self.nodes = data["nodes"]
+		except (OSError, ValueError, KeyError) as e:
+			logger.error(f"load: could not load fingerprint cache {self.cache_path}, ignoring it: {e}")
+
+
+	def save(self):
+		"""write cache atomically, so interrupted write does not leave broken cache"""
+		if self.cache_path is None:
+			return
+		os.makedirs(os.path.dirname(self.cache_path), exist_ok = True)
+		tmp_path = self.cache_path + ".tmp"
+		with open(tmp_path, "w") as f:
+			json.dump({"version": CACHE_VERSION, "nodes": self.nodes}, f)
+		os.replace(tmp_path, self.cache_path)
+
+
+	def open_dir(self, path, rel, name):
+		"""stat own entries of directory, return frame of walk: [rel, name, entries digest, iterator of subdirectories, hasher]"""
+		records = []
+		subdirs = []
+		with os.scandir(path) as it:
+			entries = sorted(it, key = lambda e: e.name)
+		for entry in entries:
+			try:
+				st = entry.stat(follow_symlinks = False)
+			except OSError as e:
+				# entry vanished or is not accessible - its error is part of fingerprint
+				records.append(f"{entry.name}\0error\0{e.errno}\n")
+				continue
+			records.append(entry_record(entry.name, st))
+			if stat.S_ISDIR(st.st_mode):
+				subdirs.append(entry.name)
+		digest = hashlib.sha256("".join(records).encode("utf-8", "surrogateescape")).hexdigest()
+		return [rel, name, digest, iter(subdirs), hashlib.sha256(digest.encode())]
+
+
+	def add_node(self, rel, digest, node_hash):
+		if self.cache_path is None:
+			return
+		cached = self.nodes.get(rel)
+		if cached is None or cached[0] != digest:
+			# own entries of directory changed, its parents changed only by hash of this subtree
+			self.changed.append(rel or ".")
+		self.new_nodes[rel] = [digest, node_hash]
+
+
+	def hash_dir(self, root):
+		"""return hash of directory root. hash of directory is finished when all its subdirectories are hashed"""
+		stack = [self.open_dir(root, "", None)]
+		while True:
+			rel, name, digest, subdirs, h = stack[-1]
+			child_name = next(subdirs, None)
+			if child_name is not None:
+				child_rel = os.path.join(rel, child_name) if rel else child_name
+				try:
+					stack.append(self.open_dir(os.path.join(root, child_rel), child_rel, child_name))
+				except OSError as e:
+					h.update(f"{child_name}\0error {e.errno}\n".encode("utf-8", "surrogateescape"))
+				continue
+			stack.pop()
+			node_hash = h.hexdigest()
+			self.add_node(rel, digest, node_hash)
+			if len(stack) == 0:
+				return node_hash
+			stack[-1][4].update(f"{name}\0{node_hash}\n".encode("utf-8", "surrogateescape"))
+
+
+	def compute(self, root):
+		"""return fingerprint (hex string) of tree at root, list of changed directories is in self.changed"""
+		self.new_nodes = {}
+		self.changed = []
+		if os.path.isdir(root) and not os.path.islink(root):
+			st = os.lstat(root)
+			fingerprint = hashlib.sha256((entry_record(".", st) + self.hash_dir(root)).encode()).hexdigest()
+		else:
+			fingerprint = hashlib.sha256(entry_record(os.path.basename(root), os.lstat(root)).encode()).hexdigest()
+		if self.cache_path is not None:
+			removed = len(set(self.nodes) - set(self.new_nodes))
+			if len(self.nodes) != 0 and removed != 0:
+				logger.debug(f"compute: {removed} directories of {root} were removed")
+			self.nodes = self.new_nodes
+			logger.debug(f"compute: fingerprint of {root} is {fingerprint}, {len(self.changed)} of {len(self.nodes)} directories changed")
+		else:
+			logger.debug(f"compute: fingerprint of {root} is {fingerprint}")
+		return fingerprint
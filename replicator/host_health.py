@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""shared host reachability service: concurrent TCP probes with cached results and circuit breaker"""
+
+
+import re
+import time
+import socket
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from .path_index import split_location
+
+logger = logging.getLogger(__name__)
+
+
+SSH_PORT = 22
+RSYNC_DAEMON_PORT = 873
+SSH_PORT_RE = re.compile(r"ssh\b[^'\"]*?\s-p\s*(\d+)")
+RSYNC_URL_PORT_RE = re.compile(r"^rsync://(?:[^@/]+@)?[^:/]+:(\d+)")
+
+
+def get_probe_target(location, options = ""):
+	"""return tuple (host, port) to probe for remote rsync location: port of rsync daemon for host::module
+	and rsync://host[:port]/module, otherwise port of ssh (-p of ssh in -e option is respected)"""
+	host, components = split_location(location)
+	if host is None:
+		return None
+	if location.startswith("rsync://"):
+		m = RSYNC_URL_PORT_RE.match(location)
+		return host, int(m.group(1)) if m is not None else RSYNC_DAEMON_PORT
+	if len(components) != 0 and components[0].startswith("::"):
+		return host, RSYNC_DAEMON_PORT
+	m = SSH_PORT_RE.search(options or "")
+	return host, int(m.group(1)) if m is not None else SSH_PORT
+
+
+
+class HostStatus(object):
+	__slots__ = ("up", "checked_at", "failures", "open_until", "error")
+
+	def __init__(self):
+		self.up = None
+		self.checked_at = None
+		self.failures = 0
+		self.open_until = None
+		self.error = None
+
+
+	def is_valid(self, now, up_ttl):
+		"""True if status may be used without new probe: host is up and status is fresh, or circuit is open"""
+		if self.up:
+			return now - self.checked_at < up_ttl
+		return self.open_until is not None and now < self.open_until
+
+
+
+class HostHealth(object):
+	"""reachability of (host, port), shared by all tasks
+
+	probes run concurrently in small pool of threads, one probe per host at a time - tasks to same host share it.
+	result of successful probe is cached for UP_TTL_S. after failed probe circuit of host is open: host is reported
+	down without probing for OPEN_BASE_S, doubled with every consecutive failure up to OPEN_MAX_S.
+	then next caller probes host again.
+	"""
+	UP_TTL_S = 60.0
+	PROBE_TIMEOUT_S = 5.0
+	OPEN_BASE_S = 30.0
+	OPEN_MAX_S = 600.0
+	PROBE_WORKERS = 8
+	statuses = {}
+	in_flight = {}
+	executor = None
+	lock = threading.Lock()
+
+
+	@classmethod
+	def probe(cls, host, port):
+		"""return concurrent.futures.Future with True if host accepts connections on port, False otherwise"""
+		key = (host, port)
+		with cls.lock:
+			status = cls.statuses.get(key)
+			if status is not None and status.is_valid(time.monotonic(), cls.UP_TTL_S):
+				future = Future()
+				future.set_result(status.up)
+				return future
+			future = cls.in_flight.get(key)
+			if future is None:
+				if cls.executor is None:
+					cls.executor = ThreadPoolExecutor(max_workers = cls.PROBE_WORKERS, thread_name_prefix = "HostHealth")
+				future = cls.executor.submit(cls._probe, host, port)
+				cls.in_flight[key] = future
+			return future
+
+
+	@classmethod
+	def get_cached(cls, host, port):
+		"""return cached reachability of host (True or False), or None if host should be probed"""
+		with cls.lock:
+			status = cls.statuses.get((host, port))
+			if status is not None and status.is_valid(time.monotonic(), cls.UP_TTL_S):
+				return status.up
+		return None
+
+
+	@classmethod
+	def check(cls, host, port):
+		"""blocking version of probe"""
+		return cls.probe(host, port).result()
+
+
+	@classmethod
+	def _probe(cls, host, port):
+		error = None
+		try:
+			with socket.create_connection((host, port), timeout = cls.PROBE_TIMEOUT_S):
+				pass
+		except OSError as e:
+			error = e
+		cls.record(host, port, error)
+		return error is None
+
+
+	@classmethod
+	def record(cls, host, port, error = None):
+		"""save result of probe, open circuit of host if probe failed"""
+		now = time.monotonic()
+		with cls.lock:
+			status = cls.statuses.setdefault((host, port), HostStatus())
+			status.checked_at = now
+			if error is None:
+				if status.up is False:
+					logger.info(f"record: host {host}:{port} is up again")
+				status.up = True
+				status.failures = 0
+				status.open_until = None
+				status.error = None
+			else:
+				status.up = False
+				status.failures += 1
+				open_s = min(cls.OPEN_MAX_S, cls.OPEN_BASE_S * 2 ** (status.failures - 1))
+				status.open_until = now + open_s
+				status.error = str(error)
+				logger.info(f"record: host {host}:{port} is down ({error}), failures: {status.failures}, will not probe it for {open_s:.0f} s")
+			cls.in_flight.pop((host, port), None)
+
+
+	@classmethod
+	def get_down_seconds(cls, host, port):
+		"""return number of seconds host will be reported down without probing (its circuit is open), or None"""
+		with cls.lock:
+			status = cls.statuses.get((host, port))
+			if status is None or status.up is not False or status.open_until is None:
+				return None
+			down_s = status.open_until - time.monotonic()
+		return down_s if down_s > 0 else None
+
+
+	@classmethod
+	def reset(cls):
+		with cls.lock:
+			cls.statuses = {}
+			cls.in_flight = {}
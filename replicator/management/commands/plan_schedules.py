@@ -0,0 +1,76 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+import datetime
+import logging
+
+from replicator.models import ReplicationSchedule, ReplicationTask
+from replicator.stagger import plan_offsets, get_peak, get_typical_duration, DEFAULT_DURATION_S
+
+logger = logging.getLogger(__name__)
+
+
+
+class Command(BaseCommand):
+	help = "propose (or apply with --apply) offsets of schedules, so their next runs are spread over backup window with lowest peak of concurrent tasks"
+	
+	
+	def add_arguments(self, parser):
+		parser.add_argument("--window-hours", type = float, default = 6.0, help = "length of backup window, it starts at first scheduled run")
+		parser.add_argument("--horizon-hours", type = float, default = 24.0, help = "plan runs scheduled this far from now")
+		parser.add_argument("--step", type = int, default = 60, help = "step of offsets in seconds")
+		parser.add_argument("--history", type = int, default = 10, help = "number of recent successful tasks of replication for its typical duration")
+		parser.add_argument("--apply", action = "store_true", help = "save planned offsets to schedules (spread of planned schedules is reset to 0)")
+	
+	
+	def get_durations(self, replication_ids, history):
+		durations = {}
+		for replication_id in replication_ids:
+			runs = ReplicationTask.objects.filter(replication_id = replication_id, OK = True, start__isnull = False,
+				end__isnull = False).order_by("-end").values_list("start", "end")[:history]
+			durations[replication_id] = get_typical_duration([(end - start).total_seconds() for start, end in runs])
+		return durations
+	
+	
+	def handle(self, *args, **options):
+		if options["window_hours"] <= 0:
+			raise CommandError("--window-hours should be positive")
+		now = timezone.now()
+		horizon = now + datetime.timedelta(hours = options["horizon_hours"])
+		runs = []
+		for s in ReplicationSchedule.objects.select_related("replication").filter(enabled = True, replication__enabled = True):
+			base_run = s.get_next_run(now, with_delay = False)
+			if base_run is not None and base_run <= horizon:
+				runs.append((s, base_run))
+		if len(runs) == 0:
+			self.stdout.write("no runs scheduled within horizon")
+			return
+		window_start = min(base_run for s, base_run in runs)
+		durations = self.get_durations({s.replication_id for s, base_run in runs}, options["history"])
+		items = []
+		current = []
+		for s, base_run in runs:
+			start = (base_run - window_start).total_seconds()
+			duration = durations[s.replication_id] or DEFAULT_DURATION_S
+			items.append((s.id, start, duration))
+			current.append((start + s.get_delay_seconds(), start + s.get_delay_seconds() + duration))
+		offsets = plan_offsets(items, options["window_hours"] * 3600, step_s = options["step"])
+		planned = [(start + offsets[key], start + offsets[key] + duration) for key, start, duration in items]
+		self.stdout.write(f"window starts at {timezone.localtime(window_start)}, {len(runs)} runs")
+		for (s, base_run), (key, start, duration) in zip(runs, items):
+			history = "" if durations[s.replication_id] is not None else " (no history)"
+			self.stdout.write(f"{s.name}: {timezone.localtime(base_run)}, duration {duration:.0f} s{history}, delay {s.get_delay_seconds()} s -> offset {offsets[key]} s")
+		self.stdout.write(f"peak of concurrent tasks: current {get_peak(current)}, planned {get_peak(planned)}")
+		if not options["apply"]:
+			return
+		changed = []
+		for s, base_run in runs:
+			if s.offset_seconds != offsets[s.id] or s.spread_seconds != 0:
+				s.offset_seconds = offsets[s.id]
+				s.spread_seconds = 0
+				# bulk update does not set auto_now, worker picks changes up by date_modified
+				s.date_modified = now
+				changed.append(s)
+		ReplicationSchedule.objects.bulk_update(changed, ["offset_seconds", "spread_seconds", "date_modified"])
+		logger.info(f"handle: offsets of {len(changed)} schedules applied")
+		self.stdout.write(f"offsets of {len(changed)} schedules saved")
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+
+import logging
+
+from replicator.base import ReplicationTaskRunner, ReplicationScheduler, acquire_worker_lock
+
+logger = logging.getLogger(__name__)
+
+
+
+class Command(BaseCommand):
+	help = "run replication worker: scheduler and task runner. web processes only add tasks to DB queue and read status"
+	
+	
+	def handle(self, *args, **options):
+		if not acquire_worker_lock():
+			lock_file_path = getattr(settings, "REPLICATOR_WORKER_LOCK_FILE", "worker.lock")
+			raise CommandError(f"another worker is already running (lock file {lock_file_path} is locked)")
+		logger.info(f"handle: starting worker")
+		self.stdout.write(f"dfrsync worker started")
+		ReplicationTaskRunner.launch_startup()
+		ReplicationScheduler.launch_startup()
+		ReplicationTaskRunner.thread.join()
@@ -0,0 +1,28 @@
+# Generated by Django 4.2.30 on 2026-10-18 15:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('replicator', '0021_alter_replication_options_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='settings',
+            name='host_limits',
+            field=models.TextField(blank=True, default='', help_text='per-host limits, one per line: hostname = N'),
+        ),
+        migrations.AddField(
+            model_name='settings',
+            name='max_running_tasks',
+            field=models.IntegerField(default=4, help_text='max number of simultaneously running tasks'),
+        ),
+        migrations.AddField(
+            model_name='settings',
+            name='max_tasks_per_host',
+            field=models.IntegerField(default=2, help_text='max number of simultaneously running tasks per remote host, 0 - no limit'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 15:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('replicator', '0022_settings_host_limits_settings_max_running_tasks_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='replication',
+            name='priority',
+            field=models.IntegerField(choices=[(0, 'high'), (1, 'normal'), (2, 'low')], default=1),
+        ),
+    ]
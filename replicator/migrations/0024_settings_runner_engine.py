@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 15:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('replicator', '0023_replication_priority'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='settings',
+            name='runner_engine',
+            field=models.CharField(choices=[('threads', 'thread per running task'), ('asyncio', 'asyncio event loop for all running tasks')], default='threads', max_length=16),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.30 on 2026-10-18 15:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('replicator', '0024_settings_runner_engine'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='replicationtask',
+            name='log_file',
+            field=models.CharField(blank=True, default=None, max_length=1024, null=True),
+        ),
+        migrations.AddField(
+            model_name='settings',
+            name='compress_task_logs',
+            field=models.BooleanField(default=False, help_text='gzip per-task log files of rsync output'),
+        ),
+    ]
@@ -0,0 +1,73 @@
+# Generated by Django 4.2.30 on 2026-10-18 15:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('replicator', '0025_replicationtask_log_file_settings_compress_task_logs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='replicationtask',
+            name='bytes_received',
+            field=models.BigIntegerField(blank=True, default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='replicationtask',
+            name='bytes_sent',
+            field=models.BigIntegerField(blank=True, default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='replicationtask',
+            name='bytes_total',
+            field=models.BigIntegerField(blank=True, default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='replicationtask',
+            name='files_total',
+            field=models.BigIntegerField(blank=True, default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='replicationtask',
+            name='files_transferred',
+            field=models.BigIntegerField(blank=True, default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='replicationtask',
+            name='literal_data',
+            field=models.BigIntegerField(blank=True, default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='replicationtask',
+            name='matched_data',
+            field=models.BigIntegerField(blank=True, default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='replicationtask',
+            name='progress_percent',
+            field=models.IntegerField(blank=True, default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='replicationtask',
+            name='rate_bps',
+            field=models.FloatField(blank=True, default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='replicationtask',
+            name='speedup',
+            field=models.FloatField(blank=True, default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='settings',
+            name='collect_transfer_stats',
+            field=models.BooleanField(default=True, help_text='run rsync with --stats --info=progress2 and save transfer statistics (requires rsync 3.1+)'),
+        ),
+        migrations.AlterField(
+            model_name='replicationtask',
+            name='bytes_copied',
+            field=models.BigIntegerField(blank=True, default=0, null=True),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.30 on 2026-10-18 15:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('replicator', '0026_replicationtask_bytes_received_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='replicationtask',
+            name='cancel_requested',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='settings',
+            name='preemption_mode',
+            field=models.CharField(choices=[('off', 'off'), ('suspend', 'suspend (SIGSTOP) lower priority task until higher priority task is done'), ('cancel', 'cancel lower priority task and queue it again')], default='off', help_text='what to do with lower priority tasks on same host when higher priority task has no free slot', max_length=16),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.30 on 2026-10-18 15:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('replicator', '0027_replicationtask_cancel_requested_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='replication',
+            name='stall_timeout',
+            field=models.IntegerField(default=30, help_text='kill task if rsync has no output and no progress for N minutes, 0 - no stall detection'),
+        ),
+        migrations.AddField(
+            model_name='replication',
+            name='timeout',
+            field=models.IntegerField(default=0, help_text='kill task if it runs longer than N minutes, 0 - no timeout'),
+        ),
+    ]
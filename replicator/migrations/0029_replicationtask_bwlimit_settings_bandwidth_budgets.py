@@ -0,0 +1,23 @@
+# Generated by Django 4.2.30 on 2026-10-18 15:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('replicator', '0028_replication_stall_timeout_replication_timeout'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='replicationtask',
+            name='bwlimit',
+            field=models.IntegerField(blank=True, default=None, help_text='--bwlimit of rsync allocated by bandwidth budget, KiB/s', null=True),
+        ),
+        migrations.AddField(
+            model_name='settings',
+            name='bandwidth_budgets',
+            field=models.TextField(blank=True, default='', help_text='bandwidth budgets, one per line: * or hostname, optional time window HH:MM-HH:MM, = rate in bit/s (k, M, G), 0 - no limit. example: * 09:00-18:00 = 50M'),
+        ),
+    ]
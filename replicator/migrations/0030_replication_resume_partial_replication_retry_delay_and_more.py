@@ -0,0 +1,44 @@
+# Generated by Django 4.2.30 on 2026-10-18 15:33
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('replicator', '0029_replicationtask_bwlimit_settings_bandwidth_budgets'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='replication',
+            name='resume_partial',
+            field=models.BooleanField(default=True, help_text='keep partially transferred files in partial-dir, so retry resumes them'),
+        ),
+        migrations.AddField(
+            model_name='replication',
+            name='retry_delay',
+            field=models.IntegerField(default=60, help_text='base delay before retry in seconds, doubled with every attempt'),
+        ),
+        migrations.AddField(
+            model_name='replication',
+            name='rsync_retries',
+            field=models.IntegerField(default=3, help_text='retries of task failed by transient error (network, timeout), 0 - no retries'),
+        ),
+        migrations.AddField(
+            model_name='replicationtask',
+            name='attempt',
+            field=models.IntegerField(default=1),
+        ),
+        migrations.AddField(
+            model_name='replicationtask',
+            name='not_before',
+            field=models.DateTimeField(blank=True, default=None, null=True, verbose_name='not_before'),
+        ),
+        migrations.AddField(
+            model_name='replicationtask',
+            name='retry_of',
+            field=models.ForeignKey(blank=True, default=None, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='retries', to='replicator.replicationtask'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 15:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('replicator', '0030_replication_resume_partial_replication_retry_delay_and_more'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='replication',
+            name='check_ping',
+            field=models.BooleanField(default=True, help_text='check that remote host accepts connections (port of ssh or rsync daemon) before replication'),
+        ),
+    ]
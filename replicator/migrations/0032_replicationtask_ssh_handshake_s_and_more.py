@@ -0,0 +1,33 @@
+# Generated by Django 4.2.30 on 2026-10-18 15:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('replicator', '0031_alter_replication_check_ping'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='replicationtask',
+            name='ssh_handshake_s',
+            field=models.FloatField(blank=True, default=None, help_text='ssh handshake time spent to open master, or saved by reuse', null=True),
+        ),
+        migrations.AddField(
+            model_name='replicationtask',
+            name='ssh_reused',
+            field=models.BooleanField(blank=True, default=None, help_text='ssh master connection was reused', null=True),
+        ),
+        migrations.AddField(
+            model_name='settings',
+            name='ssh_control_persist',
+            field=models.IntegerField(default=600, help_text='keep idle ssh master connection for N seconds'),
+        ),
+        migrations.AddField(
+            model_name='settings',
+            name='ssh_multiplexing',
+            field=models.BooleanField(default=True, help_text='share one ssh master connection (ControlMaster) per remote host between rsync runs'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.30 on 2026-10-18 15:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('replicator', '0032_replicationtask_ssh_handshake_s_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='replication',
+            name='shard_mode',
+            field=models.CharField(choices=[('dirs', 'by top-level subdirectories'), ('size', 'by size of top-level subdirectories')], default='dirs', max_length=16),
+        ),
+        migrations.AddField(
+            model_name='replication',
+            name='shards',
+            field=models.IntegerField(default=1, help_text='number of parallel rsync runs, src is split by its top-level entries. 1 - no sharding, works only for local src'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.2.30 on 2026-10-18 15:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('replicator', '0033_replication_shard_mode_replication_shards'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='replication',
+            name='last_src_fingerprint',
+            field=models.CharField(blank=True, default=None, editable=False, max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='replication',
+            name='skip_unchanged',
+            field=models.BooleanField(default=False, help_text='do not run rsync if local src did not change since last successful run. dest must not be changed by anything else'),
+        ),
+        migrations.AddField(
+            model_name='replicationtask',
+            name='unchanged',
+            field=models.BooleanField(default=False, help_text='src did not change since last successful run, rsync was skipped'),
+        ),
+    ]
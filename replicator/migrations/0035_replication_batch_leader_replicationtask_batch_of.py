@@ -0,0 +1,24 @@
+# Generated by Django 4.2.30 on 2026-10-18 15:46
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('replicator', '0034_replication_last_src_fingerprint_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='replication',
+            name='batch_leader',
+            field=models.ForeignKey(blank=True, default=None, help_text='replication with same src and options: its task scans src once and its changes are replayed to dest of this replication (rsync batch mode)', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='batch_followers', to='replicator.replication'),
+        ),
+        migrations.AddField(
+            model_name='replicationtask',
+            name='batch_of',
+            field=models.ForeignKey(blank=True, default=None, help_text='task of batch leader replication, whose batch is replayed by this task', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='batch_tasks', to='replicator.replicationtask'),
+        ),
+    ]
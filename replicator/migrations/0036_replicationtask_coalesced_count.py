@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 15:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('replicator', '0035_replication_batch_leader_replicationtask_batch_of'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='replicationtask',
+            name='coalesced_count',
+            field=models.IntegerField(default=0, help_text='triggers of replication absorbed by this task while it was pending'),
+        ),
+    ]
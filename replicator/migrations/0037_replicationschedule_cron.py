@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 15:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('replicator', '0036_replicationtask_coalesced_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='replicationschedule',
+            name='cron',
+            field=models.CharField(blank=True, default=None, help_text='cron expression: minute hour day-of-month month day-of-week, e.g. 30 2 * * 1-5. other fields are ignored', max_length=128, null=True),
+        ),
+    ]
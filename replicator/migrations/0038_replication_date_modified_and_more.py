@@ -0,0 +1,23 @@
+# Generated by Django 4.2.30 on 2026-10-18 15:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('replicator', '0037_replicationschedule_cron'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='replication',
+            name='date_modified',
+            field=models.DateTimeField(auto_now=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='replicationschedule',
+            name='date_modified',
+            field=models.DateTimeField(auto_now=True, db_index=True, null=True),
+        ),
+    ]
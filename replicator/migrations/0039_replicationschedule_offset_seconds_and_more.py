@@ -0,0 +1,23 @@
+# Generated by Django 4.2.30 on 2026-10-18 15:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('replicator', '0038_replication_date_modified_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='replicationschedule',
+            name='offset_seconds',
+            field=models.IntegerField(default=0, help_text='run N seconds later than scheduled, see manage.py plan_schedules'),
+        ),
+        migrations.AddField(
+            model_name='replicationschedule',
+            name='spread_seconds',
+            field=models.IntegerField(default=0, help_text='run up to N seconds later than scheduled, delay is stable for schedule, so schedules with same time are spread over this window'),
+        ),
+    ]
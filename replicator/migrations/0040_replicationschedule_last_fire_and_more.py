@@ -0,0 +1,33 @@
+# Generated by Django 4.2.30 on 2026-10-18 15:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('replicator', '0039_replicationschedule_offset_seconds_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='replicationschedule',
+            name='last_fire',
+            field=models.DateTimeField(blank=True, default=None, editable=False, help_text='scheduled time of last run fired by scheduler', null=True),
+        ),
+        migrations.AddField(
+            model_name='replicationschedule',
+            name='next_fire',
+            field=models.DateTimeField(blank=True, default=None, editable=False, help_text='time of next run planned by scheduler', null=True),
+        ),
+        migrations.AddField(
+            model_name='settings',
+            name='misfire_catchup_interval',
+            field=models.IntegerField(default=60, help_text='start catch-up runs of missed schedules at least N seconds apart, so restart does not start all of them at once'),
+        ),
+        migrations.AddField(
+            model_name='settings',
+            name='misfire_policy',
+            field=models.CharField(choices=[('skip', 'skip missed runs'), ('once', 'run once for all missed runs of schedule'), ('all', 'run every missed run')], default='once', help_text='what to do on start of scheduler with runs missed while it was not running', max_length=16),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 4.2.30 on 2026-10-18 16:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('replicator', '0040_replicationschedule_last_fire_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='replication',
+            name='est_bytes',
+            field=models.FloatField(blank=True, default=None, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='replication',
+            name='est_duration_dev_s',
+            field=models.FloatField(blank=True, default=None, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='replication',
+            name='est_duration_s',
+            field=models.FloatField(blank=True, default=None, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='replication',
+            name='est_samples',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AlterField(
+            model_name='replication',
+            name='timeout',
+            field=models.IntegerField(default=0, help_text='kill task if it runs longer than N minutes, 0 - automatic (several times predicted duration, once enough tasks finished), -1 - no timeout'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 16:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('replicator', '0041_replication_est_bytes_replication_est_duration_dev_s_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='settings',
+            name='version',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 18:12
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('replicator', '0042_settings_version'),
+    ]
+
+    operations = [
+        migrations.RenameField(
+            model_name='replicationtask',
+            old_name='rate_bps',
+            new_name='bytes_per_s',
+        ),
+    ]
@@ -1,45 +1,130 @@
 from django.db import models
 from django.urls import reverse
 from django.utils import timezone
-from django import forms
+from django.core.exceptions import ValidationError
 
-# import datetime
+import os
+import time
+import shlex
+import calendar
+import datetime
+import zlib
+import hashlib
+import random
 import logging
 import traceback
-import threading
 
 
 logger = logging.getLogger(__name__)
 
-from .base_functions import run_command, run_command_with_returncode
+from .engine import RunCommand, Sleep, Ping, Probe, OpenSshMaster, Call, Parallel, TaskCancelled, run_steps
+from .task_log import TaskOutputLog
+from .rsync_stats import RsyncOutputParser, CombinedOutputParser, STATS_OPTIONS
+from . import sharding
+from .fingerprint import TreeFingerprint, get_fingerprint_root
+from .rsync_errors import classify_failure
+from .host_health import get_probe_target
+from .ssh_pool import get_ssh_target
+from .cron import CronExpression
+from .predictor import Estimate
 
 
 
 class Settings(models.Model):
+	"""settings of app, single row with pk 1. read it by get_settings, which returns cached object"""
+	ENGINE_THREADS = "threads"
+	ENGINE_ASYNCIO = "asyncio"
+	ENGINE_CHOICES = ((ENGINE_THREADS, "thread per running task"), (ENGINE_ASYNCIO, "asyncio event loop for all running tasks"))
+	PREEMPTION_OFF = "off"
+	PREEMPTION_SUSPEND = "suspend"
+	PREEMPTION_CANCEL = "cancel"
+	PREEMPTION_CHOICES = ((PREEMPTION_OFF, "off"), (PREEMPTION_SUSPEND, "suspend (SIGSTOP) lower priority task until higher priority task is done"),
+		(PREEMPTION_CANCEL, "cancel lower priority task and queue it again"))
+	MISFIRE_SKIP = "skip"
+	MISFIRE_ONCE = "once"
+	MISFIRE_ALL = "all"
+	MISFIRE_CHOICES = ((MISFIRE_SKIP, "skip missed runs"), (MISFIRE_ONCE, "run once for all missed runs of schedule"), (MISFIRE_ALL, "run every missed run"))
 	global_dry_run = models.BooleanField(default = False)
 	rsync_executable = models.CharField(max_length = 512, default = "rsync")
-	
-	
-	@staticmethod
-	def get_settings():
-		q = Settings.objects.filter(pk = 1)
-		logger.debug(f"get_settings: object with pk == 1: {q}")
-		if not q.exists():
-			new_settings = Settings.objects.create()
-			new_settings.save()
-			logger.debug(f"get_settings: created new settings object {new_settings.pk}")
-			logger.debug(f"get_settings: all objects {Settings.objects.all()}")
-		return Settings.objects.get(pk = 1)
-
-	
-	@staticmethod
-	def reset_settings():
+	runner_engine = models.CharField(max_length = 16, default = ENGINE_THREADS, choices = ENGINE_CHOICES)
+	compress_task_logs = models.BooleanField(default = False, help_text = "gzip per-task log files of rsync output")
+	collect_transfer_stats = models.BooleanField(default = True, help_text = "run rsync with --stats --info=progress2 and save transfer statistics (requires rsync 3.1+)")
+	max_running_tasks = models.IntegerField(default = 4, help_text = "max number of simultaneously running tasks")
+	max_tasks_per_host = models.IntegerField(default = 2, help_text = "max number of simultaneously running tasks per remote host, 0 - no limit")
+	host_limits = models.TextField(default = "", blank = True, help_text = "per-host limits, one per line: hostname = N")
+	bandwidth_budgets = models.TextField(default = "", blank = True, help_text = "bandwidth budgets, one per line: * or hostname, optional time window HH:MM-HH:MM, = rate in bit/s (k, M, G), 0 - no limit. example: * 09:00-18:00 = 50M")
+	ssh_multiplexing = models.BooleanField(default = True, help_text = "share one ssh master connection (ControlMaster) per remote host between rsync runs")
+	ssh_control_persist = models.IntegerField(default = 600, help_text = "keep idle ssh master connection for N seconds")
+	preemption_mode = models.CharField(max_length = 16, default = PREEMPTION_OFF, choices = PREEMPTION_CHOICES, help_text = "what to do with lower priority tasks on same host when higher priority task has no free slot")
+	misfire_policy = models.CharField(max_length = 16, default = MISFIRE_ONCE, choices = MISFIRE_CHOICES, help_text = "what to do on start of scheduler with runs missed while it was not running")
+	misfire_catchup_interval = models.IntegerField(default = 60, help_text = "start catch-up runs of missed schedules at least N seconds apart, so restart does not start all of them at once")
+	version = models.IntegerField(default = 0, editable = False)
+	# cached object is checked against version in DB at most this often
+	CACHE_CHECK_S = 5.0
+	cached = None
+	cache_checked_at = 0.0
+	
+	
+	def save(self, *args, **kwargs):
+		# version tells other processes that their cached settings are outdated
+		self.version = (self.version or 0) + 1
+		if kwargs.get("update_fields") is not None:
+			kwargs["update_fields"] = list(kwargs["update_fields"]) + ["version"]
+		super().save(*args, **kwargs)
+	
+	
+	def get_host_limit(self, host):
+		"""return max number of running tasks for remote host, 0 means no limit"""
+		for line in self.host_limits.splitlines():
+			if "=" not in line:
+				continue
+			name, _, limit = line.partition("=")
+			if name.strip() == host:
+				try:
+					return int(limit.strip())
+				except ValueError:
+					logger.error(f"get_host_limit: invalid limit in line {line}, ignoring")
+		return self.max_tasks_per_host
+	
+	
+	@classmethod
+	def get_settings(cls):
+		"""return cached settings object, it is read from DB (and created) only if it changed.
+		cache is cleared by signals when settings are saved in this process (see signals.py), changes saved by other process
+		are noticed by version, which is read at most every CACHE_CHECK_S"""
+		cached = cls.cached
+		now = time.monotonic()
+		if cached is not None:
+			if now - cls.cache_checked_at < cls.CACHE_CHECK_S:
+				return cached
+			cls.cache_checked_at = now
+			if Settings.objects.filter(pk = 1, version = cached.version).exists():
+				return cached
+		settings, created = Settings.objects.get_or_create(pk = 1)
+		if created:
+			logger.debug(f"get_settings: created new settings object {settings.pk}")
+		logger.debug(f"get_settings: loaded settings, version {settings.version}")
+		cls.cached = settings
+		cls.cache_checked_at = now
+		return settings
+	
+	
+	@classmethod
+	def clear_cache(cls):
+		cls.cached = None
+	
+	
+	@classmethod
+	def reset_settings(cls):
 		all_settings = Settings.objects.all()
 		logger.debug(f"reset_settings: all objects: {all_settings}")
+		# new object continues version of deleted one, so other processes notice it
+		last_version = max([obj.version for obj in all_settings], default = 0)
 		for obj in all_settings:
 			obj.delete()
 		logger.debug(f"reset_settings: all existing settings deleted")
-		new_settings = get_settings()
+		Settings(pk = 1, version = last_version).save()
+		cls.clear_cache()
 		logger.info(f"reset_settings: new settings created from defaults")
 		
 
@@ -48,23 +133,52 @@ class Replication(models.Model):
 	""""""
 	# class Meta:
 	# 	ordering = ("-pk",)
+	PRIORITY_HIGH = 0
+	PRIORITY_NORMAL = 1
+	PRIORITY_LOW = 2
+	PRIORITY_CHOICES = ((PRIORITY_HIGH, "high"), (PRIORITY_NORMAL, "normal"), (PRIORITY_LOW, "low"))
 	name = models.CharField(max_length = 128, unique = True)
 	src = models.CharField(max_length = 512, default = None)
 	dest = models.CharField(max_length = 512, default = None)
 	options = models.CharField(max_length = 512, default = "-axv --delete")
 	dry_run = models.BooleanField(default = False)
 	enabled = models.BooleanField(default = True)
+	date_modified = models.DateTimeField(auto_now = True, null = True, db_index = True)
 	src_file_to_check = models.CharField(max_length = 512, default = None, blank = True, null = True)
 	dst_file_to_check = models.CharField(max_length = 512, default = None, blank = True, null = True)
 	retries = models.IntegerField(default = 3)
 	pre_cmd = models.CharField(max_length = 512, default = None, blank = True, null = True)
 	post_cmd = models.CharField(max_length = 512, default = None, blank = True, null = True)
-	check_ping = models.BooleanField(default = True)
-	RSYNC_BIN = Settings.get_settings().rsync_executable
+	check_ping = models.BooleanField(default = True, help_text = "check that remote host accepts connections (port of ssh or rsync daemon) before replication")
+	priority = models.IntegerField(default = PRIORITY_NORMAL, choices = PRIORITY_CHOICES)
+	timeout = models.IntegerField(default = 0, help_text = "kill task if it runs longer than N minutes, 0 - automatic (several times predicted duration, once enough tasks finished), -1 - no timeout")
+	stall_timeout = models.IntegerField(default = 30, help_text = "kill task if rsync has no output and no progress for N minutes, 0 - no stall detection")
+	rsync_retries = models.IntegerField(default = 3, help_text = "retries of task failed by transient error (network, timeout), 0 - no retries")
+	retry_delay = models.IntegerField(default = 60, help_text = "base delay before retry in seconds, doubled with every attempt")
+	shards = models.IntegerField(default = 1, help_text = "number of parallel rsync runs, src is split by its top-level entries. 1 - no sharding, works only for local src")
+	shard_mode = models.CharField(max_length = 16, default = sharding.SHARD_DIRS, choices = sharding.SHARD_MODE_CHOICES)
+	resume_partial = models.BooleanField(default = True, help_text = "keep partially transferred files in partial-dir, so retry resumes them")
+	skip_unchanged = models.BooleanField(default = False, help_text = "do not run rsync if local src did not change since last successful run. dest must not be changed by anything else")
+	last_src_fingerprint = models.CharField(max_length = 64, default = None, blank = True, null = True, editable = False)
+	batch_leader = models.ForeignKey("self", on_delete = models.SET_NULL, default = None, blank = True, null = True, related_name = "batch_followers",
+		help_text = "replication with same src and options: its task scans src once and its changes are replayed to dest of this replication (rsync batch mode)")
+	# EWMA estimate of successful tasks, see predictor.py
+	est_duration_s = models.FloatField(default = None, blank = True, null = True, editable = False)
+	est_duration_dev_s = models.FloatField(default = None, blank = True, null = True, editable = False)
+	est_bytes = models.FloatField(default = None, blank = True, null = True, editable = False)
+	est_samples = models.IntegerField(default = 0, editable = False)
+	MAX_RETRY_DELAY_S = 3600
+	PARTIAL_DIR = ".rsync-partial"
 
 
 	def __str__(self):
 		return f"Replication {self.name}"
+	
+	
+	@property
+	def RSYNC_BIN(self):
+		# read on every use, so change of Settings.rsync_executable applies without restart
+		return Settings.get_settings().rsync_executable
 
 	
 	def get_absolute_url(self):
@@ -100,9 +214,81 @@ class Replication(models.Model):
 		return remote_host
 	
 	
+	@property
+	def remote_location(self):
+		"""src or dest, which is remote, None if replication is local"""
+		if self.src_is_local and self.dest_is_local:
+			return None
+		return self.dest if self.src_is_local else self.src
+	
+	
+	def get_probe_target(self):
+		"""return tuple (host, port) to check before replication, or None if replication is local"""
+		if self.remote_location is None:
+			return None
+		return get_probe_target(self.remote_location, self.options)
+	
+	
+	def get_ssh_target(self):
+		"""return tuple (user, host, port) if rsync connects to remote side over ssh, None otherwise"""
+		if self.remote_location is None:
+			return None
+		return get_ssh_target(self.remote_location, self.options)
+	
+	
 	@property
 	def resulting_cmd(self):
-		return f"{self.RSYNC_BIN} {self.options} {self.src} {self.dest}"
+		return self.get_cmd()
+	
+	
+	def get_retry_delay(self, attempt):
+		"""exponential backoff with jitter: random delay between half and full retry_delay * 2 ** (attempt - 1)"""
+		cap = min(self.MAX_RETRY_DELAY_S, self.retry_delay * 2 ** (attempt - 1))
+		return cap / 2 + random.uniform(0, cap / 2)
+	
+	
+	def get_estimate(self):
+		return Estimate(self.est_duration_s, self.est_duration_dev_s, self.est_bytes, self.est_samples)
+	
+	
+	def update_estimate(self, duration_s, bytes = None):
+		"""add finished task to estimate, saved by update, so date_modified is not changed and no signals are sent"""
+		estimate = self.get_estimate()
+		estimate.update(duration_s, bytes)
+		self.est_duration_s, self.est_duration_dev_s, self.est_bytes, self.est_samples = estimate.duration_s, estimate.duration_dev_s, estimate.bytes, estimate.samples
+		Replication.objects.filter(pk = self.pk).update(est_duration_s = self.est_duration_s, est_duration_dev_s = self.est_duration_dev_s,
+			est_bytes = self.est_bytes, est_samples = self.est_samples)
+		logger.debug(f"update_estimate: estimate of {self} is {estimate}")
+		return estimate
+	
+	
+	def get_timeout_s(self):
+		"""timeout of task in seconds, 0 - no timeout. timeout 0 is automatic, from estimate"""
+		if self.timeout > 0:
+			return self.timeout * 60
+		if self.timeout < 0:
+			return 0
+		return self.get_estimate().get_timeout_s() or 0
+	
+	
+	def get_batch_followers(self):
+		"""enabled replications which get changes of task of this replication by rsync --read-batch"""
+		return [r for r in self.batch_followers.filter(enabled = True) if r.src == self.src and r.options == self.options and r.pk != self.pk]
+	
+	
+	def get_read_batch_cmd(self, batch_file, extra_options = []):
+		"""rsync command replaying batch to dest, src and file list are taken from batch"""
+		return f"{self.RSYNC_BIN} {self.options} {shlex.join(extra_options + [f'--read-batch={batch_file}'])} {self.dest}"
+	
+	
+	def get_cmd(self, extra_options = [], src = None, dest = None):
+		"""rsync command, extra_options (list of args) are added after options of replication.
+		src and dest of replication may be replaced (for shards)"""
+		src = self.src if src is None else src
+		dest = self.dest if dest is None else dest
+		if len(extra_options) == 0:
+			return f"{self.RSYNC_BIN} {self.options} {src} {dest}"
+		return f"{self.RSYNC_BIN} {self.options} {shlex.join(extra_options)} {src} {dest}"
 
 
 
@@ -116,6 +302,7 @@ class ReplicationSchedule(models.Model):
 	every 10th day of month at HH:MM:SS
 	every N days at HH:MM:SS
 	at YYYY-MM-DD HH:MM:SS (one time in future)
+	cron expression (see cron.py), other fields are ignored then
 	"""
 	class Meta:
 		ordering = ("pk",)
@@ -128,12 +315,21 @@ class ReplicationSchedule(models.Model):
 	month = models.IntegerField(default = None, blank = True, null = True)
 	year = models.IntegerField(default = None, blank = True, null = True)
 	dow = models.IntegerField(default = None, blank = True, null = True)
+	cron = models.CharField(max_length = 128, default = None, blank = True, null = True, help_text = "cron expression: minute hour day-of-month month day-of-week, e.g. 30 2 * * 1-5. other fields are ignored")
+	spread_seconds = models.IntegerField(default = 0, help_text = "run up to N seconds later than scheduled, delay is stable for schedule, so schedules with same time are spread over this window")
+	offset_seconds = models.IntegerField(default = 0, help_text = "run N seconds later than scheduled, see manage.py plan_schedules")
 	enabled = models.BooleanField(default = True)
+	date_modified = models.DateTimeField(auto_now = True, null = True, db_index = True)
+	# saved by scheduler with bulk_update, which does not change date_modified
+	last_fire = models.DateTimeField(default = None, blank = True, null = True, editable = False, help_text = "scheduled time of last run fired by scheduler")
+	next_fire = models.DateTimeField(default = None, blank = True, null = True, editable = False, help_text = "time of next run planned by scheduler")
+	# next run is searched at most this far
+	MAX_YEARS_AHEAD = 5
 	
 	
 	@property
 	def hour(self):
-		if not self.hourly:
+		if not self.hourly and self.time is not None:
 			return self.time.hour
 		else:
 			return None
@@ -141,12 +337,32 @@ class ReplicationSchedule(models.Model):
 	
 	@property
 	def minute(self):
-		return self.time.minute
+		return self.time.minute if self.time is not None else None
 	
 	
 	@property
 	def second(self):
-		return self.time.second
+		return self.time.second if self.time is not None else None
+	
+	
+	@property
+	def is_cron(self):
+		return self.cron is not None and len(self.cron.strip()) != 0
+	
+	
+	@property
+	def signature(self):
+		"""everything which decides when schedule runs, job of scheduler is rescheduled only if it changed"""
+		return (self.replication_id, self.enabled, self.replication.enabled, self.time, self.hourly, self.every_n_days,
+			self.dom, self.month, self.year, self.dow, self.cron, self.spread_seconds, self.offset_seconds)
+	
+	
+	def get_delay_seconds(self):
+		"""delay of every run after its scheduled time: offset plus stable part of spread window, derived from id of schedule"""
+		delay = self.offset_seconds or 0
+		if self.spread_seconds and self.spread_seconds > 0 and self.pk is not None:
+			delay += zlib.crc32(f"schedule {self.pk}".encode()) % self.spread_seconds
+		return delay
 	
 	
 	def get_absolute_url(self):
@@ -186,6 +402,7 @@ class ReplicationSchedule(models.Model):
 	def is_monthly(self):
 		if (self.dom is not None 
 			and self.dow is None 
+			and self.year is None 
 			and not self.is_hourly 
 			and not self.is_daily
 			and not self.is_every_n_days):
@@ -215,7 +432,9 @@ class ReplicationSchedule(models.Model):
 		calendar.setfirstweekday(calendar.MONDAY)
 		seconds = "00" if self.second is None else f"{self.second:02}"
 		try:
-			if self.is_hourly:
+			if self.is_cron:
+				return f"cron {self.cron.strip()}"
+			elif self.is_hourly:
 				return f"hourly, at {self.minute:02}:{seconds}"
 			elif self.is_daily:
 				return f"daily, at {self.hour:02}:{self.minute:02}:{seconds}"
@@ -241,54 +460,100 @@ class ReplicationSchedule(models.Model):
 		return related_tasks
 	
 	
-	def load_schedule_object(self):
-		import schedule
-		from .base import ReplicationTaskRunner
-		def date_str_res():
-			if self.second is None:
-				_date_str = f"{self.hour:02}:{self.minute:02}:00"
-			else:
-				_date_str = f"{self.hour:02}:{self.minute:02}:{self.second:02}"
-			return _date_str
-		
+	def get_next_local_run(self, after, last_run = None):
+		"""return first run after naive local datetime after as naive local datetime, or None if schedule will not run anymore.
+		last_run (naive local) keeps phase of every N days schedule"""
+		if self.is_cron:
+			return CronExpression(self.cron).next_after(after)
+		if self.time is None:
+			logger.error(f"get_next_local_run: schedule {self} has no time")
+			return None
+		if self.is_hourly:
+			candidate = after.replace(minute = self.minute, second = self.second, microsecond = 0)
+			return candidate if candidate > after else candidate + datetime.timedelta(hours = 1)
 		if self.is_daily:
-			self.job = schedule.every().day.at(date_str_res()).do(ReplicationTaskRunner.add_task_for_replication, self.replication, schedule = self)
-		elif self.is_hourly:
-			if self.second is None:
-				date_str = f"{self.minute:02}:00"
-			else:
-				date_str = f"{self.minute:02}:{self.second:02}"
-			self.job = schedule.every().hour.at(date_str).do(ReplicationTaskRunner.add_task_for_replication, self.replication, schedule = self)
-		elif self.is_weekly:
-			match self.dow:
-				case 0:
-					self.job = schedule.every().monday.at(date_str_res()).do(ReplicationTaskRunner.add_task_for_replication, self.replication, schedule = self)
-				case 1:
-					self.job = schedule.every().tuesday.at(date_str_res()).do(ReplicationTaskRunner.add_task_for_replication, self.replication, schedule = self)
-				case 2:
-					self.job = schedule.every().wednesday.at(date_str_res()).do(ReplicationTaskRunner.add_task_for_replication, self.replication, schedule = self)
-				case 3:
-					self.job = schedule.every().thursday.at(date_str_res()).do(ReplicationTaskRunner.add_task_for_replication, self.replication, schedule = self)
-				case 4:
-					self.job = schedule.every().friday.at(date_str_res()).do(ReplicationTaskRunner.add_task_for_replication, self.replication, schedule = self)
-				case 5:
-					self.job = schedule.every().saturday.at(date_str_res()).do(ReplicationTaskRunner.add_task_for_replication, self.replication, schedule = self)
-				case 6:
-					self.job = schedule.every().sunday.at(date_str_res()).do(ReplicationTaskRunner.add_task_for_replication, self.replication, schedule = self)
-		elif self.every_n_days:
-			self.job = schedule.every(self.every_n_days).days.at(date_str_res()).do(ReplicationTaskRunner.add_task_for_replication, self.replication, schedule = self)
-		elif self.is_monthly:
-			raise NotImplemented
-			# monthly is not supported by schedule
-			# self.job = schedule.every().month.at(date_str).do(ReplicationTaskRunner.add_task_for_replication, self.replication, schedule = self)
-			pass
-		elif self.is_one_time_in_future:
-			raise NotImplemented		
+			candidate = datetime.datetime.combine(after.date(), self.time)
+			return candidate if candidate > after else candidate + datetime.timedelta(days = 1)
+		if self.is_weekly:
+			candidate = datetime.datetime.combine(after.date() + datetime.timedelta(days = (self.dow - after.weekday()) % 7), self.time)
+			return candidate if candidate > after else candidate + datetime.timedelta(days = 7)
+		if self.is_every_n_days:
+			if last_run is None:
+				candidate = datetime.datetime.combine(after.date(), self.time)
+				return candidate if candidate > after else candidate + datetime.timedelta(days = 1)
+			candidate = datetime.datetime.combine(last_run.date() + datetime.timedelta(days = self.every_n_days), self.time)
+			if candidate <= after:
+				# skip periods missed since last run, phase is kept
+				period = datetime.timedelta(days = self.every_n_days)
+				candidate += ((after - candidate) // period + 1) * period
+			return candidate
+		if self.is_monthly:
+			# months without this day (31, 30, 29 of february) are skipped, as in cron
+			year, month = after.year, after.month
+			for i in range(12 * self.MAX_YEARS_AHEAD):
+				if self.dom <= calendar.monthrange(year, month)[1]:
+					candidate = datetime.datetime.combine(datetime.date(year, month, self.dom), self.time)
+					if candidate > after:
+						return candidate
+				year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+			return None
+		if self.is_one_time_in_future:
+			candidate = datetime.datetime.combine(datetime.date(self.year, self.month, self.dom or 1), self.time)
+			return candidate if candidate > after else None
+		logger.error(f"get_next_local_run: unsupported schedule type of {self}, please check")
+		return None
+	
+	
+	def get_next_run(self, after = None, last_run = None, with_delay = True):
+		"""return next run (aware datetime) strictly after after (default - now), or None.
+		run is delayed by get_delay_seconds(), unless with_delay is False"""
+		after = timezone.now() if after is None else after
+		delay = datetime.timedelta(seconds = self.get_delay_seconds() if with_delay else 0)
+		local_after = timezone.localtime(after - delay).replace(tzinfo = None)
+		local_last_run = timezone.localtime(last_run - delay).replace(tzinfo = None) if last_run is not None else None
+		try:
+			next_run = self.get_next_local_run(local_after, last_run = local_last_run)
+		except (ValueError, TypeError) as e:
+			logger.error(f"get_next_run: invalid schedule {self}: {e}")
+			return None
+		return timezone.make_aware(next_run) + delay if next_run is not None else None
+	
+	
+	def get_missed_runs(self, now = None, limit = 100):
+		"""runs which were due after last fire (or planned next fire, if schedule never fired) and before now, at most limit of oldest"""
+		now = timezone.now() if now is None else now
+		if self.last_fire is not None:
+			run = self.get_next_run(self.last_fire, last_run = self.last_fire)
+		elif self.next_fire is not None and self.get_next_run(self.next_fire - datetime.timedelta(seconds = 1)) == self.next_fire:
+			# planned next fire is still run of schedule, it was not changed since
+			run = self.next_fire
 		else:
-			logger.error(f"load_schedule_object: unsupported schedule type, please check")
-			return
-				
-		logger.debug(f"load_schedule_object: added job {self.job}")
+			run = None
+		runs = []
+		while run is not None and run <= now and len(runs) < limit:
+			runs.append(run)
+			run = self.get_next_run(run, last_run = run)
+		return runs
+	
+	
+	def get_next_runs(self, n = 5, after = None):
+		"""preview of next n runs"""
+		runs = []
+		next_run = self.get_next_run(after)
+		while next_run is not None and len(runs) < n:
+			runs.append(next_run)
+			next_run = self.get_next_run(next_run, last_run = next_run)
+		return runs
+	
+	
+	def clean(self):
+		if self.is_cron:
+			try:
+				CronExpression(self.cron)
+			except ValueError as e:
+				raise ValidationError({"cron": str(e)})
+		elif self.time is None:
+			raise ValidationError({"time": "time is required, if schedule is not cron expression"})
 	
 	
 	@property
@@ -307,31 +572,46 @@ class ReplicationTask(models.Model):
 	start = models.DateTimeField("start", blank = True, null = True)
 	end = models.DateTimeField("end", blank = True, null = True)
 	dry_run = models.BooleanField(default = False)
-	bytes_copied = models.IntegerField(default = 0, blank = True, null = True)
+	bytes_copied = models.BigIntegerField(default = 0, blank = True, null = True)
+	files_total = models.BigIntegerField(default = None, blank = True, null = True)
+	files_transferred = models.BigIntegerField(default = None, blank = True, null = True)
+	bytes_total = models.BigIntegerField(default = None, blank = True, null = True)
+	literal_data = models.BigIntegerField(default = None, blank = True, null = True)
+	matched_data = models.BigIntegerField(default = None, blank = True, null = True)
+	bytes_sent = models.BigIntegerField(default = None, blank = True, null = True)
+	bytes_received = models.BigIntegerField(default = None, blank = True, null = True)
+	speedup = models.FloatField(default = None, blank = True, null = True)
+	bytes_per_s = models.FloatField(default = None, blank = True, null = True)
+	progress_percent = models.IntegerField(default = None, blank = True, null = True)
 	error = models.BooleanField(default = False)
 	warning = models.BooleanField(default = False)
 	running = models.BooleanField(default = False)
 	OK = models.BooleanField(default = False)
 	complete = models.BooleanField(default = False)
 	cancelled = models.BooleanField(default = False)
+	cancel_requested = models.BooleanField(default = False)
+	unchanged = models.BooleanField(default = False, help_text = "src did not change since last successful run, rsync was skipped")
+	coalesced_count = models.IntegerField(default = 0, help_text = "triggers of replication absorbed by this task while it was pending")
 	error_text = models.TextField(blank = True, null = True)
 	cmd_output_text = models.TextField(blank = True, null = True)
+	log_file = models.CharField(max_length = 1024, default = None, blank = True, null = True)
+	attempt = models.IntegerField(default = 1)
+	retry_of = models.ForeignKey("self", on_delete = models.SET_NULL, default = None, blank = True, null = True, related_name = "retries")
+	batch_of = models.ForeignKey("self", on_delete = models.SET_NULL, default = None, blank = True, null = True, related_name = "batch_tasks",
+		help_text = "task of batch leader replication, whose batch is replayed by this task")
+	not_before = models.DateTimeField("not_before", default = None, blank = True, null = True)
+	ssh_reused = models.BooleanField(default = None, blank = True, null = True, help_text = "ssh master connection was reused")
+	ssh_handshake_s = models.FloatField(default = None, blank = True, null = True, help_text = "ssh handshake time spent to open master, or saved by reuse")
+	bwlimit = models.IntegerField(default = None, blank = True, null = True, help_text = "--bwlimit of rsync allocated by bandwidth budget, KiB/s")
 	returncode = models.IntegerField(default = None, blank = True, null = True)
 	comment = models.TextField(default = None, blank = True, null = True)
 	RETRY_DELAY_S = 5.0
+	output_parser = None
+	control = None
+	ssh_master = None
+	batch_file = None
 	
 	
-	def _set_thread(self, _thread):
-		self._thread = _thread
-	
-		
-	def _get_thread(self):
-		return self._thread
-	
-	
-	thread = property(_get_thread, _set_thread)
-		
-	
 	def __str__(self):
 		return f"ReplicationTask {self.id} for replica {self.replication}"
 	
@@ -343,15 +623,242 @@ class ReplicationTask(models.Model):
 		return self.end - self.start
 	
 	
+	@property
+	def mb_per_s(self):
+		"""average (or current, while running) rate in MB/s"""
+		if self.bytes_per_s is None:
+			return None
+		return round(self.bytes_per_s / 1000000, 2)
+	
+	
+	def get_rsync_extra_options(self, with_stats = True, shards = 1):
+		"""options added to rsync command by dfrsync itself. bandwidth limit is split between shards"""
+		extra_options = []
+		if with_stats and Settings.get_settings().collect_transfer_stats:
+			extra_options += [o for o in STATS_OPTIONS if o not in self.replication.options]
+		if self.replication.resume_partial and "--partial" not in self.replication.options:
+			extra_options.append(f"--partial-dir={Replication.PARTIAL_DIR}")
+		if self.ssh_master is not None:
+			extra_options += ["-e", self.ssh_master.get_ssh_command(self.replication.get_ssh_target()[2])]
+		# static --bwlimit in options of replication has precedence over budget
+		if self.bwlimit is not None and "--bwlimit" not in self.replication.options:
+			extra_options.append(f"--bwlimit={max(1, self.bwlimit // shards)}")
+		if self.batch_file is not None:
+			extra_options.append(f"--write-batch={self.batch_file}")
+		return extra_options
+	
+	
+	def on_rsync_output(self, chunk):
+		"""called with every chunk of rsync output, must not use DB"""
+		self.output_log.write(chunk)
+		self.output_parser.feed(chunk)
+	
+	
+	def get_shard_output_handler(self, parser, lock):
+		"""on_output for one shard: shards write to one log, every shard has its own parser"""
+		def on_output(chunk):
+			with lock:
+				self.output_log.write(chunk)
+			parser.feed(chunk)
+		return on_output
+	
+	
+	def plan_shards(self):
+		"""return tuple (src_dir, dest_dir, shards) or None if replication should run as single rsync"""
+		if self.replication.shards < 2 or not self.replication.src_is_local:
+			return None
+		src_dir, dest_dir = sharding.get_shard_locations(self.replication.src, self.replication.dest)
+		try:
+			shards = sharding.plan_shards(src_dir, self.replication.shards, mode = self.replication.shard_mode)
+		except OSError as e:
+			logger.error(f"plan_shards: could not split {src_dir} to shards, will run single rsync: {e}")
+			return None
+		if shards is None or len(shards) < 2:
+			return None
+		return src_dir, dest_dir, shards
+	
+	
+	def run_sharded_rsync_steps(self, src_dir, dest_dir, shards):
+		"""run rsync for every shard in parallel, then cleanup pass if replication deletes, return combined returncode"""
+		import threading
+		lists_dir = os.path.join(os.path.dirname(self.get_log_file_path()), f"task_{self.id}_shards")
+		os.makedirs(lists_dir, exist_ok = True)
+		requests = []
+		parsers = []
+		lock = threading.Lock()
+		extra_options = self.get_rsync_extra_options(shards = len(shards)) + sharding.SHARD_OPTIONS
+		for i, names in enumerate(shards):
+			list_path = os.path.join(lists_dir, f"shard_{i}")
+			sharding.write_files_from(list_path, names)
+			parser = RsyncOutputParser()
+			parsers.append(parser)
+			cmd = self.replication.get_cmd(extra_options + [f"--files-from={list_path}"], src = shlex.quote(src_dir), dest = shlex.quote(dest_dir))
+			requests.append(RunCommand(cmd, on_output = self.get_shard_output_handler(parser, lock), control = self.control))
+		self.output_parser = CombinedOutputParser(parsers)
+		logger.info(f"run_sharded_rsync: id {self.id} - running {len(shards)} shards of {src_dir}")
+		try:
+			results = yield Parallel(requests)
+		finally:
+			for i in range(len(shards)):
+				os.remove(os.path.join(lists_dir, f"shard_{i}"))
+			os.rmdir(lists_dir)
+		returncodes = []
+		for i, result in enumerate(results):
+			if isinstance(result, TaskCancelled):
+				raise result
+			if isinstance(result, BaseException):
+				self.add_error_text(f"shard {i}: ERROR - EXCEPTION: {result}")
+				returncodes.append(-1)
+			else:
+				returncodes.append(result[1])
+		returncode = sharding.combine_returncodes(returncodes)
+		if returncode in (0, 24) and "--delete" in self.replication.options:
+			# entries removed from src are not in any shard list
+			cleanup_options = self.get_rsync_extra_options(with_stats = False) + sharding.CLEANUP_OPTIONS
+			cmd = self.replication.get_cmd(cleanup_options, src = shlex.quote(src_dir), dest = shlex.quote(dest_dir))
+			_, cleanup_returncode = yield RunCommand(cmd, on_output = self.output_log.write, control = self.control)
+			if cleanup_returncode != 0:
+				self.add_error_text(f"cleanup pass: got returncode {cleanup_returncode}")
+				returncode = cleanup_returncode
+		return returncode
+	
+	
+	def apply_transfer_stats(self, parser):
+		"""save final statistics parsed from rsync output"""
+		for key in ("files_total", "files_transferred", "bytes_total", "literal_data", "matched_data", "bytes_sent", "bytes_received"):
+			if key in parser.stats:
+				setattr(self, key, parser.stats[key])
+		if "bytes_transferred" in parser.stats:
+			self.bytes_copied = parser.stats["bytes_transferred"]
+		self.speedup = parser.stats.get("speedup")
+		self.bytes_per_s = parser.stats.get("bytes_per_s", parser.bytes_per_s)
+		if self.returncode_is_ok:
+			self.progress_percent = 100
+	
+	
+	def get_retry_reason(self):
+		"""return reason to retry failed task, or None if task did not fail or its failure is permanent"""
+		if not self.error or self.cancelled or self.OK:
+			return None
+		if self.comment is not None and self.comment.startswith("Killed by watchdog"):
+			return self.comment
+		if self.returncode is None:
+			if self.error_text is not None and "could not reach" in self.error_text:
+				return "remote host unreachable"
+			return None
+		transient, reason = classify_failure(self.returncode, f"{self.cmd_output_text}\n{self.error_text}")
+		return reason if transient else None
+	
+	
+	def get_log_file_path(self):
+		from django.conf import settings
+		logs_dir = getattr(settings, "REPLICATOR_TASK_LOGS_DIR", "task_logs")
+		return os.path.join(logs_dir, f"task_{self.id}.log")
+	
+	
+	@staticmethod
+	def get_batch_file_path(task_id):
+		"""batch written by task of batch leader, rsync writes also script FILE.sh next to it"""
+		from django.conf import settings
+		batches_dir = getattr(settings, "REPLICATOR_BATCHES_DIR", "batches")
+		return os.path.join(batches_dir, f"task_{task_id}.batch")
+	
+	
+	@staticmethod
+	def remove_batch_files(task_id):
+		batch_file = ReplicationTask.get_batch_file_path(task_id)
+		for path in (batch_file, batch_file + ".sh"):
+			try:
+				os.remove(path)
+				logger.debug(f"remove_batch_files: removed {path}")
+			except FileNotFoundError:
+				pass
+			except OSError as e:
+				logger.error(f"remove_batch_files: could not remove {path}: {e}")
+	
+	
+	def prepare_batch_file(self):
+		"""if tasks of batch followers wait for this task, return path of batch file to write, otherwise None"""
+		if not self.batch_tasks.filter(start__isnull = True, cancelled = False).exists():
+			return None
+		batch_file = self.get_batch_file_path(self.id)
+		os.makedirs(os.path.dirname(batch_file), exist_ok = True)
+		return batch_file
+	
+	
+	def run_read_batch_steps(self, rsync_cmd):
+		"""replay batch of leader task to dest, fall back to full rsync if batch is not available or could not be replayed
+		(dest differed from dest of leader before leader run). return returncode"""
+		leader = self.batch_of
+		batch_file = self.get_batch_file_path(leader.id)
+		if leader.OK and leader.returncode == 0 and os.path.exists(batch_file):
+			cmd = self.replication.get_read_batch_cmd(batch_file, self.get_rsync_extra_options())
+			logger.debug(f"run_read_batch: id {self.id} - replaying batch of task {leader.id}: {cmd}")
+			_, returncode = yield RunCommand(cmd, on_output = self.on_rsync_output, control = self.control)
+			if returncode == 0:
+				self.comment = f"Replayed batch of task {leader.id}"
+				return returncode
+			self.comment = f"Replay of batch of task {leader.id} failed with returncode {returncode}, ran full rsync"
+			# statistics of full run replace statistics of failed replay
+			self.output_parser = RsyncOutputParser()
+		else:
+			self.comment = f"Batch of task {leader.id} is not available, ran full rsync"
+		logger.info(f"run_read_batch: id {self.id} - {self.comment}")
+		_, returncode = yield RunCommand(rsync_cmd, on_output = self.on_rsync_output, control = self.control)
+		return returncode
+	
+	
+	def get_fingerprint_cache_path(self):
+		"""return path to cache of nodes of fingerprint, or None if changed directories are not reported"""
+		from django.conf import settings
+		if not getattr(settings, "REPLICATOR_FINGERPRINT_CHANGED_DIRS", False):
+			return None
+		fingerprints_dir = getattr(settings, "REPLICATOR_FINGERPRINTS_DIR", "fingerprints")
+		return os.path.join(fingerprints_dir, f"replication_{self.replication.id}.json")
+	
+	
+	def compute_src_fingerprint(self):
+		"""return fingerprint of local src combined with dest and options, or None if src can not be fingerprinted.
+		must not use DB, it is called outside of engine loop"""
+		root = get_fingerprint_root(self.replication.src)
+		if root is None:
+			return None
+		tree = TreeFingerprint(self.get_fingerprint_cache_path())
+		try:
+			tree_hash = tree.compute(root)
+			tree.save()
+		except OSError as e:
+			logger.error(f"compute_src_fingerprint: could not fingerprint {root}: {e}")
+			return None
+		if len(tree.changed) != 0:
+			changed = ", ".join(tree.changed[:10]) + (", ..." if len(tree.changed) > 10 else "")
+			logger.info(f"compute_src_fingerprint: {len(tree.changed)} changed directories in {root}: {changed}")
+		config = f"{tree_hash}\0{self.replication.src}\0{self.replication.dest}\0{self.replication.options}"
+		return hashlib.sha256(config.encode("utf-8", "surrogateescape")).hexdigest()
+	
+	
+	def save_src_fingerprint(self, fingerprint):
+		"""update only fingerprint, replication may be edited while task runs"""
+		self.replication.last_src_fingerprint = fingerprint
+		Replication.objects.filter(pk = self.replication.pk).update(last_src_fingerprint = fingerprint)
+	
+	
 	def run_pre_cmd(self):
+		return run_steps(self.run_pre_cmd_steps())
+	
+	
+	def run_pre_cmd_steps(self):
 		if self.replication.pre_cmd is None:
 			return
 		logger.debug(f"run_pre_cmd: will run pre-cmd {self.replication.pre_cmd}")
 		try:
-			cmd_output_text, returncode = run_command_with_returncode(self.replication.pre_cmd, shell = False)
+			cmd_output_text, returncode = yield RunCommand(self.replication.pre_cmd, shell = False, control = self.control)
+		except TaskCancelled:
+			raise
 		except Exception as e:
 			logger.error(f"run_pre_cmd: got error while executing pre-cmd: {e}, traceback: {traceback.format_exc()}")
-			self.add_error_text(f"pre-cmd: ERROR - EXCEPTION: cmd: {self.replication.pre_cmd}, output: " + cmd_output_text + "\n\n")
+			self.add_error_text(f"pre-cmd: ERROR - EXCEPTION: cmd: {self.replication.pre_cmd}, error: {e}" + "\n\n")
+			return False
 		if returncode != 0:
 			logger.error(f"run_pre_cmd: got error while executing pre-cmd: {self.replication.pre_cmd}. exitcode is: {str(returncode)}, cmd output is {cmd_output_text}")
 			self.add_error_text(f"pre-cmd: ERROR - NON_ZERO_RETURNCODE: cmd: {self.replication.pre_cmd}, output: " + cmd_output_text + "\n\n")
@@ -362,14 +869,21 @@ class ReplicationTask(models.Model):
 	
 	
 	def run_post_cmd(self):
+		return run_steps(self.run_post_cmd_steps())
+	
+	
+	def run_post_cmd_steps(self):
 		if self.replication.post_cmd is None:
 			return
 		logger.debug(f"run_post_cmd: will run post-cmd {self.replication.post_cmd}")
 		try:
-			cmd_output_text, returncode = run_command_with_returncode(self.replication.post_cmd, shell = False)
+			cmd_output_text, returncode = yield RunCommand(self.replication.post_cmd, shell = False, control = self.control)
+		except TaskCancelled:
+			raise
 		except Exception as e:
 			logger.error(f"run_post_cmd: got error while executing post-cmd: {e}, traceback: {traceback.format_exc()}")
-			self.add_error_text(f"post-cmd: ERROR - EXCEPTION: cmd: {self.replication.post_cmd}, output: " + cmd_output_text + "\n\n")
+			self.add_error_text(f"post-cmd: ERROR - EXCEPTION: cmd: {self.replication.post_cmd}, error: {e}" + "\n\n")
+			return False
 		if returncode != 0:
 			logger.error(f"run_post_cmd: got error while executing post-cmd: {self.replication.post_cmd}. exitcode is {str(returncode)}, cmd output is {cmd_output_text}")
 			self.add_error_text(f"post-cmd: ERROR - NON_ZERO_RETURNCODE: cmd: {self.replication.post_cmd}, output: " + cmd_output_text + "\n\n")
@@ -383,10 +897,12 @@ class ReplicationTask(models.Model):
 		"""check connection via ICMP.
 		returns True if reachable, False if unreachable, None if there is no remote_host to connect (both src and dest are local
 		)"""
-		import time
-		import ping3
+		return run_steps(self.check_connection_via_ICMP_steps())
+	
+	
+	def check_connection_via_ICMP_steps(self):
 		def ping_f():
-			ping_res = ping3.ping(self.replication.remote_host)
+			ping_res = yield Ping(self.replication.remote_host)
 			logger.debug(f"check_connection_via_ICMP: ping_f: ping_res is {ping_res}")
 			return ping_res
 		if self.replication.remote_host is None:
@@ -394,11 +910,11 @@ class ReplicationTask(models.Model):
 			return None
 		logger.debug(f"check_connection_via_ICMP: will check connection to {self.replication.remote_host}")
 		retries_left = self.replication.retries
-		ping = ping_f()
+		ping = yield from ping_f()
 		while (ping is False or ping is None) and retries_left > 0:
 			logger.info(f"check_connection_via_ICMP: host {self.replication.remote_host} unreachable by ICMP, retrying ({retries_left} left)...")
-			time.sleep(self.RETRY_DELAY_S)
-			ping = ping_f()
+			yield Sleep(self.RETRY_DELAY_S, self.control)
+			ping = yield from ping_f()
 			retries_left -= 1
 		if ping is not False and ping is not None:
 			# OK host is reachable
@@ -476,26 +992,82 @@ class ReplicationTask(models.Model):
 	
 	
 	def run_replication(self):
+		return run_steps(self.run_replication_steps())
+	
+	
+	def open_ssh_master_steps(self):
+		"""get master connection to remote host from SshControlPool, if rsync runs over ssh and replication does not set -e"""
+		target = self.replication.get_ssh_target()
+		settings = Settings.get_settings()
+		if target is None or not settings.ssh_multiplexing:
+			return None
+		if "-e " in self.replication.options or "--rsh" in self.replication.options:
+			logger.debug(f"open_ssh_master: replication sets its own remote shell, ssh master will not be used")
+			return None
+		master = yield OpenSshMaster(*target, settings.ssh_control_persist)
+		if master is not None:
+			self.ssh_reused = master.reused
+			self.ssh_handshake_s = master.handshake_s
+		return master
+	
+	
+	def run_replication_steps(self):
 		logger.debug(f"run_replication: starting task {self} for replication {self.replication}")
-		rsync_cmd = self.replication.resulting_cmd
+		if not self.dry_run:
+			self.ssh_master = yield from self.open_ssh_master_steps()
+			self.batch_file = self.prepare_batch_file()
+		rsync_cmd = self.replication.get_cmd(self.get_rsync_extra_options())
 		self.mark_start()
 		if not self.dry_run:
 			try:
 				if self.replication.pre_cmd is not None:
-					self.run_pre_cmd()
+					yield from self.run_pre_cmd_steps()
+				# fingerprint is taken before rsync, so changes made while rsync runs are seen by next run
+				src_fingerprint = None
+				if self.replication.skip_unchanged:
+					src_fingerprint = yield Call(self.compute_src_fingerprint)
+				if src_fingerprint is not None and src_fingerprint == self.replication.last_src_fingerprint:
+					yield from self.skip_unchanged_steps()
+					self.mark_end()
+					self.save()
+					return
 				logger.debug(f"run_replication: id {self.id} - ready to run cmd: {rsync_cmd}")
-				self.cmd_output_text, self.returncode = run_command_with_returncode(rsync_cmd)
+				# output is streamed to log file, only its head and tail are saved to DB
+				self.output_log = TaskOutputLog(self.get_log_file_path(), compress = Settings.get_settings().compress_task_logs).open()
+				self.output_parser = RsyncOutputParser()
+				self.log_file = self.output_log.path
+				try:
+					shard_plan = None
+					if self.batch_file is None and self.batch_of_id is None:
+						# batch is written by single rsync run
+						shard_plan = yield Call(self.plan_shards)
+					if self.batch_of_id is not None:
+						self.returncode = yield from self.run_read_batch_steps(rsync_cmd)
+					elif shard_plan is not None:
+						self.returncode = yield from self.run_sharded_rsync_steps(*shard_plan)
+					else:
+						_, self.returncode = yield RunCommand(rsync_cmd, on_output = self.on_rsync_output, control = self.control)
+				finally:
+					self.output_log.close()
+					self.output_parser.close()
+					self.cmd_output_text = self.output_log.summary_text()
+				self.apply_transfer_stats(self.output_parser)
 				logger.debug(f"run_replication: id {self.id} - cmd execution complete. returncode is {self.returncode}")
 				if self.returncode_is_ok:
 					self.OK = True
 					logger.info(f"run_replication: id {self.id} - replication is complete, OK")
+					# with 24 some files vanished while rsync ran, dest may not match fingerprint
+					if src_fingerprint is not None and self.returncode == 0:
+						self.save_src_fingerprint(src_fingerprint)
 					if self.replication.post_cmd is not None:
-						self.run_post_cmd()
+						yield from self.run_post_cmd_steps()
 				else:
 					self.OK = False
 					self.error = True
 					self.add_error_text(f"Got non-zero returncode {self.returncode}" + "\n")
 					logger.info(f"run_replication: id {self.id} - replication is complete, NOT OK")
+			except TaskCancelled as e:
+				self.mark_cancelled_while_running(e)
 			except Exception as e:
 				self.error = True
 				self.error_text = str(e)
@@ -508,6 +1080,17 @@ class ReplicationTask(models.Model):
 		logger.debug(f"run_replication: replication id {self.id} complete, result is: {self.cmd_output_text}")
 	
 	
+	def skip_unchanged_steps(self):
+		"""src did not change since last successful run: rsync is not run, post_cmd is, as pre_cmd was"""
+		logger.info(f"run_replication: id {self.id} - src did not change since last successful run, skipping rsync")
+		self.unchanged = True
+		self.OK = True
+		self.progress_percent = 100
+		self.comment = "No changes in src since last successful run, rsync skipped"
+		if self.replication.post_cmd is not None:
+			yield from self.run_post_cmd_steps()
+	
+	
 	def cancel(self):
 		logger.info(f"cancel: this task {self} is being cancelled")
 		self.cancelled = True
@@ -515,15 +1098,24 @@ class ReplicationTask(models.Model):
 		logger.info(f"cancel: this task {self} cancelled, saved")
 	
 	
-	def launch(self):
-		self._set_thread(threading.Thread(target = self.run))
-		self._thread.start()
-		logger.info(f"launch: subthread launced for task{self}")
+	def mark_cancelled_while_running(self, reason):
+		"""processes of task were terminated by its control, task is complete but not OK"""
+		self.OK = False
+		if self.control is not None and self.control.timed_out:
+			logger.error(f"mark_cancelled_while_running: task {self} killed by watchdog: {reason}")
+			self.error = True
+			self.comment = f"Killed by watchdog: {reason}"
+			self.add_error_text(f"Killed by watchdog: {reason}")
+			return
+		logger.info(f"mark_cancelled_while_running: task {self} cancelled while running: {reason}")
+		self.cancelled = True
+		self.comment = f"Cancelled while running: {reason}"
+		self.add_error_text(f"Cancelled while running: {reason}")
 	
 	
 	@property
 	def pending(self):
-		if self.start is None and not self.running and not self.cancelled:
+		if self.start is None and not self.running and not self.cancelled and not self.complete:
 			return "pending"
 	
 	
@@ -539,10 +1131,15 @@ class ReplicationTask(models.Model):
 		if self.pending:
 			return "pending"
 		if not self.running and self.complete and (self.start is not None) and (self.end is not None):
+			if self.unchanged:
+				return "complete, no changes"
 			if not self.error:
 				return "complete, OK"
 			else:
 				return "complete, FAIL"
+		if not self.running and self.complete and self.error and self.start is None:
+			# failed before start, e.g. host stayed unreachable
+			return "complete, FAIL"
 		return "UNKNOWN"
 	
 	
@@ -554,26 +1151,61 @@ class ReplicationTask(models.Model):
 	
 	
 	def run(self):
+		"""run task in current thread"""
+		return run_steps(self.steps())
+	
+	
+	def steps(self):
+		"""all steps of task as generator of requests to engine, see engine.py"""
 		logger.debug("run: starting replication")
 		self.mark_start()
+		try:
+			yield from self.run_checked_replication_steps()
+		except TaskCancelled as e:
+			self.mark_cancelled_while_running(e)
+		self.mark_end()
+		self.update_replication_estimate()
+	
+	
+	def update_replication_estimate(self):
+		"""successful rsync run updates predicted duration and bytes of replication. skipped unchanged runs and dry runs do not"""
+		if not self.OK or self.unchanged or self.dry_run or self.cancelled or self.start is None or self.end is None:
+			return
+		try:
+			self.replication.update_estimate((self.end - self.start).total_seconds(), self.bytes_copied)
+		except Exception as e:
+			logger.error(f"update_replication_estimate: could not update estimate of {self.replication}: {e}")
+	
+	
+	def check_host_steps(self):
+		"""check that remote host accepts connections on port of ssh or rsync daemon.
+		returns True if reachable, False if unreachable, None if replication is local. see HostHealth"""
+		target = self.replication.get_probe_target()
+		if target is None:
+			return None
+		reachable = yield Probe(*target)
+		logger.debug(f"check_host: host {target[0]} port {target[1]} reachable: {reachable}")
+		return reachable
+	
+	
+	def run_checked_replication_steps(self):
 		if self.replication.check_ping:
-			logger.debug(f"run: will check ping - check_ping set to True")
-			reachable = self.check_connection_via_ICMP()
-			if self.replication.remote_host is None:
+			logger.debug(f"run: will check host - check_ping set to True")
+			reachable = yield from self.check_host_steps()
+			if reachable is None:
 				logger.info(f"run: running local replication")
-				self.run_replication()
+				yield from self.run_replication_steps()
 			else:
-				if reachable is not False and reachable is not None:
+				if reachable:
 					logger.info(f"run: running remote replication")
-					self.run_replication()
+					yield from self.run_replication_steps()
 				else:
 					logger.error(f"run: replication is remote, but could not reach {self.replication.remote_host}, will not replicate")
 					self.error = True
 					self.add_error_text(f"Replication is remote, but could not reach {self.replication.remote_host}, will not replicate")
 		else:
 			logger.debug(f"run: will not check ping")
-			self.run_replication()
-		self.mark_end()
+			yield from self.run_replication_steps()
 
 
 
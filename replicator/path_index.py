@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""path-prefix index of src/dest claims, used for blocker detection"""
+
+
+import posixpath
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+SRC = "src"
+DEST = "dest"
+
+
+def split_location(location):
+	"""split rsync location to tuple (host, path components)
+
+	/data/a -> (None, ("data", "a"))
+	user@host:/data/a -> ("host", ("data", "a"))
+	host::module/a -> ("host", ("::module", "a"))
+	rsync://user@host/module/a -> ("host", ("::module", "a"))
+	"""
+	host = None
+	path = location
+	if location.startswith("rsync://"):
+		host_part, _, path = location[len("rsync://"):].partition("/")
+		host = host_part.split("@")[-1].split(":")[0]
+		path = "::" + path
+	elif not location.startswith("/") and ":" in location:
+		host_part, _, path = location.partition(":")
+		host = host_part.split("@")[-1]
+		if path.startswith(":"):
+			path = "::" + path[1:]
+	path = posixpath.normpath("/" + path.lstrip("/")) if not path.startswith("::") else path
+	components = tuple(c for c in path.split("/") if c not in ("", "."))
+	return host, components
+
+
+
+class _Node(object):
+	__slots__ = ("children", "claims", "subtree_src", "subtree_dest")
+
+	def __init__(self):
+		self.children = {}
+		self.claims = {}
+		self.subtree_src = 0
+		self.subtree_dest = 0
+
+
+	def subtree_count(self, kind):
+		return self.subtree_src if kind == SRC else self.subtree_dest
+
+
+	def add_subtree_count(self, kind, n):
+		if kind == SRC:
+			self.subtree_src += n
+		else:
+			self.subtree_dest += n
+
+
+
+class PathClaimIndex(object):
+	"""component-aware trie of paths claimed by tasks
+
+	every task claims its src for reading and its dest for writing. two paths overlap if one of them
+	is ancestor of the other or they are equal, compared by path components - so /data2 does not overlap /data.
+	lookup costs O(path depth) plus number of found claims, it does not depend on number of claims in index.
+	"""
+
+	def __init__(self):
+		self.roots = {}
+		self.size = 0
+
+
+	def __len__(self):
+		return self.size
+
+
+	def _walk(self, location, create = False):
+		"""return list of nodes from host root to node of location, or None if there is no such node"""
+		host, components = split_location(location)
+		node = self.roots.get(host)
+		if node is None:
+			if not create:
+				return None
+			node = self.roots[host] = _Node()
+		nodes = [node]
+		for c in components:
+			child = node.children.get(c)
+			if child is None:
+				if not create:
+					return None
+				child = node.children[c] = _Node()
+			node = child
+			nodes.append(node)
+		return nodes
+
+
+	def add(self, owner, location, kind):
+		nodes = self._walk(location, create = True)
+		nodes[-1].claims.setdefault(owner, set()).add(kind)
+		for n in nodes:
+			n.add_subtree_count(kind, 1)
+		self.size += 1
+
+
+	def remove(self, owner, location, kind):
+		nodes = self._walk(location)
+		if nodes is None or kind not in nodes[-1].claims.get(owner, ()):
+			logger.debug(f"remove: claim {kind} {location} of {owner} not found")
+			return False
+		claims = nodes[-1].claims
+		claims[owner].discard(kind)
+		if len(claims[owner]) == 0:
+			del claims[owner]
+		for n in nodes:
+			n.add_subtree_count(kind, -1)
+		# prune empty branches
+		host, components = split_location(location)
+		for i in range(len(nodes) - 1, 0, -1):
+			if nodes[i].subtree_src == 0 and nodes[i].subtree_dest == 0:
+				del nodes[i - 1].children[components[i - 1]]
+			else:
+				break
+		if nodes[0].subtree_src == 0 and nodes[0].subtree_dest == 0:
+			del self.roots[host]
+		self.size -= 1
+		return True
+
+
+	def find_overlapping(self, location, kind):
+		"""return set of owners having claim of kind on location, its ancestors or descendants"""
+		owners = set()
+		host, components = split_location(location)
+		node = self.roots.get(host)
+		if node is None:
+			return owners
+		for c in components:
+			self._collect_claims(node, kind, owners)
+			node = node.children.get(c)
+			if node is None:
+				return owners
+		# node of location itself and all its subtree
+		stack = [node]
+		while len(stack) != 0:
+			n = stack.pop()
+			self._collect_claims(n, kind, owners)
+			stack.extend(child for child in n.children.values() if child.subtree_count(kind) != 0)
+		return owners
+
+
+	@staticmethod
+	def _collect_claims(node, kind, owners):
+		for owner, kinds in node.claims.items():
+			if kind in kinds:
+				owners.add(owner)
+
+
+	def add_task_claims(self, owner, src, dest):
+		self.add(owner, src, SRC)
+		self.add(owner, dest, DEST)
+
+
+	def remove_task_claims(self, owner, src, dest):
+		self.remove(owner, src, SRC)
+		self.remove(owner, dest, DEST)
+
+
+	def find_conflicts(self, src, dest):
+		"""return set of owners which conflict with replication from src to dest:
+		their dest overwrites our src or dest, or our dest overwrites their src"""
+		conflicts = self.find_overlapping(src, DEST)
+		conflicts |= self.find_overlapping(dest, DEST)
+		conflicts |= self.find_overlapping(dest, SRC)
+		return conflicts
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""prediction of duration and transferred bytes of tasks of replication from its past successful tasks
+
+estimate is EWMA of duration and of its mean deviation (as round-trip time estimate of TCP) and EWMA of
+transferred bytes. it is updated by every finished task in O(1) and kept in fields of Replication, history
+of tasks is never re-read. estimates are used by ReplicationTaskRunner to order queue (shortest expected
+task first), for automatic timeout and for ETAs on task runner page.
+"""
+
+
+import heapq
+import datetime
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+# weight of new sample in EWMA of duration and bytes, and in EWMA of deviation
+ALPHA = 0.25
+BETA = 0.25
+# duration of task of replication without estimate
+DEFAULT_DURATION_S = 600
+# automatic timeout is used only when estimate is made of this many tasks
+MIN_SAMPLES = 5
+AUTO_TIMEOUT_FACTOR = 3
+AUTO_TIMEOUT_MIN_S = 3600
+
+
+
+class Estimate(object):
+	"""EWMA estimate of replication, duration_s is None if no task finished yet"""
+	__slots__ = ("duration_s", "duration_dev_s", "bytes", "samples")
+
+	def __init__(self, duration_s = None, duration_dev_s = None, bytes = None, samples = 0):
+		self.duration_s = duration_s
+		self.duration_dev_s = duration_dev_s
+		self.bytes = bytes
+		self.samples = samples or 0
+
+
+	def __str__(self):
+		if self.duration_s is None:
+			return "no estimate"
+		return f"{self.duration_s:.0f} +- {self.duration_dev_s:.0f} s of {self.samples} tasks"
+
+
+	def update(self, duration_s, bytes = None):
+		if self.duration_s is None:
+			self.duration_s = duration_s
+			self.duration_dev_s = duration_s / 2
+		else:
+			self.duration_dev_s = (1 - BETA) * self.duration_dev_s + BETA * abs(duration_s - self.duration_s)
+			self.duration_s = (1 - ALPHA) * self.duration_s + ALPHA * duration_s
+		if bytes is not None:
+			self.bytes = bytes if self.bytes is None else (1 - ALPHA) * self.bytes + ALPHA * bytes
+		self.samples += 1
+
+
+	@property
+	def upper_s(self):
+		"""duration which task should rarely exceed"""
+		if self.duration_s is None:
+			return None
+		return self.duration_s + 4 * self.duration_dev_s
+
+
+	def get_timeout_s(self):
+		"""automatic timeout, or None if there are not enough samples"""
+		if self.samples < MIN_SAMPLES or self.duration_s is None:
+			return None
+		return max(AUTO_TIMEOUT_MIN_S, int(AUTO_TIMEOUT_FACTOR * self.upper_s))
+
+
+
+def get_etas(running, pending, slots, now):
+	"""expected (start, end) of tasks, if slots tasks run at once.
+	running - list of tuples (key, start, duration_s), pending - list of tuples (key, duration_s, not_before) in queue order.
+	duration None is DEFAULT_DURATION_S, running task which took longer than expected is expected to end now.
+	limits of hosts and paths are not taken into account. return dict key -> (start, end)"""
+	etas = {}
+	free_at = []
+	for key, start, duration_s in running:
+		end = max(now, start + datetime.timedelta(seconds = DEFAULT_DURATION_S if duration_s is None else duration_s))
+		etas[key] = (start, end)
+		free_at.append(end)
+	free_at = sorted(free_at)[-slots:] if len(free_at) > slots else free_at
+	free_at += [now] * (slots - len(free_at))
+	heapq.heapify(free_at)
+	for key, duration_s, not_before in pending:
+		start = heapq.heappop(free_at) if len(free_at) != 0 else now
+		if not_before is not None and not_before > start:
+			start = not_before
+		end = start + datetime.timedelta(seconds = DEFAULT_DURATION_S if duration_s is None else duration_s)
+		etas[key] = (start, end)
+		heapq.heappush(free_at, end)
+	return etas
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""classification of rsync failures to transient (worth retry) and permanent"""
+
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+# network and remote side problems, usually gone after some time
+TRANSIENT_CODES = {
+	5: "error starting client-server protocol",
+	10: "error in socket I/O",
+	12: "error in rsync protocol data stream",
+	14: "error in IPC code",
+	20: "received SIGUSR1 or SIGINT",
+	30: "timeout in data send/receive",
+	35: "timeout waiting for daemon connection",
+	255: "ssh connection failed",
+}
+
+# wrong replication settings or environment, retry will fail the same way
+PERMANENT_CODES = {
+	1: "syntax or usage error",
+	2: "protocol incompatibility",
+	4: "requested action not supported",
+	6: "daemon unable to append to log-file",
+	13: "errors with program diagnostics",
+	22: "error allocating core memory buffers",
+	25: "the --max-delete limit stopped deletions",
+}
+
+# 3 and 23 (errors selecting files, partial transfer due to error) and unknown codes are classified by output
+TRANSIENT_PATTERNS = (
+	"connection reset",
+	"connection refused",
+	"connection timed out",
+	"connection unexpectedly closed",
+	"broken pipe",
+	"no route to host",
+	"network is unreachable",
+	"host is down",
+	"could not resolve hostname",
+	"temporary failure in name resolution",
+	"timeout in data send/receive",
+	"stale file handle",
+	"resource temporarily unavailable",
+)
+
+PERMANENT_PATTERNS = (
+	"permission denied",
+	"no space left on device",
+	"disk quota exceeded",
+	"read-only file system",
+	"unknown option",
+	"syntax or usage error",
+	"no such file or directory",
+)
+
+# ssh exits with 255 both when network is down and when it is refused to log in
+LOGIN_PATTERNS = (
+	"permission denied (publickey",
+	"host key verification failed",
+	"is your shell clean",
+)
+
+
+def find_pattern(text, patterns):
+	for pattern in patterns:
+		if pattern in text:
+			return pattern
+	return None
+
+
+def classify_failure(returncode, output_text = ""):
+	"""return tuple (transient, reason) for failed rsync run
+
+	exit code decides, if it is known as transient or permanent (except failed ssh login), otherwise
+	(3, 23 and unknown codes) output decides: any permanent error text makes failure permanent
+	"""
+	text = (output_text or "").lower()
+	if returncode in PERMANENT_CODES:
+		return False, f"exit code {returncode}: {PERMANENT_CODES[returncode]}"
+	login_error = find_pattern(text, LOGIN_PATTERNS)
+	if login_error is not None:
+		return False, f"exit code {returncode}, output: {login_error}"
+	if returncode in TRANSIENT_CODES:
+		return True, f"exit code {returncode}: {TRANSIENT_CODES[returncode]}"
+	permanent = find_pattern(text, PERMANENT_PATTERNS)
+	if permanent is not None:
+		return False, f"exit code {returncode}, output: {permanent}"
+	transient = find_pattern(text, TRANSIENT_PATTERNS)
+	if transient is not None:
+		return True, f"exit code {returncode}, output: {transient}"
+	return False, f"exit code {returncode}, unknown error"
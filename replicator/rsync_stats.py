@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""incremental parser of rsync --stats and --info=progress2 output"""
+
+
+import re
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+STATS_OPTIONS = ["--stats", "--info=progress2"]
+
+SIZE_SUFFIXES = {"": 1, "K": 1000, "M": 1000 ** 2, "G": 1000 ** 3, "T": 1000 ** 4, "P": 1000 ** 5}
+
+# "    1,234,567  45%   12.34MB/s    0:00:10 (xfr#12, to-chk=100/2000)"
+PROGRESS_RE = re.compile(r"^\s*([\d,.']+[KMGTP]?)\s+(\d+)%\s+([\d,.']+)([KMGTP]?)B/s\s+\d+:\d\d:\d\d")
+
+STATS_RE = {
+	"files_total": re.compile(r"^Number of files:\s+([\d,.']+[KMGTP]?)"),
+	"files_transferred": re.compile(r"^Number of (?:regular )?files transferred:\s+([\d,.']+[KMGTP]?)"),
+	"bytes_total": re.compile(r"^Total file size:\s+([\d,.']+[KMGTP]?)"),
+	"bytes_transferred": re.compile(r"^Total transferred file size:\s+([\d,.']+[KMGTP]?)"),
+	"literal_data": re.compile(r"^Literal data:\s+([\d,.']+[KMGTP]?)"),
+	"matched_data": re.compile(r"^Matched data:\s+([\d,.']+[KMGTP]?)"),
+	"bytes_sent": re.compile(r"^Total bytes sent:\s+([\d,.']+[KMGTP]?)"),
+	"bytes_received": re.compile(r"^Total bytes received:\s+([\d,.']+[KMGTP]?)"),
+}
+
+# "sent 1,234 bytes  received 56 bytes  2,580.00 bytes/sec"
+RATE_RE = re.compile(r"^sent\s+[\d,.']+[KMGTP]?\s+bytes\s+received\s+[\d,.']+[KMGTP]?\s+bytes\s+([\d,.']+)([KMGTP]?)\s+bytes/sec")
+# "total size is 1,234,567  speedup is 123.45"
+SPEEDUP_RE = re.compile(r"total size is\s+[\d,.']+[KMGTP]?\s+speedup is\s+([\d,.']+)")
+
+
+def parse_number(text, suffix = ""):
+	"""parse rsync number, which may contain thousands separators (depends on locale) or size suffix (with -h)"""
+	if len(text) != 0 and text[-1] in SIZE_SUFFIXES:
+		text, suffix = text[:-1], text[-1]
+	text = text.replace("'", "")
+	# "1,234,567" or "1.234.567" are integers, "12.34" or "12,34" are fractions
+	separators = [c for c in text if c in ",."]
+	if len(separators) != 0:
+		last = text.rfind(separators[-1])
+		if len(separators) == 1 and len(text) - last - 1 != 3 or len(set(separators)) == 2:
+			integer_part = re.sub(r"[,.]", "", text[:last])
+			text = integer_part + "." + text[last + 1:]
+		else:
+			text = re.sub(r"[,.]", "", text)
+	try:
+		value = float(text) * SIZE_SUFFIXES.get(suffix, 1)
+	except ValueError:
+		return None
+	return value
+
+
+
+class RsyncOutputParser(object):
+	"""parses rsync output chunk by chunk, keeps live progress and final statistics"""
+
+
+	def __init__(self):
+		self.buffer = b""
+		self.progress_percent = None
+		self.bytes_per_s = None
+		self.bytes_done = None
+		self.stats = {}
+
+
+	def feed(self, chunk):
+		"""parse next chunk of output, lines may be split by \\n or by \\r (progress2 updates)"""
+		data = self.buffer + chunk
+		lines = re.split(rb"[\r\n]", data)
+		self.buffer = lines.pop()
+		# incomplete line is kept in buffer, but it should not grow without limit
+		if len(self.buffer) > 4096:
+			self.buffer = b""
+		for line in lines:
+			if len(line) != 0:
+				self.parse_line(line.decode("utf-8", errors = "replace"))
+
+
+	def close(self):
+		if len(self.buffer) != 0:
+			self.parse_line(self.buffer.decode("utf-8", errors = "replace"))
+			self.buffer = b""
+
+
+	def parse_line(self, line):
+		m = PROGRESS_RE.match(line)
+		if m is not None:
+			self.bytes_done = parse_number(m.group(1))
+			self.progress_percent = int(m.group(2))
+			self.bytes_per_s = parse_number(m.group(3), m.group(4))
+			return
+		for key, regexp in STATS_RE.items():
+			m = regexp.match(line)
+			if m is not None:
+				value = parse_number(m.group(1))
+				if value is not None:
+					self.stats[key] = int(value)
+				return
+		m = RATE_RE.match(line)
+		if m is not None:
+			self.stats["bytes_per_s"] = parse_number(m.group(1), m.group(2))
+			return
+		m = SPEEDUP_RE.search(line)
+		if m is not None:
+			self.stats["speedup"] = parse_number(m.group(1))
+
+
+
+class CombinedOutputParser(object):
+	"""progress and statistics of several rsync runs (shards of one task), rolled up as one parser"""
+	SUM_KEYS = ("files_total", "files_transferred", "bytes_total", "bytes_transferred", "literal_data", "matched_data",
+		"bytes_sent", "bytes_received", "bytes_per_s")
+
+
+	def __init__(self, parsers):
+		self.parsers = parsers
+
+
+	def close(self):
+		for parser in self.parsers:
+			parser.close()
+
+
+	@property
+	def progress_percent(self):
+		"""mean of progress of shards, shard without progress yet counts as 0%"""
+		values = [p.progress_percent for p in self.parsers if p.progress_percent is not None]
+		if len(values) == 0:
+			return None
+		return int(sum(values) / len(self.parsers))
+
+
+	@property
+	def bytes_per_s(self):
+		values = [p.bytes_per_s for p in self.parsers if p.bytes_per_s is not None]
+		return sum(values) if len(values) != 0 else None
+
+
+	@property
+	def bytes_done(self):
+		values = [p.bytes_done for p in self.parsers if p.bytes_done is not None]
+		return sum(values) if len(values) != 0 else None
+
+
+	@property
+	def stats(self):
+		stats = {}
+		for key in self.SUM_KEYS:
+			values = [p.stats[key] for p in self.parsers if key in p.stats]
+			if len(values) != 0:
+				stats[key] = sum(values)
+		transferred = stats.get("bytes_sent", 0) + stats.get("bytes_received", 0)
+		if "bytes_total" in stats and transferred != 0:
+			stats["speedup"] = round(stats["bytes_total"] / transferred, 2)
+		return stats
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""split src of replication to shards, which are copied by parallel rsync runs
+
+src is split by its top-level entries (subdirectories and files). in SHARD_DIRS mode entries are dealt
+to shards by count, in SHARD_SIZE mode by size of their trees (largest first, to shard with least size).
+every shard is copied by rsync --files-from with list of its entries. entries removed from src
+are deleted from dest by cleanup pass, which does not recurse and does not transfer anything.
+"""
+
+
+import os
+import heapq
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+SHARD_DIRS = "dirs"
+SHARD_SIZE = "size"
+SHARD_MODE_CHOICES = ((SHARD_DIRS, "by top-level subdirectories"), (SHARD_SIZE, "by size of top-level subdirectories"))
+
+SHARD_OPTIONS = ["--recursive", "--from0"]
+CLEANUP_OPTIONS = ["--no-recursive", "--dirs", "--delete", "--existing", "--ignore-existing"]
+
+
+def get_shard_locations(src, dest):
+	"""return tuple (src_dir, dest_dir) with same meaning as rsync src dest, where src_dir is copied by its content:
+	rsync /data/a /backup/ copies /data/a/ to /backup/a/"""
+	if src.endswith("/"):
+		return src, dest
+	return src + "/", os.path.join(dest, os.path.basename(src)) + "/"
+
+
+def list_entries(src_dir):
+	with os.scandir(src_dir) as it:
+		return sorted(entry.name for entry in it)
+
+
+def get_tree_size(path):
+	"""total size of files in tree, symlinks are not followed"""
+	st = os.lstat(path)
+	if not os.path.isdir(path) or os.path.islink(path):
+		return st.st_size
+	total = 0
+	for root, dirs, files in os.walk(path):
+		for name in files:
+			try:
+				total += os.lstat(os.path.join(root, name)).st_size
+			except OSError:
+				pass
+	return total
+
+
+def measure_sizes(src_dir, entries, workers = 8):
+	"""sizes of entries, trees are walked in parallel - walk is bound by stat latency, not by CPU"""
+	with ThreadPoolExecutor(max_workers = workers) as pool:
+		sizes = list(pool.map(lambda name: get_tree_size(os.path.join(src_dir, name)), entries))
+	return dict(zip(entries, sizes))
+
+
+def partition(weights, n):
+	"""split dict entry -> weight to at most n lists of entries with close total weights (LPT)"""
+	shards = [(0, i, []) for i in range(n)]
+	for name in sorted(weights, key = lambda name: (-weights[name], name)):
+		total, i, names = heapq.heappop(shards)
+		names.append(name)
+		heapq.heappush(shards, (total + max(weights[name], 1), i, names))
+	return [names for total, i, names in sorted(shards, key = lambda s: s[1]) if len(names) != 0]
+
+
+def plan_shards(src_dir, n, mode = SHARD_DIRS, workers = 8):
+	"""return list of shards (lists of top-level entries of src_dir), or None if src_dir can not be sharded"""
+	if n < 2 or not os.path.isdir(src_dir):
+		return None
+	entries = list_entries(src_dir)
+	if len(entries) < 2:
+		return None
+	if mode == SHARD_SIZE:
+		weights = measure_sizes(src_dir, entries, workers = workers)
+	else:
+		weights = {name: 1 for name in entries}
+	shards = partition(weights, n)
+	logger.debug(f"plan_shards: {len(entries)} entries of {src_dir} split to {len(shards)} shards")
+	return shards
+
+
+def write_files_from(path, names):
+	"""write list of entries for rsync --files-from --from0"""
+	with open(path, "wb") as f:
+		for name in names:
+			f.write(os.fsencode(name) + b"\0")
+
+
+def combine_returncodes(returncodes):
+	"""returncode of sharded run: first failure, else 24 if some source files vanished, else 0"""
+	for returncode in returncodes:
+		if returncode not in (0, 24):
+			return returncode
+	return 24 if 24 in returncodes else 0
@@ -1,19 +1,44 @@
-
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 
 import logging
 
-from .models import ReplicationSchedule
+from .models import Replication, ReplicationSchedule, Settings
 from .base import ReplicationScheduler
 
 logger = logging.getLogger(__name__)
 
 
-
-@receiver(post_save, sender = ReplicationSchedule)
-def signal_reload_shedule_jobs(sender, instance, created, **kwargs):
-	logger.debug(f"signal_reload_shedule_jobs: signal called")
-	ReplicationScheduler.reload_all_schedules()
+# only job of changed schedule is updated. signals update scheduler running in this process,
+# scheduler in other process (manage.py worker) picks changes up by date_modified, see ReplicationScheduler.sync_changes
 
 
+@receiver(post_save, sender = ReplicationSchedule)
+def signal_update_schedule_job(sender, instance, created, **kwargs):
+	if ReplicationScheduler.thread is None:
+		return
+	logger.debug(f"signal_update_schedule_job: schedule {instance} saved")
+	ReplicationScheduler.add_job(instance)
+
+
+@receiver(post_delete, sender = ReplicationSchedule)
+def signal_remove_schedule_job(sender, instance, **kwargs):
+	if ReplicationScheduler.thread is None:
+		return
+	logger.debug(f"signal_remove_schedule_job: schedule {instance} deleted")
+	ReplicationScheduler.remove_job(instance.id)
+
+
+@receiver(post_save, sender = Replication)
+def signal_update_replication_jobs(sender, instance, created, **kwargs):
+	if ReplicationScheduler.thread is None or created:
+		return
+	logger.debug(f"signal_update_replication_jobs: replication {instance} saved")
+	ReplicationScheduler.update_replication_jobs(instance)
+
+
+@receiver(post_save, sender = Settings)
+@receiver(post_delete, sender = Settings)
+def signal_clear_settings_cache(sender, instance, **kwargs):
+	logger.debug(f"signal_clear_settings_cache: settings {instance.pk} changed")
+	Settings.clear_cache()
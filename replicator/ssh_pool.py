@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""pool of long-lived ssh master connections (ControlMaster), shared by rsync runs to same host"""
+
+
+import os
+import time
+import shlex
+import logging
+import threading
+import subprocess
+
+from .path_index import split_location
+from .host_health import get_probe_target
+
+logger = logging.getLogger(__name__)
+
+
+def get_ssh_target(location, options = ""):
+	"""return tuple (user, host, port) if location is reached by rsync over ssh, otherwise None"""
+	if location.startswith("rsync://"):
+		return None
+	host, components = split_location(location)
+	if host is None or (len(components) != 0 and components[0].startswith("::")):
+		return None
+	user = location.partition(":")[0].rpartition("@")[0] or None
+	_, port = get_probe_target(location, options)
+	return user, host, port
+
+
+
+class SshMaster(object):
+	"""master connection used by task: socket_path, reused (False if master was opened for this task)
+	and handshake_s - time of handshake, spent to open master or saved by reuse"""
+	__slots__ = ("socket_path", "reused", "handshake_s")
+
+	def __init__(self, socket_path, reused, handshake_s):
+		self.socket_path = socket_path
+		self.reused = reused
+		self.handshake_s = handshake_s
+
+
+	def get_ssh_command(self, port):
+		"""value of rsync -e option, ssh connects through master socket"""
+		cmd = ["ssh", "-o", f"ControlPath={self.socket_path}", "-o", "ControlMaster=no"]
+		if port != 22:
+			cmd += ["-p", str(port)]
+		return shlex.join(cmd)
+
+
+
+class SshControlPool(object):
+	"""opens one ssh master per (user, host, port) and keeps it for persist_s after last use (ssh ControlPersist)
+
+	master is opened by ssh -M -N -f, its duration is handshake time, which is saved by every reuse.
+	opening is serialized per target, so tasks started together to same host open only one master.
+	"""
+	CONNECT_TIMEOUT_S = 10
+	CHECK_TIMEOUT_S = 5
+	sockets_dir = None
+	handshake_s = {}
+	warm_until = {}
+	target_locks = {}
+	lock = threading.Lock()
+
+
+	@classmethod
+	def get_sockets_dir(cls):
+		"""directory of master sockets, path of unix socket is limited to ~100 chars, so it is short path in /tmp"""
+		if cls.sockets_dir is None:
+			from django.conf import settings
+			cls.sockets_dir = str(getattr(settings, "REPLICATOR_SSH_SOCKETS_DIR", f"/tmp/dfrsync-ssh-{os.getuid()}"))
+		os.makedirs(cls.sockets_dir, mode = 0o700, exist_ok = True)
+		return cls.sockets_dir
+
+
+	@classmethod
+	def get_socket_path(cls, user, host, port):
+		name = f"{user}@{host}:{port}" if user is not None else f"{host}:{port}"
+		return os.path.join(cls.get_sockets_dir(), name)
+
+
+	@staticmethod
+	def get_destination_args(user, host, port):
+		args = ["-p", str(port)] if port != 22 else []
+		return args + [f"{user}@{host}" if user is not None else host]
+
+
+	@classmethod
+	def check_master(cls, socket_path, user, host, port):
+		"""True if master listening on socket_path is alive"""
+		if not os.path.exists(socket_path):
+			return False
+		args = ["ssh", "-O", "check", "-o", f"ControlPath={socket_path}"] + cls.get_destination_args(user, host, port)
+		try:
+			return subprocess.run(args, stdin = subprocess.DEVNULL, stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL,
+				timeout = cls.CHECK_TIMEOUT_S).returncode == 0
+		except Exception as e:
+			logger.error(f"check_master: could not check master {socket_path}: {e}")
+			return False
+
+
+	@classmethod
+	def get_target_lock(cls, target):
+		with cls.lock:
+			return cls.target_locks.setdefault(target, threading.Lock())
+
+
+	@classmethod
+	def open_master(cls, user, host, port, persist_s):
+		"""return SshMaster for target - live master is reused, otherwise new master is opened.
+		return None if master could not be opened, then rsync should use its own ssh connection"""
+		target = (user, host, port)
+		with cls.get_target_lock(target):
+			socket_path = cls.get_socket_path(user, host, port)
+			if cls.check_master(socket_path, user, host, port):
+				cls.warm_until[host] = time.monotonic() + persist_s
+				logger.debug(f"open_master: reusing master {socket_path}")
+				return SshMaster(socket_path, True, cls.handshake_s.get(target))
+			# stdout and stderr are not captured: ssh -f keeps them open in background master
+			args = ["ssh", "-M", "-N", "-f", "-o", f"ControlPath={socket_path}", "-o", f"ControlPersist={persist_s}",
+				"-o", "BatchMode=yes", "-o", f"ConnectTimeout={cls.CONNECT_TIMEOUT_S}"] + cls.get_destination_args(user, host, port)
+			time_start = time.monotonic()
+			try:
+				returncode = subprocess.run(args, stdin = subprocess.DEVNULL, stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL,
+					timeout = cls.CONNECT_TIMEOUT_S + 5, start_new_session = True).returncode
+			except Exception as e:
+				logger.error(f"open_master: could not open master to {host}: {e}")
+				return None
+			took = time.monotonic() - time_start
+			if returncode != 0:
+				logger.error(f"open_master: could not open master to {host}, returncode {returncode}")
+				return None
+			cls.handshake_s[target] = took
+			cls.warm_until[host] = time.monotonic() + persist_s
+			logger.info(f"open_master: opened master {socket_path} in {took:.2f} s")
+			return SshMaster(socket_path, False, took)
+
+
+	@classmethod
+	def is_warm(cls, host):
+		"""True if there is master to host, which should be still alive"""
+		warm_until = cls.warm_until.get(host)
+		return warm_until is not None and time.monotonic() < warm_until
+
+
+	@classmethod
+	def list_sockets(cls):
+		try:
+			return sorted(os.listdir(cls.get_sockets_dir()))
+		except OSError:
+			return []
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""planner of schedule offsets: spreads runs which start at same time over backup window
+
+every run is interval (start, start + typical duration of its replication). runs are placed one by one,
+longest first, at offset (from 0 to latest offset which still fits window, with step) where peak number
+of concurrently running tasks is lowest - earliest such offset wins. see manage.py plan_schedules.
+"""
+
+
+import statistics
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_DURATION_S = 600
+
+
+def get_peak(intervals, start = None, end = None):
+	"""max number of intervals (start, end) running at once, within [start, end) if specified"""
+	events = []
+	for s, e in intervals:
+		if start is not None and (e <= start or s >= end):
+			continue
+		events.append((s if start is None else max(s, start), 1))
+		events.append((e, -1))
+	peak = 0
+	running = 0
+	# at same time end goes before start
+	for t, delta in sorted(events, key = lambda ev: (ev[0], ev[1])):
+		running += delta
+		peak = max(peak, running)
+	return peak
+
+
+def plan_offsets(items, window_s, step_s = 60, fixed = ()):
+	"""items - list of tuples (key, start_s, duration_s), start relative to start of window.
+	fixed - intervals of runs which are not moved. return dict key -> offset_s"""
+	placed = list(fixed)
+	offsets = {}
+	for key, start, duration in sorted(items, key = lambda item: (-item[2], item[1])):
+		latest = max(0, int(window_s - duration - start))
+		best_peak, best_offset = None, 0
+		for offset in range(0, latest + 1, max(1, step_s)):
+			peak = get_peak(placed, start + offset, start + offset + duration)
+			if best_peak is None or peak < best_peak:
+				best_peak, best_offset = peak, offset
+				if peak == 0:
+					break
+		offsets[key] = best_offset
+		placed.append((start + best_offset, start + best_offset + duration))
+	return offsets
+
+
+def get_typical_duration(durations):
+	"""median of durations of recent runs, None if there are none"""
+	if len(durations) == 0:
+		return None
+	return statistics.median(durations)
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""per-task log file for command output"""
+
+
+import os
+import gzip
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+
+class TaskOutputLog(object):
+	"""streams command output to log file, optionally gzip-compressed, keeps only bounded head and tail in memory"""
+	HEAD_SIZE = 16 * 1024
+	TAIL_SIZE = 64 * 1024
+
+
+	def __init__(self, path, compress = False):
+		self.path = path + ".gz" if compress else path
+		self.compress = compress
+		self.head = bytearray()
+		self.tail = bytearray()
+		self.size = 0
+		self.file = None
+
+
+	def open(self):
+		os.makedirs(os.path.dirname(self.path), exist_ok = True)
+		self.file = gzip.open(self.path, "ab") if self.compress else open(self.path, "ab")
+		logger.debug(f"open: writing output to {self.path}")
+		return self
+
+
+	def write(self, chunk):
+		if self.file is not None:
+			self.file.write(chunk)
+		self.size += len(chunk)
+		if len(self.head) < self.HEAD_SIZE:
+			head_part = chunk[:self.HEAD_SIZE - len(self.head)]
+			self.head += head_part
+			chunk = chunk[len(head_part):]
+		if len(chunk) != 0:
+			self.tail += chunk
+			if len(self.tail) > self.TAIL_SIZE:
+				del self.tail[:len(self.tail) - self.TAIL_SIZE]
+
+
+	def close(self):
+		if self.file is not None:
+			self.file.close()
+			self.file = None
+
+
+	@property
+	def skipped_size(self):
+		return self.size - len(self.head) - len(self.tail)
+
+
+	def summary_text(self):
+		"""head and tail of output, to be saved in DB"""
+		if self.skipped_size == 0:
+			return (bytes(self.head) + bytes(self.tail)).decode("utf-8", errors = "replace")
+		return (self.head.decode("utf-8", errors = "replace")
+			+ f"\n\n... {self.skipped_size} bytes skipped, full output in log file {self.path} ...\n\n"
+			+ self.tail.decode("utf-8", errors = "replace"))
+
+
+	@staticmethod
+	def iter_file(path, chunk_size = 64 * 1024):
+		"""yield content of log file by chunks, log file may be compressed"""
+		opener = gzip.open if path.endswith(".gz") else open
+		with opener(path, "rb") as f:
+			while True:
+				chunk = f.read(chunk_size)
+				if not chunk:
+					break
+				yield chunk
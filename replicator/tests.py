@@ -1,5 +1,44 @@
 from django.test import TestCase
-from .models import Replication, ReplicationTask, ReplicationSchedule
+from unittest import mock
+from .models import Replication, ReplicationTask, ReplicationSchedule, Settings
+
+
+
+class SettingsTests(TestCase):
+	
+	def setUp(self):
+		Settings.clear_cache()
+	
+	
+	def tearDown(self):
+		Settings.clear_cache()
+	
+	
+	def test_settings_are_cached(self):
+		settings = Settings.get_settings()
+		with self.assertNumQueries(0):
+			self.assertIs(Settings.get_settings(), settings)
+		# saved by other process
+		Settings.objects.filter(pk = 1).update(rsync_executable = "/usr/local/bin/rsync", version = settings.version + 1)
+		self.assertIs(Settings.get_settings(), settings)
+		Settings.cache_checked_at = 0.0
+		self.assertEqual(Settings.get_settings().rsync_executable, "/usr/local/bin/rsync")
+		with self.assertNumQueries(1):
+			Settings.cache_checked_at = 0.0
+			Settings.get_settings()
+	
+	
+	def test_saved_settings_apply_without_restart(self):
+		replication = Replication(name = "r1", src = "/tmp/src1/", dest = "/tmp/dest1/", options = "-a")
+		self.assertTrue(replication.get_cmd().startswith("rsync "))
+		settings = Settings.objects.get(pk = Settings.get_settings().pk)
+		settings.rsync_executable = "/opt/rsync"
+		settings.save()
+		self.assertTrue(replication.get_cmd().startswith("/opt/rsync "))
+		version = Settings.get_settings().version
+		Settings.reset_settings()
+		self.assertEqual(Settings.get_settings().rsync_executable, "rsync")
+		self.assertGreater(Settings.get_settings().version, version)
 
 
 
@@ -77,6 +116,44 @@ class ReplicationScheduleModelTests(TestCase):
 		self.assertEqual(test_rs.hour, 1)
 		self.assertEqual(test_rs.minute, 2)
 		self.assertEqual(test_rs.second, 3)
+	
+	
+	def test_one_time_in_future_is_not_monthly(self):
+		import datetime
+		test_rs = ReplicationSchedule(replication = Replication(src = "/tmp/", dest = "/temp2/"),
+			time = datetime.time(hour = 1, minute = 2), year = 2030, month = 5, dom = 10)
+		self.assertEqual(test_rs.is_monthly, False)
+		self.assertEqual(test_rs.is_one_time_in_future, True)
+	
+	
+	def test_get_next_local_run(self):
+		import datetime
+		test_r = Replication(src = "/tmp/", dest = "/temp2/")
+		t = datetime.time(hour = 3, minute = 30)
+		after = datetime.datetime(2024, 1, 31, 12, 0)
+		def next_run(**kwargs):
+			return ReplicationSchedule(replication = test_r, **kwargs).get_next_local_run(after)
+		self.assertEqual(next_run(time = datetime.time(0, 15, 5), hourly = True), datetime.datetime(2024, 1, 31, 12, 15, 5))
+		self.assertEqual(next_run(time = t), datetime.datetime(2024, 2, 1, 3, 30))
+		# 2024-01-31 is wednesday, dow 0 is monday
+		self.assertEqual(next_run(time = t, dow = 0), datetime.datetime(2024, 2, 5, 3, 30))
+		# february and april have no 31st
+		self.assertEqual(next_run(time = t, dom = 31), datetime.datetime(2024, 3, 31, 3, 30))
+		self.assertEqual(next_run(time = t, year = 2024, month = 6, dom = 1), datetime.datetime(2024, 6, 1, 3, 30))
+		self.assertIsNone(next_run(time = t, year = 2023, month = 6, dom = 1))
+		self.assertEqual(next_run(cron = "*/20 9-17 * * mon-fri"), datetime.datetime(2024, 1, 31, 12, 20))
+		every_3 = ReplicationSchedule(replication = test_r, time = t, every_n_days = 3)
+		self.assertEqual(every_3.get_next_local_run(after), datetime.datetime(2024, 2, 1, 3, 30))
+		# phase of last run is kept, missed periods are skipped
+		self.assertEqual(every_3.get_next_local_run(after, last_run = datetime.datetime(2024, 1, 20, 3, 30)), datetime.datetime(2024, 2, 1, 3, 30))
+		self.assertEqual(every_3.get_next_local_run(after, last_run = datetime.datetime(2024, 1, 30, 3, 30)), datetime.datetime(2024, 2, 2, 3, 30))
+	
+	
+	def test_invalid_cron_is_rejected(self):
+		from django.core.exceptions import ValidationError
+		test_rs = ReplicationSchedule(replication = Replication(src = "/tmp/", dest = "/temp2/"), cron = "61 * * * *")
+		with self.assertRaises(ValidationError):
+			test_rs.clean()
 
 
 
@@ -133,3 +210,1590 @@ class ReplicationTaskModelTest(TestCase):
 	
 
 
+
+
+
+class ReplicationTaskRunnerTests(TestCase):
+	
+	def setUp(self):
+		from .base import ReplicationTaskRunner
+		from .path_index import PathClaimIndex
+		from .bandwidth import BandwidthManager
+		self.runner = ReplicationTaskRunner
+		self.runner.tasks = {}
+		self.runner.queue = []
+		self.runner.recent_tasks.clear()
+		self.runner.path_index = PathClaimIndex()
+		self.runner.running_count = 0
+		self.runner.running_on_host = {}
+		self.runner.abandoned_count = 0
+		self.runner.bandwidth = BandwidthManager()
+		self.runner.retry_candidate_ids = []
+		self.runner.requeue_replication_ids = []
+		self.runner.last_loaded_id = 0
+		self.runner.pending_by_replication = {}
+		self.running_here = mock.patch.object(self.runner, "is_running_here", return_value = True)
+		self.running_here.start()
+		from .host_health import HostHealth
+		self.hosts_up = mock.patch.object(HostHealth, "get_cached", return_value = True)
+		self.hosts_up.start()
+	
+	
+	def tearDown(self):
+		self.running_here.stop()
+		self.hosts_up.stop()
+		# cached settings outlive rollback of test
+		Settings.clear_cache()
+		from .path_index import PathClaimIndex
+		self.runner.tasks = {}
+		self.runner.queue = []
+		self.runner.recent_tasks.clear()
+		self.runner.path_index = PathClaimIndex()
+		self.runner.running_count = 0
+		self.runner.running_on_host = {}
+		self.runner.abandoned_count = 0
+	
+	
+	def test_dispatch_pending_tasks_launches_without_delay(self):
+		import time
+		r1 = Replication.objects.create(name = "r1", src = "/tmp/src1/", dest = "/tmp/dest1/")
+		r2 = Replication.objects.create(name = "r2", src = "/tmp/src2/", dest = "/tmp/dest2/")
+		with mock.patch.object(self.runner, "submit_task") as launch:
+			self.runner.add_task_for_replication(r1)
+			self.runner.add_task_for_replication(r2)
+			time_start = time.monotonic()
+			launched = self.runner.dispatch_pending_tasks()
+			took = time.monotonic() - time_start
+		self.assertEqual(len(launched), 2)
+		self.assertEqual(launch.call_count, 2)
+		self.assertLess(took, 0.1)
+	
+	
+	def test_dispatch_pending_tasks_skips_blocked(self):
+		r1 = Replication.objects.create(name = "r1", src = "/tmp/src1/", dest = "/tmp/dest1/")
+		r2 = Replication.objects.create(name = "r2", src = "/tmp/dest1/", dest = "/tmp/dest2/")
+		with mock.patch.object(self.runner, "submit_task"):
+			t1 = self.runner.add_task_for_replication(r1)
+			t2 = self.runner.add_task_for_replication(r2)
+			launched = self.runner.dispatch_pending_tasks()
+		self.assertEqual([s.id for s in launched], [t1.id])
+		self.assertFalse(self.runner.tasks[t2.id].running)
+	
+	
+	def test_finished_tasks_are_evicted_to_bounded_history(self):
+		r1 = Replication.objects.create(name = "r1", src = "/tmp/src1/", dest = "/tmp/dest1/")
+		with mock.patch.object(self.runner, "submit_task"):
+			for i in range(self.runner.recent_tasks.maxlen + 10):
+				self.runner.add_task_for_replication(r1)
+				for state in self.runner.dispatch_pending_tasks():
+					self.runner.on_task_finished(state)
+		self.assertEqual(len(self.runner.tasks), 0)
+		self.assertEqual(len(self.runner.recent_tasks), self.runner.recent_tasks.maxlen)
+	
+	
+	def test_cancel_pending_task(self):
+		r1 = Replication.objects.create(name = "r1", src = "/tmp/src1/", dest = "/tmp/dest1/")
+		t1 = self.runner.add_task_for_replication(r1)
+		self.assertTrue(self.runner.cancel_replication_task(t1))
+		self.assertNotIn(t1.id, self.runner.tasks)
+		self.assertTrue(ReplicationTask.objects.get(pk = t1.id).cancelled)
+	
+	
+	def test_dispatch_order_by_priority(self):
+		settings = Settings.get_settings()
+		settings.max_running_tasks = 1
+		settings.save()
+		r_low = Replication.objects.create(name = "r_low", src = "/tmp/src1/", dest = "/tmp/dest1/", priority = Replication.PRIORITY_LOW)
+		r_high = Replication.objects.create(name = "r_high", src = "/tmp/src2/", dest = "/tmp/dest2/", priority = Replication.PRIORITY_HIGH)
+		with mock.patch.object(self.runner, "submit_task"):
+			self.runner.add_task_for_replication(r_low)
+			t_high = self.runner.add_task_for_replication(r_high)
+			launched = self.runner.dispatch_pending_tasks()
+		self.assertEqual([s.id for s in launched], [t_high.id])
+	
+	
+	def test_dispatch_low_priority_task_ages(self):
+		import datetime
+		from django.utils import timezone
+		settings = Settings.get_settings()
+		settings.max_running_tasks = 1
+		settings.save()
+		r_low = Replication.objects.create(name = "r_low", src = "/tmp/src1/", dest = "/tmp/dest1/", priority = Replication.PRIORITY_LOW)
+		r_normal = Replication.objects.create(name = "r_normal", src = "/tmp/src2/", dest = "/tmp/dest2/")
+		with mock.patch.object(self.runner, "submit_task"):
+			t_low = self.runner.add_task_for_replication(r_low)
+			state = self.runner.tasks[t_low.id]
+			# low priority task waits for 2 hours already
+			self.runner.queue = []
+			state.sort_key = None
+			state.date_created = timezone.now() - datetime.timedelta(hours = 2)
+			self.runner.enqueue_task_state(state)
+			self.runner.add_task_for_replication(r_normal)
+			launched = self.runner.dispatch_pending_tasks()
+		self.assertEqual([s.id for s in launched], [t_low.id])
+	
+	
+	def test_task_fails_when_host_stays_down(self):
+		from .host_health import HostHealth
+		r1 = Replication.objects.create(name = "r1", src = "/tmp/src1/", dest = "nas1:/dest1/", retries = 2)
+		with mock.patch.object(self.runner, "submit_task"), mock.patch.object(HostHealth, "get_cached", return_value = False), \
+			mock.patch.object(HostHealth, "get_down_seconds", return_value = 30.0):
+			t1 = self.runner.add_task_for_replication(r1)
+			state = self.runner.tasks[t1.id]
+			for i in range(2):
+				self.assertEqual(self.runner.dispatch_pending_tasks(), [])
+				self.assertIsNotNone(state.not_before)
+				# open circuit of host expired
+				state.not_before = None
+			self.assertEqual(self.runner.dispatch_pending_tasks(), [])
+		self.assertNotIn(t1.id, self.runner.tasks)
+		t1.refresh_from_db()
+		self.assertTrue(t1.error and t1.complete)
+		self.assertIsNone(t1.start)
+		self.assertFalse(t1.pending)
+		self.assertEqual(t1.state, "complete, FAIL")
+		self.assertEqual(t1.get_retry_reason(), "remote host unreachable")
+		self.assertEqual(self.runner.retry_candidate_ids, [t1.id])
+		# next trigger is not coalesced into failed task
+		self.assertNotEqual(self.runner.add_task_for_replication(r1).id, t1.id)
+	
+	
+	def test_bandwidth_is_rebalanced_when_task_waits(self):
+		settings = Settings.get_settings()
+		settings.bandwidth_budgets = "* = 50M"
+		settings.max_running_tasks = 4
+		settings.save()
+		r1 = Replication.objects.create(name = "r1", src = "/tmp/src1/", dest = "nas1:/dest1/")
+		r2 = Replication.objects.create(name = "r2", src = "/tmp/src2/", dest = "nas2:/dest2/")
+		with mock.patch.object(self.runner, "submit_task"):
+			t1 = self.runner.add_task_for_replication(r1)
+			self.assertEqual([s.bwlimit for s in self.runner.dispatch_pending_tasks()], [6103])
+			t2 = self.runner.add_task_for_replication(r2)
+			self.assertEqual(self.runner.dispatch_pending_tasks(), [])
+			self.runner.check_bandwidth_budgets()
+			state = self.runner.tasks[t1.id]
+			self.assertTrue(state.bandwidth_restart and state.control.cancelled)
+			self.runner.on_task_finished(state)
+			self.runner.requeue_preempted_tasks()
+			launched = self.runner.dispatch_pending_tasks()
+		self.assertEqual(sorted(s.replication_id for s in launched), [r1.id, r2.id])
+		self.assertEqual([s.bwlimit for s in launched], [3051, 3051])
+		self.assertIn(t2.id, [s.id for s in launched])
+		self.runner.check_bandwidth_budgets()
+		self.assertFalse(any(s.control.cancelled for s in launched))
+	
+	
+	def test_bandwidth_budget_change_restarts_task(self):
+		import datetime
+		settings = Settings.get_settings()
+		settings.bandwidth_budgets = "* 09:00-18:00 = 50M"
+		settings.max_running_tasks = 2
+		settings.save()
+		r1 = Replication.objects.create(name = "r1", src = "/tmp/src1/", dest = "nas1:/dest1/")
+		r2 = Replication.objects.create(name = "r2", src = "/tmp/src2/", dest = "nas2:/dest2/")
+		with mock.patch.object(self.runner, "submit_task"), mock.patch("replicator.base.timezone.localtime", return_value = datetime.datetime(2024, 1, 1, 8, 59)):
+			t1 = self.runner.add_task_for_replication(r1)
+			self.runner.add_task_for_replication(r2)
+			launched = self.runner.dispatch_pending_tasks()
+			self.runner.check_bandwidth_budgets()
+		self.assertEqual([s.bwlimit for s in launched], [None, None])
+		self.assertFalse(any(s.control.cancelled for s in launched))
+		with mock.patch("replicator.base.timezone.localtime", return_value = datetime.datetime(2024, 1, 1, 9, 0)):
+			self.runner.check_bandwidth_budgets()
+		self.assertTrue(all(s.bandwidth_restart and s.control.cancelled for s in launched))
+		state = self.runner.tasks[t1.id]
+		self.runner.on_task_finished(state)
+		self.assertEqual(self.runner.requeue_replication_ids, [r1.id])
+		self.assertEqual(self.runner.retry_candidate_ids, [])
+	
+	
+	def test_dispatch_shortest_expected_task_first(self):
+		settings = Settings.get_settings()
+		settings.max_running_tasks = 1
+		settings.save()
+		r_long = Replication.objects.create(name = "r_long", src = "/tmp/src1/", dest = "/tmp/dest1/", est_duration_s = 1200, est_duration_dev_s = 60, est_samples = 5)
+		r_short = Replication.objects.create(name = "r_short", src = "/tmp/src2/", dest = "/tmp/dest2/", est_duration_s = 30, est_duration_dev_s = 5, est_samples = 5)
+		with mock.patch.object(self.runner, "submit_task"):
+			self.runner.add_task_for_replication(r_long)
+			t_short = self.runner.add_task_for_replication(r_short)
+			launched = self.runner.dispatch_pending_tasks()
+		self.assertEqual([s.id for s in launched], [t_short.id])
+	
+	
+	def test_short_task_does_not_wait_behind_queued_long_tasks(self):
+		import datetime
+		settings = Settings.get_settings()
+		settings.max_running_tasks = 1
+		settings.save()
+		long_tasks = []
+		for i in range(3):
+			r = Replication.objects.create(name = f"r_long{i}", src = f"/tmp/src{i}/", dest = f"/tmp/dest{i}/", est_duration_s = 7200, est_duration_dev_s = 60, est_samples = 5)
+			long_tasks.append(self.runner.add_task_for_replication(r))
+		r_short = Replication.objects.create(name = "r_short", src = "/tmp/src9/", dest = "/tmp/dest9/", est_duration_s = 20, est_duration_dev_s = 2, est_samples = 5)
+		t_short = self.runner.add_task_for_replication(r_short)
+		# short task was triggered a minute after long ones
+		self.runner.queue = []
+		for t in long_tasks:
+			state = self.runner.tasks[t.id]
+			state.sort_key = None
+			state.date_created -= datetime.timedelta(minutes = 1)
+			self.runner.enqueue_task_state(state)
+		self.runner.enqueue_task_state(self.runner.tasks[t_short.id])
+		with mock.patch.object(self.runner, "submit_task"):
+			launched = self.runner.dispatch_pending_tasks()
+		self.assertEqual([s.id for s in launched], [t_short.id])
+	
+	
+	def test_long_high_priority_task_goes_before_short_normal_task(self):
+		settings = Settings.get_settings()
+		settings.max_running_tasks = 1
+		settings.save()
+		r_normal = Replication.objects.create(name = "r_normal", src = "/tmp/src1/", dest = "/tmp/dest1/", est_duration_s = 10, est_duration_dev_s = 1, est_samples = 5)
+		r_high = Replication.objects.create(name = "r_high", src = "/tmp/src2/", dest = "/tmp/dest2/", priority = Replication.PRIORITY_HIGH,
+			est_duration_s = 86400, est_duration_dev_s = 60, est_samples = 5)
+		with mock.patch.object(self.runner, "submit_task"):
+			self.runner.add_task_for_replication(r_normal)
+			t_high = self.runner.add_task_for_replication(r_high)
+			launched = self.runner.dispatch_pending_tasks()
+		self.assertEqual([s.id for s in launched], [t_high.id])
+		gaps = sorted(self.runner.PRIORITY_DELAY_S.values())
+		self.assertLess(self.runner.SJF_MAX_DELAY_S, min(b - a for a, b in zip(gaps, gaps[1:])))
+	
+	
+	def test_finished_task_updates_estimate(self):
+		import datetime
+		r1 = Replication.objects.create(name = "r1", src = "/tmp/src1/", dest = "/tmp/dest1/")
+		task = ReplicationTask.objects.create(replication = r1)
+		def run_steps(task):
+			task.start -= datetime.timedelta(seconds = 100)
+			task.OK = True
+			task.bytes_copied = 1000
+			return iter(())
+		with mock.patch.object(ReplicationTask, "run_checked_replication_steps", run_steps):
+			task.run()
+		r1 = Replication.objects.get(pk = r1.id)
+		self.assertAlmostEqual(r1.est_duration_s, 100, delta = 1)
+		self.assertEqual((r1.est_bytes, r1.est_samples), (1000, 1))
+		self.assertEqual(r1.get_timeout_s(), 0)
+	
+	
+	def test_load_queued_tasks_from_other_process(self):
+		r1 = Replication.objects.create(name = "r1", src = "/tmp/src1/", dest = "/tmp/dest1/")
+		r2 = Replication.objects.create(name = "r2", src = "/tmp/src2/", dest = "/tmp/dest2/")
+		with mock.patch.object(self.runner, "is_running_here", return_value = False):
+			t1 = self.runner.add_task_for_replication(r1)
+			t2 = self.runner.add_task_for_replication(r2)
+		self.assertEqual(len(self.runner.tasks), 0)
+		self.assertEqual(self.runner.load_queued_tasks(), 2)
+		self.assertEqual(set(self.runner.tasks), {t1.id, t2.id})
+		self.assertEqual(self.runner.load_queued_tasks(), 0)
+		with mock.patch.object(self.runner, "is_running_here", return_value = False):
+			self.assertTrue(self.runner.cancel_replication_task(t2))
+		self.assertEqual(self.runner.load_queued_tasks(), 1)
+		self.assertEqual(set(self.runner.tasks), {t1.id})
+	
+	
+	def test_recover_interrupted_tasks(self):
+		r1 = Replication.objects.create(name = "r1", src = "/tmp/src1/", dest = "/tmp/dest1/")
+		t1 = ReplicationTask.objects.create(replication = r1, running = True)
+		self.runner.recover_interrupted_tasks()
+		t1.refresh_from_db()
+		self.assertFalse(t1.running)
+		self.assertTrue(t1.complete)
+		self.assertTrue(t1.error)
+	
+	
+	def test_wakeup_sets_dispatch_required(self):
+		self.runner.dispatch_required = False
+		self.runner.wakeup()
+		self.assertTrue(self.runner.dispatch_required)
+
+	
+	def test_dispatch_pending_tasks_keeps_order_of_blocked(self):
+		r1 = Replication.objects.create(name = "r1", src = "/tmp/src1/", dest = "/tmp/dest1/")
+		r2 = Replication.objects.create(name = "r2", src = "/tmp/dest1/", dest = "/tmp/dest2/")
+		r3 = Replication.objects.create(name = "r3", src = "/tmp/src3/", dest = "/tmp/dest2/sub")
+		with mock.patch.object(self.runner, "submit_task"):
+			t1 = self.runner.add_task_for_replication(r1)
+			t2 = self.runner.add_task_for_replication(r2)
+			t3 = self.runner.add_task_for_replication(r3)
+			launched = self.runner.dispatch_pending_tasks()
+		self.assertEqual([s.id for s in launched], [t1.id])
+		s1 = self.runner.tasks[t1.id]
+		s2 = self.runner.tasks[t2.id]
+		self.assertEqual(self.runner.find_blockers_for_task(s2), [s1])
+		self.runner.on_task_finished(s1)
+		self.assertEqual(self.runner.find_blockers_for_task(s2), [])
+	
+	
+	def test_dispatch_pending_tasks_respects_slot_limits(self):
+		settings = Settings.get_settings()
+		settings.max_running_tasks = 3
+		settings.max_tasks_per_host = 1
+		settings.host_limits = "nas2 = 2"
+		settings.save()
+		r1 = Replication.objects.create(name = "r1", src = "/tmp/src1/", dest = "nas1:/dest1/")
+		r2 = Replication.objects.create(name = "r2", src = "/tmp/src2/", dest = "nas1:/dest2/")
+		r3 = Replication.objects.create(name = "r3", src = "/tmp/src3/", dest = "nas2:/dest3/")
+		r4 = Replication.objects.create(name = "r4", src = "/tmp/src4/", dest = "nas2:/dest4/")
+		r5 = Replication.objects.create(name = "r5", src = "/tmp/src5/", dest = "/tmp/dest5/")
+		with mock.patch.object(self.runner, "submit_task"):
+			tasks = [self.runner.add_task_for_replication(r) for r in (r1, r2, r3, r4, r5)]
+			launched = self.runner.dispatch_pending_tasks()
+			self.assertEqual([s.id for s in launched], [tasks[0].id, tasks[2].id, tasks[3].id])
+			self.runner.on_task_finished(launched[0])
+			launched = self.runner.dispatch_pending_tasks()
+			self.assertEqual([s.id for s in launched], [tasks[1].id])
+	
+	
+	def test_cancel_running_task_terminates_its_processes(self):
+		r1 = Replication.objects.create(name = "r1", src = "/tmp/src1/", dest = "/tmp/dest1/")
+		with mock.patch.object(self.runner, "submit_task"):
+			t1 = self.runner.add_task_for_replication(r1)
+			state = self.runner.dispatch_pending_tasks()[0]
+		with mock.patch.object(state.control, "cancel") as cancel:
+			self.assertTrue(self.runner.cancel_replication_task(t1))
+			cancel.assert_called_once()
+		self.assertTrue(ReplicationTask.objects.get(pk = t1.id).cancel_requested)
+	
+	
+	def test_watchdog_kills_stalled_task_and_releases_it(self):
+		import time
+		r1 = Replication.objects.create(name = "r1", src = "/tmp/src1/", dest = "/tmp/dest1/", stall_timeout = 1)
+		r2 = Replication.objects.create(name = "r2", src = "/tmp/src2/", dest = "/tmp/dest1/sub/")
+		with mock.patch.object(self.runner, "submit_task"):
+			t1 = self.runner.add_task_for_replication(r1)
+			t2 = self.runner.add_task_for_replication(r2)
+			launched = self.runner.dispatch_pending_tasks()
+			self.assertEqual([s.id for s in launched], [t1.id])
+			stalled = launched[0]
+			stalled.control.last_activity = time.monotonic() - 30
+			self.runner.check_timeouts()
+			self.assertIn(t1.id, self.runner.tasks)
+			stalled.control.last_activity = time.monotonic() - 61
+			with mock.patch.object(stalled.control, "cancel") as cancel:
+				self.runner.check_timeouts()
+				cancel.assert_called_once()
+			self.assertNotIn(t1.id, self.runner.tasks)
+			self.assertEqual(self.runner.running_count, 0)
+			self.assertTrue(ReplicationTask.objects.get(pk = t1.id).error)
+			# blocked task is launched without waiting for worker of killed task
+			self.assertEqual([s.id for s in self.runner.dispatch_pending_tasks()], [t2.id])
+			self.runner.on_task_finished(stalled)
+		self.assertEqual(self.runner.abandoned_count, 0)
+		self.assertEqual(self.runner.running_count, 1)
+	
+	
+	def test_get_timeout_reason(self):
+		from .engine import ProcessControl
+		r1 = Replication.objects.create(name = "r1", src = "/tmp/src1/", dest = "/tmp/dest1/", timeout = 10, stall_timeout = 0)
+		t1 = ReplicationTask.objects.create(replication = r1)
+		from .base import TaskState
+		state = TaskState(t1)
+		state.control = ProcessControl()
+		state.launched_at = 0.0
+		self.assertIsNone(self.runner.get_timeout_reason(state, 599.0))
+		self.assertIn("timeout", self.runner.get_timeout_reason(state, 601.0))
+		state.control.suspended_s = 100.0
+		self.assertIsNone(self.runner.get_timeout_reason(state, 601.0))
+	
+	
+	def test_transient_failure_is_retried_with_backoff(self):
+		import datetime
+		from django.utils import timezone
+		r1 = Replication.objects.create(name = "r1", src = "/tmp/src1/", dest = "nas1:/dest1/", rsync_retries = 1, retry_delay = 100)
+		with mock.patch.object(self.runner, "submit_task"):
+			t1 = self.runner.add_task_for_replication(r1)
+			state = self.runner.dispatch_pending_tasks()[0]
+			ReplicationTask.objects.filter(pk = t1.id).update(error = True, returncode = 12, complete = True)
+			self.runner.on_task_finished(state, ReplicationTask.objects.get(pk = t1.id))
+			self.runner.schedule_retries()
+			retry = ReplicationTask.objects.get(retry_of = t1)
+			self.assertEqual(retry.attempt, 2)
+			self.assertGreaterEqual(retry.not_before, timezone.now() + datetime.timedelta(seconds = 49))
+			# retry waits until its not_before
+			self.assertEqual(self.runner.dispatch_pending_tasks(), [])
+			self.assertEqual(self.runner.deferred_until, retry.not_before)
+			self.runner.tasks[retry.id].not_before = timezone.now()
+			state = self.runner.dispatch_pending_tasks()[0]
+			self.assertEqual(state.id, retry.id)
+			# no retries left
+			ReplicationTask.objects.filter(pk = retry.id).update(error = True, returncode = 12, complete = True)
+			self.runner.on_task_finished(state, ReplicationTask.objects.get(pk = retry.id))
+			self.runner.schedule_retries()
+		self.assertEqual(ReplicationTask.objects.filter(replication = r1).count(), 2)
+	
+	
+	def test_permanent_failure_is_not_retried(self):
+		r1 = Replication.objects.create(name = "r1", src = "/tmp/src1/", dest = "nas1:/dest1/")
+		with mock.patch.object(self.runner, "submit_task"):
+			t1 = self.runner.add_task_for_replication(r1)
+			state = self.runner.dispatch_pending_tasks()[0]
+			ReplicationTask.objects.filter(pk = t1.id).update(error = True, returncode = 1, complete = True)
+			self.runner.on_task_finished(state, ReplicationTask.objects.get(pk = t1.id))
+			self.runner.schedule_retries()
+		self.assertEqual(ReplicationTask.objects.filter(replication = r1).count(), 1)
+	
+	
+	def test_task_for_host_known_down_is_deferred(self):
+		from .host_health import HostHealth
+		r1 = Replication.objects.create(name = "r1", src = "/tmp/src1/", dest = "nas1:/dest1/")
+		r2 = Replication.objects.create(name = "r2", src = "/tmp/src2/", dest = "nas2:/dest2/")
+		with mock.patch.object(self.runner, "submit_task"):
+			self.runner.add_task_for_replication(r1)
+			t2 = self.runner.add_task_for_replication(r2)
+			with mock.patch.object(HostHealth, "get_cached", side_effect = lambda host, port: host == "nas2"), mock.patch.object(HostHealth, "get_down_seconds", return_value = 30.0):
+				launched = self.runner.dispatch_pending_tasks()
+		self.assertEqual([s.id for s in launched], [t2.id])
+		self.assertIsNotNone(self.runner.deferred_until)
+	
+	
+	def test_tasks_to_host_with_warm_ssh_master_are_grouped(self):
+		from .ssh_pool import SshControlPool
+		settings = Settings.get_settings()
+		settings.max_running_tasks = 1
+		settings.save()
+		r1 = Replication.objects.create(name = "r1", src = "/tmp/src1/", dest = "nas1:/dest1/")
+		r2 = Replication.objects.create(name = "r2", src = "/tmp/src2/", dest = "nas2:/dest2/")
+		with mock.patch.object(self.runner, "submit_task"), mock.patch.object(SshControlPool, "is_warm", side_effect = lambda host: host == "nas2"):
+			t1 = self.runner.add_task_for_replication(r1)
+			t2 = self.runner.add_task_for_replication(r2)
+			self.assertEqual([s.id for s in self.runner.dispatch_pending_tasks()], [t2.id])
+	
+	
+	def test_preemption_suspends_lower_priority_task(self):
+		settings = Settings.get_settings()
+		settings.max_tasks_per_host = 1
+		settings.preemption_mode = Settings.PREEMPTION_SUSPEND
+		settings.save()
+		r_low = Replication.objects.create(name = "low", src = "/tmp/src1/", dest = "nas1:/dest1/", priority = Replication.PRIORITY_LOW)
+		r_high = Replication.objects.create(name = "high", src = "/tmp/src2/", dest = "nas1:/dest2/", priority = Replication.PRIORITY_HIGH)
+		with mock.patch.object(self.runner, "submit_task"):
+			self.runner.add_task_for_replication(r_low)
+			low = self.runner.dispatch_pending_tasks()[0]
+			low.control = mock.Mock(cancelled = False)
+			self.runner.add_task_for_replication(r_high)
+			high = self.runner.dispatch_pending_tasks()[0]
+		self.assertEqual(high.replication_id, r_high.id)
+		low.control.suspend.assert_called_once()
+		self.assertEqual(low.suspended_by, high.id)
+		self.assertEqual(self.runner.running_on_host["nas1"], 1)
+		self.runner.on_task_finished(high)
+		low.control.resume.assert_called_once()
+		self.assertIsNone(low.suspended_by)
+		self.assertEqual(self.runner.running_on_host["nas1"], 1)
+	
+	
+	def test_preemption_cancels_and_requeues_lower_priority_task(self):
+		settings = Settings.get_settings()
+		settings.max_tasks_per_host = 1
+		settings.preemption_mode = Settings.PREEMPTION_CANCEL
+		settings.save()
+		r_low = Replication.objects.create(name = "low", src = "/tmp/src1/", dest = "nas1:/dest1/", priority = Replication.PRIORITY_LOW)
+		r_high = Replication.objects.create(name = "high", src = "/tmp/src2/", dest = "nas1:/dest2/", priority = Replication.PRIORITY_HIGH)
+		with mock.patch.object(self.runner, "submit_task"):
+			self.runner.add_task_for_replication(r_low)
+			low = self.runner.dispatch_pending_tasks()[0]
+			low.control = mock.Mock(cancelled = False)
+			self.runner.add_task_for_replication(r_high)
+			self.assertEqual(self.runner.dispatch_pending_tasks(), [])
+			low.control.cancel.assert_called_once()
+			# high priority task is launched after cancelled task terminates
+			self.runner.on_task_finished(low)
+			launched = self.runner.dispatch_pending_tasks()
+			self.assertEqual([s.replication_id for s in launched], [r_high.id])
+			self.runner.requeue_preempted_tasks()
+		self.assertEqual(ReplicationTask.objects.filter(replication = r_low).count(), 2)
+	
+	
+	def test_trigger_is_coalesced_into_pending_task(self):
+		r1 = Replication.objects.create(name = "r1", src = "/tmp/src1/", dest = "/tmp/dest1/")
+		with mock.patch.object(self.runner, "submit_task"):
+			t1 = self.runner.add_task_for_replication(r1)
+			with self.assertNumQueries(0):
+				self.assertIsNone(self.runner.add_task_for_replication(r1))
+				self.assertIsNone(self.runner.add_task_for_replication(r1))
+			self.assertEqual(ReplicationTask.objects.filter(replication = r1).count(), 1)
+			state = self.runner.dispatch_pending_tasks()[0]
+			self.assertEqual(state.coalesced_count, 2)
+			# task is running, next trigger queues new task
+			t2 = self.runner.add_task_for_replication(r1)
+		self.assertNotEqual(t2.id, t1.id)
+		with mock.patch.object(ReplicationTask, "run_checked_replication_steps", lambda task: iter(())):
+			self.runner._run_task(state)
+		self.assertEqual(ReplicationTask.objects.get(pk = t1.id).coalesced_count, 2)
+	
+	
+	def test_trigger_is_coalesced_in_db_queue(self):
+		r1 = Replication.objects.create(name = "r1", src = "/tmp/src1/", dest = "/tmp/dest1/")
+		with mock.patch.object(self.runner, "is_running_here", return_value = False):
+			t1 = self.runner.add_task_for_replication(r1)
+			self.assertIsNone(self.runner.add_task_for_replication(r1))
+		t1.refresh_from_db()
+		self.assertEqual(t1.coalesced_count, 1)
+		self.assertEqual(ReplicationTask.objects.filter(replication = r1).count(), 1)
+	
+	
+	def test_burst_of_triggers_is_one_insert(self):
+		from django.db import connection
+		from django.test.utils import CaptureQueriesContext
+		replications = [Replication.objects.create(name = f"r{i}", src = f"/tmp/src{i}/", dest = f"/tmp/dest{i}/") for i in range(5)]
+		pending = self.runner.add_task_for_replication(replications[0])
+		triggers = [(r, None) for r in replications] + [(replications[1], None)]
+		with CaptureQueriesContext(connection) as queries:
+			tasks = self.runner.add_tasks_for_replications(triggers)
+		inserts = [q for q in queries.captured_queries if q["sql"].startswith("INSERT")]
+		if connection.features.can_return_rows_from_bulk_insert:
+			self.assertEqual(len(inserts), 1)
+		self.assertEqual([t.replication.name for t in tasks], ["r1", "r2", "r3", "r4"])
+		self.assertTrue(all(t.id is not None for t in tasks))
+		self.assertEqual(tasks[0].coalesced_count, 1)
+		self.assertEqual(self.runner.tasks[pending.id].coalesced_count, 1)
+		self.assertEqual(len(self.runner.queue), 5)
+	
+	
+	def test_batch_follower_waits_for_leader(self):
+		leader = Replication.objects.create(name = "leader", src = "/tmp/src1/", dest = "/tmp/dest1/")
+		Replication.objects.create(name = "follower", src = "/tmp/src1/", dest = "/tmp/dest2/", batch_leader = leader)
+		Replication.objects.create(name = "other options", src = "/tmp/src1/", dest = "/tmp/dest3/", options = "-a", batch_leader = leader)
+		with mock.patch.object(self.runner, "submit_task"):
+			t1 = self.runner.add_task_for_replication(leader)
+			follower_tasks = list(t1.batch_tasks.all())
+			self.assertEqual([t.replication.name for t in follower_tasks], ["follower"])
+			launched = self.runner.dispatch_pending_tasks()
+			self.assertEqual([s.id for s in launched], [t1.id])
+			self.runner.on_task_finished(launched[0])
+			launched = self.runner.dispatch_pending_tasks()
+		self.assertEqual([s.id for s in launched], [follower_tasks[0].id])
+
+
+
+class PathClaimIndexTests(TestCase):
+	
+	def test_split_location(self):
+		from .path_index import split_location
+		self.assertEqual(split_location("/data/a/"), (None, ("data", "a")))
+		self.assertEqual(split_location("root@host1:/data//a"), ("host1", ("data", "a")))
+		self.assertEqual(split_location("host1::module/a"), ("host1", ("::module", "a")))
+		self.assertEqual(split_location("rsync://root@host1/module/a"), ("host1", ("::module", "a")))
+	
+	
+	def test_sibling_with_common_prefix_does_not_overlap(self):
+		from .path_index import PathClaimIndex, DEST
+		index = PathClaimIndex()
+		index.add("t1", "/data", DEST)
+		self.assertEqual(index.find_overlapping("/data2", DEST), set())
+		self.assertEqual(index.find_overlapping("/data/sub", DEST), {"t1"})
+		self.assertEqual(index.find_overlapping("/", DEST), {"t1"})
+	
+	
+	def test_hosts_are_separated(self):
+		from .path_index import PathClaimIndex, DEST
+		index = PathClaimIndex()
+		index.add("t1", "host1:/data", DEST)
+		self.assertEqual(index.find_overlapping("/data", DEST), set())
+		self.assertEqual(index.find_overlapping("user@host1:/data/a", DEST), {"t1"})
+	
+	
+	def test_find_conflicts(self):
+		from .path_index import PathClaimIndex
+		index = PathClaimIndex()
+		index.add_task_claims("t1", "/src1", "/dest1")
+		# reading the same src is not a conflict
+		self.assertEqual(index.find_conflicts("/src1", "/dest2"), set())
+		# our dest overwrites their src
+		self.assertEqual(index.find_conflicts("/src2", "/src1/sub"), {"t1"})
+		# their dest overwrites our src
+		self.assertEqual(index.find_conflicts("/dest1/sub", "/dest3"), {"t1"})
+	
+	
+	def test_remove_prunes_index(self):
+		from .path_index import PathClaimIndex
+		index = PathClaimIndex()
+		index.add_task_claims("t1", "/src1/a/b", "/dest1/a/b")
+		index.remove_task_claims("t1", "/src1/a/b", "/dest1/a/b")
+		self.assertEqual(len(index), 0)
+		self.assertEqual(index.roots, {})
+
+
+
+class HostHealthTests(TestCase):
+	
+	def setUp(self):
+		from .host_health import HostHealth
+		HostHealth.reset()
+	
+	
+	def tearDown(self):
+		from .host_health import HostHealth
+		HostHealth.reset()
+	
+	
+	def test_get_probe_target(self):
+		from .host_health import get_probe_target
+		self.assertEqual(get_probe_target("user@nas1:/data/"), ("nas1", 22))
+		self.assertEqual(get_probe_target("nas1:/data/", "-axv -e 'ssh -p 2222'"), ("nas1", 2222))
+		self.assertEqual(get_probe_target("nas1::backup/"), ("nas1", 873))
+		self.assertEqual(get_probe_target("rsync://user@nas1:8873/backup/"), ("nas1", 8873))
+		self.assertIsNone(get_probe_target("/data/"))
+	
+	
+	def test_probe_is_cached_and_circuit_opens(self):
+		import socket
+		from .host_health import HostHealth
+		listener = socket.socket()
+		listener.bind(("127.0.0.1", 0))
+		listener.listen()
+		port = listener.getsockname()[1]
+		try:
+			self.assertIs(HostHealth.check("127.0.0.1", port), True)
+			self.assertIs(HostHealth.get_cached("127.0.0.1", port), True)
+		finally:
+			listener.close()
+		self.assertIs(HostHealth.check("127.0.0.1", port), True)
+		HostHealth.statuses.clear()
+		self.assertIs(HostHealth.check("127.0.0.1", port), False)
+		self.assertGreater(HostHealth.get_down_seconds("127.0.0.1", port), 0)
+		with mock.patch("socket.create_connection") as create_connection:
+			self.assertIs(HostHealth.check("127.0.0.1", port), False)
+			create_connection.assert_not_called()
+	
+	
+	def test_concurrent_probes_of_host_are_shared(self):
+		import time
+		from .host_health import HostHealth
+		def slow_connection(*args, **kwargs):
+			time.sleep(0.2)
+			raise OSError("no route to host")
+		with mock.patch("socket.create_connection", side_effect = slow_connection) as create_connection:
+			futures = [HostHealth.probe("nas1", 22) for i in range(10)]
+			self.assertEqual([f.result() for f in futures], [False] * 10)
+			self.assertEqual(create_connection.call_count, 1)
+
+
+
+class SshControlPoolTests(TestCase):
+	
+	def setUp(self):
+		import tempfile
+		from .ssh_pool import SshControlPool
+		self.sockets_dir = tempfile.TemporaryDirectory()
+		SshControlPool.sockets_dir = self.sockets_dir.name
+		SshControlPool.warm_until = {}
+		SshControlPool.handshake_s = {}
+	
+	
+	def tearDown(self):
+		from .ssh_pool import SshControlPool
+		SshControlPool.sockets_dir = None
+		SshControlPool.warm_until = {}
+		SshControlPool.handshake_s = {}
+		self.sockets_dir.cleanup()
+	
+	
+	def test_get_ssh_target(self):
+		from .ssh_pool import get_ssh_target
+		self.assertEqual(get_ssh_target("user@nas1:/data/"), ("user", "nas1", 22))
+		self.assertEqual(get_ssh_target("nas1:/data/", "-axv -e 'ssh -p 2222'"), (None, "nas1", 2222))
+		self.assertIsNone(get_ssh_target("nas1::backup/"))
+		self.assertIsNone(get_ssh_target("/data/"))
+	
+	
+	def test_master_is_opened_once_and_reused(self):
+		import subprocess
+		from .ssh_pool import SshControlPool
+		def run(args, **kwargs):
+			if "-M" in args:
+				# master creates its socket
+				open(args[args.index("-o") + 1].partition("=")[2], "w").close()
+			return subprocess.CompletedProcess(args, 0)
+		with mock.patch("subprocess.run", side_effect = run) as run_mock:
+			master = SshControlPool.open_master("user", "nas1", 22, 600)
+			self.assertFalse(master.reused)
+			self.assertTrue(SshControlPool.is_warm("nas1"))
+			master = SshControlPool.open_master("user", "nas1", 22, 600)
+			self.assertTrue(master.reused)
+			self.assertEqual(len([c for c in run_mock.call_args_list if "-M" in c.args[0]]), 1)
+		self.assertEqual(SshControlPool.list_sockets(), ["user@nas1:22"])
+		self.assertIn("ControlMaster=no", master.get_ssh_command(22))
+	
+	
+	def test_rsync_uses_master(self):
+		from .ssh_pool import SshMaster
+		r1 = Replication(name = "r1", src = "/tmp/src1/", dest = "nas1:/dest1/")
+		task = ReplicationTask(replication = r1)
+		task.ssh_master = SshMaster("/tmp/dfrsync-ssh/nas1:22", True, 0.5)
+		options = task.get_rsync_extra_options()
+		self.assertEqual(options[options.index("-e") + 1], "ssh -o ControlPath=/tmp/dfrsync-ssh/nas1:22 -o ControlMaster=no")
+
+
+
+class RsyncErrorsTests(TestCase):
+	
+	def test_classify_failure(self):
+		from .rsync_errors import classify_failure
+		self.assertTrue(classify_failure(12, "rsync: connection unexpectedly closed")[0])
+		self.assertTrue(classify_failure(30, "")[0])
+		self.assertFalse(classify_failure(1, "rsync: connection unexpectedly closed")[0])
+		self.assertFalse(classify_failure(255, "user@nas1: Permission denied (publickey,password).")[0])
+		self.assertTrue(classify_failure(255, "ssh: connect to host nas1 port 22: No route to host")[0])
+		self.assertFalse(classify_failure(23, "rsync: send_files failed to open \"/data/a\": Permission denied (13)")[0])
+		self.assertTrue(classify_failure(23, "rsync: read errors mapping \"/mnt/nfs/a\": Stale file handle (116)")[0])
+	
+	
+	def test_retry_delay_grows_with_attempt(self):
+		r1 = Replication(name = "r1", src = "/tmp/src1/", dest = "nas1:/dest1/", retry_delay = 60)
+		for attempt, cap in ((1, 60), (2, 120), (3, 240), (10, Replication.MAX_RETRY_DELAY_S)):
+			delay = r1.get_retry_delay(attempt)
+			self.assertGreaterEqual(delay, cap / 2)
+			self.assertLessEqual(delay, cap)
+	
+	
+	def test_partial_dir_option(self):
+		r1 = Replication(name = "r1", src = "/tmp/src1/", dest = "nas1:/dest1/")
+		self.assertIn("--partial-dir=.rsync-partial", ReplicationTask(replication = r1).get_rsync_extra_options())
+		r1.options = "-axv --partial"
+		self.assertNotIn("--partial-dir=.rsync-partial", ReplicationTask(replication = r1).get_rsync_extra_options())
+
+
+
+class BandwidthTests(TestCase):
+	
+	def test_parse_rules(self):
+		from .bandwidth import BudgetRule, parse_rate
+		self.assertEqual(parse_rate("50M"), 50000000)
+		self.assertEqual(parse_rate("1.5Gbit/s"), 1500000000)
+		self.assertIsNone(parse_rate("0"))
+		rules = BudgetRule.parse_rules("* = 200M\n* 09:00-18:00 = 50M\nnas1 22:00-06:00 = 0\ninvalid line")
+		self.assertEqual([(r.scope, r.window, r.rate_bps) for r in rules],
+			[("*", None, 200000000), ("*", (540, 1080), 50000000), ("nas1", (1320, 360), None)])
+	
+	
+	def test_get_budget_by_time_of_day(self):
+		import datetime
+		from .bandwidth import BudgetRule, GLOBAL
+		rules = BudgetRule.parse_rules("* 09:00-18:00 = 50M\nnas1 = 20M\nnas1 22:00-06:00 = 0")
+		self.assertEqual(BudgetRule.get_budget(rules, GLOBAL, datetime.time(10, 0)), 50000000)
+		self.assertIsNone(BudgetRule.get_budget(rules, GLOBAL, datetime.time(20, 0)))
+		self.assertEqual(BudgetRule.get_budget(rules, "nas1", datetime.time(12, 0)), 20000000)
+		self.assertIsNone(BudgetRule.get_budget(rules, "nas1", datetime.time(23, 30)))
+	
+	
+	def test_budget_is_split_between_tasks(self):
+		import datetime
+		from .bandwidth import BandwidthManager, BudgetRule
+		rules = BudgetRule.parse_rules("* = 100M\nnas2 = 10M")
+		now = datetime.time(12, 0)
+		manager = BandwidthManager()
+		hosts = {0: "nas1", 1: "nas2", 2: "nas1", 3: "nas2", 4: "nas1"}
+		manager.set_demand(hosts)
+		# 5 tasks contend, but only 4 run at once
+		shares = [manager.allocate(i, hosts[i], rules, now, max_running_tasks = 4, host_limit = 2 if hosts[i] == "nas2" else 0) for i in range(4)]
+		self.assertEqual(shares, [25000000, 5000000, 25000000, 5000000])
+		self.assertLessEqual(manager.get_scope_usage("*")[1], 100000000)
+		self.assertLessEqual(manager.get_scope_usage("nas2")[1], 10000000)
+		self.assertEqual(manager.get_outdated(rules, now, max_running_tasks = 4), [])
+		self.assertIsNone(manager.allocate(5, None, rules, now, max_running_tasks = 4))
+	
+	
+	def test_budget_is_rebalanced_between_active_tasks(self):
+		import datetime
+		from .bandwidth import BandwidthManager, BudgetRule
+		rules = BudgetRule.parse_rules("* = 50M")
+		now = datetime.time(12, 0)
+		manager = BandwidthManager()
+		# task alone gets whole budget
+		self.assertEqual(manager.allocate(1, "nas1", rules, now, max_running_tasks = 4), 50000000)
+		self.assertEqual(manager.get_outdated(rules, now, max_running_tasks = 4), [])
+		# waiting task does not get bandwidth of running task, running task should be restarted with its share
+		manager.set_demand({2: "nas2"})
+		self.assertEqual(manager.get_rate(2, "nas2", rules, now, max_running_tasks = 4), 0)
+		self.assertEqual(manager.allocate(2, "nas2", rules, now, max_running_tasks = 4), 0)
+		self.assertEqual(manager.get_outdated(rules, now, max_running_tasks = 4), [1])
+		manager.release(1)
+		manager.set_demand({2: "nas2", 3: "nas1"})
+		self.assertEqual([manager.allocate(i, host, rules, now, max_running_tasks = 4) for i, host in ((2, "nas2"), (3, "nas1"))], [25000000, 25000000])
+		self.assertEqual(manager.get_outdated(rules, now, max_running_tasks = 4), [])
+		# share of task left alone grows, it should be restarted to use it
+		manager.release(3)
+		self.assertEqual(manager.get_outdated(rules, now, max_running_tasks = 4), [2])
+	
+	
+	def test_allocation_is_outdated_by_window_change(self):
+		import datetime
+		from .bandwidth import BandwidthManager, BudgetRule
+		rules = BudgetRule.parse_rules("* 09:00-18:00 = 50M")
+		manager = BandwidthManager()
+		self.assertIsNone(manager.allocate(1, "nas1", rules, datetime.time(8, 59), max_running_tasks = 2))
+		self.assertEqual(manager.get_outdated(rules, datetime.time(8, 59)), [])
+		self.assertEqual(manager.get_outdated(rules, datetime.time(9, 0)), [1])
+	
+	
+	def test_bwlimit_option(self):
+		r1 = Replication(name = "r1", src = "/tmp/src1/", dest = "nas1:/dest1/")
+		task = ReplicationTask(replication = r1, bwlimit = 6103)
+		self.assertIn("--bwlimit=6103", task.get_rsync_extra_options())
+		r1.options = "-axv --bwlimit=1000"
+		self.assertNotIn("--bwlimit=6103", task.get_rsync_extra_options())
+
+
+
+class EngineTests(TestCase):
+	
+	def test_run_steps(self):
+		from .engine import RunCommand, run_steps
+		def steps():
+			output, returncode = yield RunCommand("echo hello")
+			return output.strip(), returncode
+		self.assertEqual(run_steps(steps()), ("hello", 0))
+	
+	
+	def test_run_steps_throws_errors_into_steps(self):
+		from .engine import RunCommand, run_steps
+		def steps():
+			try:
+				yield RunCommand("/nonexistent/command")
+			except FileNotFoundError:
+				return "error"
+			return "ok"
+		self.assertEqual(run_steps(steps()), "error")
+	
+	
+	def test_run_pre_cmd(self):
+		test_r = Replication(src = "/tmp/", dest = "/temp2/", pre_cmd = "true")
+		self.assertIs(ReplicationTask(replication = test_r).run_pre_cmd(), True)
+		test_r = Replication(src = "/tmp/", dest = "/temp2/", pre_cmd = "false")
+		test_rt = ReplicationTask(replication = test_r)
+		self.assertIs(test_rt.run_pre_cmd(), False)
+		self.assertIn("NON_ZERO_RETURNCODE", test_rt.error_text)
+	
+	
+	def test_process_control_cancel_terminates_command(self):
+		import time
+		import threading
+		from .engine import ProcessControl, RunCommand, TaskCancelled, run_steps
+		control = ProcessControl()
+		def steps():
+			try:
+				yield RunCommand("sleep 30", control = control)
+			except TaskCancelled as e:
+				return str(e)
+			return "not cancelled"
+		threading.Timer(0.5, control.cancel, kwargs = {"reason": "test"}).start()
+		time_start = time.monotonic()
+		self.assertEqual(run_steps(steps()), "test")
+		self.assertLess(time.monotonic() - time_start, 10.0)
+		self.assertEqual(control.pids, set())
+	
+	
+	def test_asyncio_engine_runs_commands_concurrently_in_one_thread(self):
+		import time
+		import threading
+		from .engine import AsyncioEngine, RunCommand, Sleep, run_steps_async
+		def steps():
+			yield Sleep(0.1)
+			output, returncode = yield RunCommand("sleep 0.5")
+			return returncode
+		AsyncioEngine.get_loop()
+		threads_before = threading.active_count()
+		time_start = time.monotonic()
+		futures = [AsyncioEngine.submit(run_steps_async(steps())) for i in range(30)]
+		time.sleep(0.3)
+		threads_running = threading.active_count()
+		results = [f.result(timeout = 10) for f in futures]
+		took = time.monotonic() - time_start
+		self.assertEqual(results, [0] * 30)
+		self.assertLess(took, 5.0)
+		self.assertLessEqual(threads_running - threads_before, 2)
+
+
+
+class TaskOutputLogTests(TestCase):
+	
+	def setUp(self):
+		import tempfile
+		self.tmp_dir = tempfile.TemporaryDirectory()
+	
+	
+	def tearDown(self):
+		self.tmp_dir.cleanup()
+	
+	
+	def test_keeps_bounded_head_and_tail(self):
+		import os
+		from .task_log import TaskOutputLog
+		output_log = TaskOutputLog(os.path.join(self.tmp_dir.name, "task_1.log")).open()
+		for i in range(20000):
+			output_log.write(f"line {i:08}\n".encode())
+		output_log.close()
+		self.assertEqual(len(output_log.head), TaskOutputLog.HEAD_SIZE)
+		self.assertEqual(len(output_log.tail), TaskOutputLog.TAIL_SIZE)
+		summary = output_log.summary_text()
+		self.assertTrue(summary.startswith("line 00000000\n"))
+		self.assertTrue(summary.endswith("line 00019999\n"))
+		self.assertIn("bytes skipped", summary)
+		self.assertEqual(os.path.getsize(output_log.path), 20000 * 14)
+	
+	
+	def test_compressed_log(self):
+		import os
+		from .task_log import TaskOutputLog
+		output_log = TaskOutputLog(os.path.join(self.tmp_dir.name, "task_1.log"), compress = True).open()
+		output_log.write(b"hello\n" * 1000)
+		output_log.close()
+		self.assertTrue(output_log.path.endswith(".gz"))
+		self.assertEqual(b"".join(TaskOutputLog.iter_file(output_log.path)), b"hello\n" * 1000)
+		self.assertEqual(output_log.summary_text(), "hello\n" * 1000)
+	
+	
+	def test_run_command_streams_output(self):
+		from .base_functions import run_command_with_returncode
+		chunks = []
+		output, returncode = run_command_with_returncode("seq 1 100000", on_output = chunks.append)
+		self.assertEqual(output, "")
+		self.assertEqual(returncode, 0)
+		self.assertGreater(len(chunks), 1)
+		self.assertTrue(b"".join(chunks).endswith(b"\n100000\n"))
+
+
+
+class RsyncOutputParserTests(TestCase):
+	STATS_OUTPUT = b"""sending incremental file list
+file1
+file2
+
+Number of files: 1,234 (reg: 1,000, dir: 234)
+Number of created files: 2 (reg: 2)
+Number of deleted files: 0
+Number of regular files transferred: 12
+Total file size: 1,234,567,890 bytes
+Total transferred file size: 45,678 bytes
+Literal data: 40,000 bytes
+Matched data: 5,678 bytes
+File list size: 0
+File list generation time: 0.001 seconds
+File list transfer time: 0.000 seconds
+Total bytes sent: 41,234 bytes
+Total bytes received: 567 bytes
+
+sent 41,234 bytes  received 567 bytes  83,602.00 bytes/sec
+total size is 1,234,567,890  speedup is 29,534.93
+"""
+	
+	def test_parse_stats(self):
+		from .rsync_stats import RsyncOutputParser
+		parser = RsyncOutputParser()
+		# feed by small chunks, lines are split between chunks
+		for i in range(0, len(self.STATS_OUTPUT), 7):
+			parser.feed(self.STATS_OUTPUT[i:i + 7])
+		parser.close()
+		self.assertEqual(parser.stats["files_total"], 1234)
+		self.assertEqual(parser.stats["files_transferred"], 12)
+		self.assertEqual(parser.stats["bytes_total"], 1234567890)
+		self.assertEqual(parser.stats["bytes_transferred"], 45678)
+		self.assertEqual(parser.stats["literal_data"], 40000)
+		self.assertEqual(parser.stats["matched_data"], 5678)
+		self.assertEqual(parser.stats["bytes_sent"], 41234)
+		self.assertEqual(parser.stats["bytes_received"], 567)
+		self.assertAlmostEqual(parser.stats["bytes_per_s"], 83602.0)
+		self.assertAlmostEqual(parser.stats["speedup"], 29534.93)
+	
+	
+	def test_parse_progress2(self):
+		from .rsync_stats import RsyncOutputParser
+		parser = RsyncOutputParser()
+		parser.feed(b"      1,048,576  10%   12.34MB/s    0:00:01 (xfr#1, to-chk=9/10)\r")
+		parser.feed(b"     52,428,800  45%   21.50MB/s    0:00:05 (xfr#5, ir-chk=1005/2000)\r")
+		self.assertEqual(parser.progress_percent, 45)
+		self.assertEqual(parser.bytes_done, 52428800)
+		self.assertAlmostEqual(parser.bytes_per_s, 21500000.0)
+	
+	
+	def test_parse_number(self):
+		from .rsync_stats import parse_number
+		self.assertEqual(parse_number("1,234,567"), 1234567)
+		self.assertEqual(parse_number("1.234.567"), 1234567)
+		self.assertEqual(parse_number("12.34"), 12.34)
+		self.assertEqual(parse_number("1.23M"), 1230000)
+	
+	
+	def test_task_applies_stats(self):
+		from .rsync_stats import RsyncOutputParser
+		parser = RsyncOutputParser()
+		parser.feed(self.STATS_OUTPUT)
+		test_rt = ReplicationTask(replication = Replication(src = "/tmp/", dest = "/temp2/"), returncode = 0)
+		test_rt.apply_transfer_stats(parser)
+		self.assertEqual(test_rt.bytes_copied, 45678)
+		self.assertEqual(test_rt.files_transferred, 12)
+		self.assertEqual(test_rt.progress_percent, 100)
+		self.assertEqual(test_rt.mb_per_s, 0.08)
+	
+	
+	def test_get_cmd_with_extra_options(self):
+		test_r = Replication(src = "/tmp/1/", dest = "/tmp2/", options = "-axv --delete")
+		self.assertEqual(test_r.get_cmd(["--stats", "-e", "ssh -p 22"]), "rsync -axv --delete --stats -e 'ssh -p 22' /tmp/1/ /tmp2/")
+
+
+
+class ShardingTests(TestCase):
+	
+	def setUp(self):
+		import tempfile, os
+		self.tmp = tempfile.TemporaryDirectory()
+		self.src = os.path.join(self.tmp.name, "src")
+		for name, size in (("a", 100), ("b", 10), ("c", 60), ("d", 50)):
+			os.makedirs(os.path.join(self.src, name))
+			with open(os.path.join(self.src, name, "f"), "wb") as f:
+				f.write(b"x" * size)
+	
+	
+	def tearDown(self):
+		self.tmp.cleanup()
+	
+	
+	def test_get_shard_locations(self):
+		from .sharding import get_shard_locations
+		self.assertEqual(get_shard_locations("/data/a/", "/backup/"), ("/data/a/", "/backup/"))
+		self.assertEqual(get_shard_locations("/data/a", "/backup/"), ("/data/a/", "/backup/a/"))
+	
+	
+	def test_plan_shards(self):
+		from .sharding import plan_shards, SHARD_DIRS, SHARD_SIZE
+		self.assertEqual(plan_shards(self.src, 2, mode = SHARD_DIRS), [["a", "c"], ["b", "d"]])
+		self.assertEqual(plan_shards(self.src, 2, mode = SHARD_SIZE), [["a", "b"], ["c", "d"]])
+		self.assertEqual(len(plan_shards(self.src, 8)), 4)
+		self.assertIsNone(plan_shards(self.src, 1))
+		self.assertIsNone(plan_shards(self.src + "/a", 2))
+	
+	
+	def test_combine_returncodes(self):
+		from .sharding import combine_returncodes
+		self.assertEqual(combine_returncodes([0, 0]), 0)
+		self.assertEqual(combine_returncodes([0, 24]), 24)
+		self.assertEqual(combine_returncodes([24, 23, 0]), 23)
+	
+	
+	def test_combined_output_parser(self):
+		from .rsync_stats import RsyncOutputParser, CombinedOutputParser
+		parsers = [RsyncOutputParser(), RsyncOutputParser()]
+		parsers[0].feed(b"      1,000  50%   1.00MB/s    0:00:01 (xfr#1, to-chk=1/2)\r")
+		parsers[0].feed(b"Total file size: 2,000 bytes\nTotal bytes sent: 1,100\nTotal bytes received: 0\n")
+		parsers[1].feed(b"Total file size: 6,000 bytes\nTotal bytes sent: 900\nTotal bytes received: 0\n")
+		combined = CombinedOutputParser(parsers)
+		self.assertEqual(combined.progress_percent, 25)
+		self.assertEqual(combined.bytes_done, 1000)
+		self.assertEqual(combined.stats["bytes_total"], 8000)
+		self.assertEqual(combined.stats["speedup"], 4.0)
+	
+	
+	def test_parallel_request(self):
+		from .engine import RunCommand, Parallel, run_steps
+		def steps():
+			results = yield Parallel([RunCommand("sleep 0.3"), RunCommand("sleep 0.3"), RunCommand("false")])
+			return [r[1] for r in results]
+		import time
+		t0 = time.monotonic()
+		self.assertEqual(run_steps(steps()), [0, 0, 1])
+		self.assertLess(time.monotonic() - t0, 0.55)
+	
+	
+	def test_sharded_rsync_commands(self):
+		import os
+		from .engine import Parallel, RunCommand
+		from .task_log import TaskOutputLog
+		test_r = Replication(src = self.src, dest = "/backup/", options = "-a --delete", shards = 2)
+		test_rt = ReplicationTask(id = 1, replication = test_r)
+		test_rt.output_log = TaskOutputLog(os.path.join(self.tmp.name, "task.log")).open()
+		with mock.patch.object(ReplicationTask, "get_log_file_path", return_value = os.path.join(self.tmp.name, "task.log")):
+			src_dir, dest_dir, shards = test_rt.plan_shards()
+			steps = test_rt.run_sharded_rsync_steps(src_dir, dest_dir, shards)
+			request = next(steps)
+			self.assertIsInstance(request, Parallel)
+			self.assertEqual(len(request.requests), 2)
+			self.assertIn("--files-from=", request.requests[0].cmdstring)
+			self.assertTrue(request.requests[0].cmdstring.endswith(f"{self.src}/ /backup/src/"))
+			cleanup = steps.send([(b"", 0), (b"", 24)])
+			self.assertIsInstance(cleanup, RunCommand)
+			self.assertIn("--existing --ignore-existing", cleanup.cmdstring)
+			with self.assertRaises(StopIteration) as cm:
+				steps.send((b"", 0))
+		test_rt.output_log.close()
+		self.assertEqual(cm.exception.value, 24)
+		self.assertFalse(os.path.exists(os.path.join(self.tmp.name, "task_1_shards")))
+
+
+
+class FingerprintTests(TestCase):
+	
+	def setUp(self):
+		import tempfile, os
+		self.tmp = tempfile.TemporaryDirectory()
+		self.src = os.path.join(self.tmp.name, "src")
+		for d in ("a/x", "b"):
+			os.makedirs(os.path.join(self.src, d))
+		for path in ("a/x/f1", "b/f2", "f3"):
+			with open(os.path.join(self.src, path), "w") as f:
+				f.write(path)
+		self.cache_path = os.path.join(self.tmp.name, "cache", "fp.json")
+	
+	
+	def tearDown(self):
+		self.tmp.cleanup()
+	
+	
+	def test_get_fingerprint_root(self):
+		from .fingerprint import get_fingerprint_root
+		self.assertEqual(get_fingerprint_root(self.src + "/"), self.src)
+		self.assertIsNone(get_fingerprint_root("host:/data/"))
+		self.assertIsNone(get_fingerprint_root(self.src + "/*"))
+		self.assertIsNone(get_fingerprint_root(self.src + "/missing"))
+	
+	
+	def test_fingerprint_detects_changed_subtree(self):
+		import os
+		from .fingerprint import TreeFingerprint
+		first = TreeFingerprint(self.cache_path)
+		fp1 = first.compute(self.src)
+		first.save()
+		self.assertEqual(sorted(first.changed), [".", "a", "a/x", "b"])
+		second = TreeFingerprint(self.cache_path)
+		self.assertEqual(second.compute(self.src), fp1)
+		self.assertEqual(second.changed, [])
+		with open(os.path.join(self.src, "a/x/f1"), "a") as f:
+			f.write("more")
+		fp2 = second.compute(self.src)
+		self.assertNotEqual(fp2, fp1)
+		self.assertEqual(second.changed, ["a/x"])
+		os.remove(os.path.join(self.src, "b/f2"))
+		self.assertNotEqual(second.compute(self.src), fp2)
+		# mtime of b changed too, it is entry of root
+		self.assertEqual(second.changed, ["b", "."])
+	
+	
+	def test_fingerprint_without_cache_keeps_no_nodes(self):
+		from .fingerprint import TreeFingerprint
+		tree = TreeFingerprint()
+		fp = tree.compute(self.src)
+		self.assertEqual((tree.changed, tree.nodes), ([], {}))
+		self.assertEqual(TreeFingerprint(self.cache_path).compute(self.src), fp)
+	
+	
+	def test_fingerprint_of_tree_deeper_than_recursion_limit(self):
+		import os
+		import sys
+		from .fingerprint import TreeFingerprint
+		os.makedirs(os.path.join(self.src, *(["d"] * 300)))
+		limit = sys.getrecursionlimit()
+		sys.setrecursionlimit(200)
+		try:
+			fp = TreeFingerprint().compute(self.src)
+		finally:
+			sys.setrecursionlimit(limit)
+		os.rmdir(os.path.join(self.src, *(["d"] * 300)))
+		self.assertNotEqual(TreeFingerprint().compute(self.src), fp)
+	
+	
+	def test_unchanged_src_skips_rsync(self):
+		import os
+		test_r = Replication.objects.create(name = "fp", src = self.src + "/", dest = os.path.join(self.tmp.name, "dest/"), skip_unchanged = True)
+		with self.settings(REPLICATOR_FINGERPRINTS_DIR = os.path.join(self.tmp.name, "fp"), REPLICATOR_TASK_LOGS_DIR = os.path.join(self.tmp.name, "logs")), \
+				mock.patch.object(Replication, "RSYNC_BIN", "true"):
+			first = ReplicationTask.objects.create(replication = test_r)
+			first.run_replication()
+			self.assertTrue(first.OK)
+			self.assertFalse(first.unchanged)
+			test_r.refresh_from_db()
+			self.assertIsNotNone(test_r.last_src_fingerprint)
+			second = ReplicationTask.objects.create(replication = test_r)
+			with mock.patch("replicator.models.RunCommand") as run_command:
+				second.run_replication()
+			run_command.assert_not_called()
+			self.assertTrue(second.unchanged)
+			self.assertEqual(second.state, "complete, no changes")
+			with open(os.path.join(self.src, "f3"), "a") as f:
+				f.write("changed")
+			third = ReplicationTask.objects.create(replication = test_r)
+			third.run_replication()
+			self.assertFalse(third.unchanged)
+
+
+
+
+class BatchModeTests(TestCase):
+	
+	def test_follower_replays_batch_and_falls_back_to_full_rsync(self):
+		import os, tempfile
+		from .engine import RunCommand
+		leader_r = Replication.objects.create(name = "leader", src = "/tmp/src1/", dest = "/tmp/dest1/")
+		follower_r = Replication.objects.create(name = "follower", src = "/tmp/src1/", dest = "nas1:/dest2/", batch_leader = leader_r)
+		leader = ReplicationTask.objects.create(replication = leader_r, OK = True, returncode = 0, complete = True)
+		follower = ReplicationTask.objects.create(replication = follower_r, batch_of = leader)
+		with tempfile.TemporaryDirectory() as tmp, self.settings(REPLICATOR_BATCHES_DIR = tmp):
+			with open(ReplicationTask.get_batch_file_path(leader.id), "w") as f:
+				f.write("batch")
+			steps = follower.run_read_batch_steps("rsync full")
+			request = next(steps)
+			self.assertIsInstance(request, RunCommand)
+			self.assertTrue(request.cmdstring.endswith(f"--read-batch={tmp}/task_{leader.id}.batch nas1:/dest2/"))
+			# dest differs from dest of leader, replay fails
+			request = steps.send((b"", 23))
+			self.assertEqual(request.cmdstring, "rsync full")
+			with self.assertRaises(StopIteration) as cm:
+				steps.send((b"", 0))
+			self.assertEqual(cm.exception.value, 0)
+			self.assertIn("failed with returncode 23", follower.comment)
+			ReplicationTask.remove_batch_files(leader.id)
+			self.assertEqual(os.listdir(tmp), [])
+
+
+
+
+class CronTests(TestCase):
+	
+	def test_next_after(self):
+		import datetime
+		from .cron import CronExpression
+		after = datetime.datetime(2024, 2, 28, 23, 59, 30)
+		self.assertEqual(CronExpression("@hourly").next_after(after), datetime.datetime(2024, 2, 29, 0, 0))
+		self.assertEqual(CronExpression("0 2 29 2 *").next_after(after), datetime.datetime(2024, 2, 29, 2, 0))
+		self.assertEqual(CronExpression("0 2 29 2 *").next_after(datetime.datetime(2024, 3, 1)), datetime.datetime(2028, 2, 29, 2, 0))
+		# day of month or day of week (sunday)
+		self.assertEqual(CronExpression("30 4 1,15 * 0").next_after(after), datetime.datetime(2024, 3, 1, 4, 30))
+		self.assertEqual(CronExpression("30 4 10 * sun").next_after(datetime.datetime(2024, 3, 1, 5, 0)), datetime.datetime(2024, 3, 3, 4, 30))
+		self.assertEqual(CronExpression("5/20 * * dec *").next_after(after), datetime.datetime(2024, 12, 1, 0, 5))
+		self.assertIsNone(CronExpression("0 0 30 2 *").next_after(after))
+		# */1 does not restrict day of month, so only day of week (monday) matches
+		self.assertEqual(CronExpression("0 3 */1 * 1").next_after(datetime.datetime(2024, 3, 6)), datetime.datetime(2024, 3, 11, 3, 0))
+		self.assertEqual(CronExpression("0 3 1 * */2").next_after(datetime.datetime(2024, 3, 6)), datetime.datetime(2024, 6, 1, 3, 0))
+	
+	
+	def test_invalid_expressions(self):
+		from .cron import CronExpression
+		for text in ("* * * *", "60 * * * *", "* * 0 * *", "*/0 * * * *", "5-1 * * * *", "* * * foo *"):
+			with self.assertRaises(ValueError):
+				CronExpression(text)
+
+
+
+class ReplicationSchedulerTests(TestCase):
+	
+	def setUp(self):
+		from .base import ReplicationScheduler
+		self.scheduler = ReplicationScheduler
+		self.scheduler.clear_all_schedules()
+		self.replication = Replication.objects.create(name = "r1", src = "/tmp/src1/", dest = "/tmp/dest1/")
+	
+	
+	def tearDown(self):
+		self.scheduler.clear_all_schedules()
+		Settings.clear_cache()
+	
+	
+	def test_jobs_fire_in_order_of_next_run(self):
+		import datetime
+		from django.utils import timezone
+		now = timezone.now()
+		soon = ReplicationSchedule.objects.create(name = "soon", replication = self.replication, time = (timezone.localtime(now) + datetime.timedelta(minutes = 5)).time())
+		later = ReplicationSchedule.objects.create(name = "later", replication = self.replication, time = (timezone.localtime(now) + datetime.timedelta(minutes = 10)).time())
+		ReplicationSchedule.objects.create(name = "disabled", replication = self.replication, time = datetime.time(1, 0), enabled = False)
+		self.scheduler.load_all_schedules()
+		self.assertEqual(len(self.scheduler.jobs), 2)
+		self.assertLessEqual(self.scheduler.get_sleep_seconds(), self.scheduler.MAX_SLEEP_S)
+		with mock.patch("replicator.base.ReplicationTaskRunner.add_task_for_replication") as add_task:
+			self.assertEqual(self.scheduler.run_pending(now), [])
+			fired = self.scheduler.run_pending(now + datetime.timedelta(minutes = 6))
+			self.assertEqual([j.schedule.id for j in fired], [soon.id])
+			self.assertEqual(add_task.call_count, 1)
+		job = self.scheduler.jobs[soon.id]
+		self.assertGreater(job.next_run, now + datetime.timedelta(hours = 23))
+		self.assertEqual(self.scheduler.heap[0][2], later.id)
+	
+	
+	def test_replaced_and_removed_jobs_leave_stale_entries(self):
+		import datetime
+		from django.utils import timezone
+		s1 = ReplicationSchedule.objects.create(name = "s1", replication = self.replication, time = datetime.time(1, 0))
+		self.scheduler.add_job(s1)
+		s1.time = datetime.time(2, 0)
+		job = self.scheduler.add_job(s1)
+		self.assertEqual(timezone.localtime(job.next_run).hour, 2)
+		self.assertEqual(len(self.scheduler.heap), 2)
+		self.scheduler.remove_job(s1.id)
+		with mock.patch("replicator.base.ReplicationTaskRunner.add_task_for_replication") as add_task:
+			self.scheduler.run_pending(timezone.now() + datetime.timedelta(days = 2))
+		add_task.assert_not_called()
+		self.assertEqual(self.scheduler.heap, [])
+	
+	
+	def test_next_runs_preview(self):
+		import datetime
+		s1 = ReplicationSchedule.objects.create(name = "hourly", replication = self.replication, time = datetime.time(0, 15), hourly = True)
+		s2 = ReplicationSchedule.objects.create(name = "cron", replication = self.replication, cron = "45 * * * *")
+		runs = self.scheduler.get_next_runs(4)
+		self.assertEqual(len(runs), 4)
+		self.assertEqual(sorted(runs, key = lambda r: r[0]), runs)
+		self.assertEqual({s.id for run, s in runs}, {s1.id, s2.id})
+		self.assertEqual(len(s1.get_next_runs(3)), 3)
+	
+	
+	def test_signals_update_only_changed_job(self):
+		import datetime
+		with mock.patch.object(self.scheduler, "thread", mock.Mock()), mock.patch.object(self.scheduler, "load_all_schedules") as load_all:
+			s1 = ReplicationSchedule.objects.create(name = "s1", replication = self.replication, time = datetime.time(1, 0))
+			s2 = ReplicationSchedule.objects.create(name = "s2", replication = self.replication, time = datetime.time(2, 0))
+			self.assertEqual(set(self.scheduler.jobs), {s1.id, s2.id})
+			job2 = self.scheduler.jobs[s2.id]
+			s1.time = datetime.time(3, 0)
+			s1.save()
+			self.assertIs(self.scheduler.jobs[s2.id], job2)
+			self.assertEqual(self.scheduler.jobs[s1.id].schedule.time, datetime.time(3, 0))
+			s2.delete()
+			self.assertEqual(set(self.scheduler.jobs), {s1.id})
+			self.replication.enabled = False
+			self.replication.save()
+			self.assertEqual(self.scheduler.jobs, {})
+		load_all.assert_not_called()
+	
+	
+	def test_sync_changes_of_other_process(self):
+		import datetime
+		from django.utils import timezone
+		s1 = ReplicationSchedule.objects.create(name = "s1", replication = self.replication, time = datetime.time(1, 0))
+		self.scheduler.load_all_schedules()
+		job = self.scheduler.jobs[s1.id]
+		self.assertEqual(self.scheduler.sync_changes(), 0)
+		self.assertIs(self.scheduler.jobs[s1.id], job)
+		# saved by web process, signal did not reach scheduler
+		s2 = ReplicationSchedule.objects.create(name = "s2", replication = self.replication, time = datetime.time(2, 0))
+		ReplicationSchedule.objects.filter(pk = s1.id).update(enabled = False, date_modified = timezone.now())
+		self.assertEqual(self.scheduler.sync_changes(), 2)
+		self.assertEqual(set(self.scheduler.jobs), {s2.id})
+	
+	
+	def test_deleted_schedule_does_not_fire(self):
+		import datetime
+		from django.utils import timezone
+		s1 = ReplicationSchedule.objects.create(name = "s1", replication = self.replication, time = datetime.time(1, 0))
+		self.scheduler.load_all_schedules()
+		ReplicationSchedule.objects.filter(pk = s1.id).delete()
+		with mock.patch("replicator.base.ReplicationTaskRunner.add_task_for_replication") as add_task:
+			self.scheduler.run_pending(timezone.now() + datetime.timedelta(days = 1))
+		add_task.assert_not_called()
+		self.assertEqual(self.scheduler.jobs, {})
+	
+	
+	def test_burst_of_due_jobs_is_queued_together(self):
+		import datetime
+		from django.utils import timezone
+		r2 = Replication.objects.create(name = "r2", src = "/tmp/src2/", dest = "/tmp/dest2/")
+		for name, replication in (("s1", self.replication), ("s2", r2)):
+			ReplicationSchedule.objects.create(name = name, replication = replication, time = datetime.time(1, 0))
+		self.scheduler.load_all_schedules()
+		with mock.patch("replicator.base.ReplicationTaskRunner.add_tasks_for_replications") as add_tasks:
+			fired = self.scheduler.run_pending(timezone.now() + datetime.timedelta(days = 1))
+		self.assertEqual(len(fired), 2)
+		add_tasks.assert_called_once()
+		self.assertEqual({r.name for r, s in add_tasks.call_args[0][0]}, {"r1", "r2"})
+	
+	
+	def test_delay_spreads_schedules(self):
+		import datetime
+		from django.utils import timezone
+		schedules = [ReplicationSchedule.objects.create(name = f"s{i}", replication = self.replication, time = datetime.time(1, 0),
+			spread_seconds = 600, offset_seconds = 60) for i in range(10)]
+		delays = [s.get_delay_seconds() for s in schedules]
+		self.assertTrue(all(60 <= d < 660 for d in delays))
+		self.assertGreater(len(set(delays)), 1)
+		self.assertEqual(delays, [ReplicationSchedule.objects.get(pk = s.id).get_delay_seconds() for s in schedules])
+		s = schedules[0]
+		base_run = s.get_next_run(with_delay = False)
+		self.assertEqual(timezone.localtime(base_run).time(), datetime.time(1, 0))
+		self.assertEqual(s.get_next_run() - base_run, datetime.timedelta(seconds = delays[0]))
+
+	
+	
+	def test_fire_times_are_saved(self):
+		import datetime
+		from django.utils import timezone
+		s1 = ReplicationSchedule.objects.create(name = "s1", replication = self.replication, time = datetime.time(1, 0))
+		date_modified = ReplicationSchedule.objects.get(pk = s1.id).date_modified
+		self.scheduler.load_all_schedules()
+		job = self.scheduler.jobs[s1.id]
+		self.assertEqual(ReplicationSchedule.objects.get(pk = s1.id).next_fire, job.next_run)
+		due = job.next_run
+		with mock.patch("replicator.base.ReplicationTaskRunner.add_task_for_replication"):
+			self.scheduler.run_pending(due + datetime.timedelta(seconds = 1))
+		s1 = ReplicationSchedule.objects.get(pk = s1.id)
+		self.assertEqual((s1.last_fire, s1.next_fire), (due, due + datetime.timedelta(days = 1)))
+		self.assertEqual(s1.date_modified, date_modified)
+	
+	
+	def test_misfire_policies(self):
+		import datetime
+		from django.utils import timezone
+		now = timezone.now()
+		schedules = [ReplicationSchedule.objects.create(name = f"s{i}", replication = self.replication, time = datetime.time(0, 30), hourly = True) for i in range(2)]
+		last_fire = schedules[0].get_next_run(now - datetime.timedelta(hours = 6))
+		ReplicationSchedule.objects.update(last_fire = last_fire)
+		self.assertEqual(len(ReplicationSchedule.objects.get(pk = schedules[0].id).get_missed_runs(now)), 5)
+		settings = Settings.get_settings()
+		settings.misfire_catchup_interval = 60
+		for policy, catchup_count in ((Settings.MISFIRE_SKIP, 0), (Settings.MISFIRE_ONCE, 1), (Settings.MISFIRE_ALL, 5)):
+			settings.misfire_policy = policy
+			settings.save()
+			self.scheduler.clear_all_schedules()
+			self.scheduler.load_all_schedules()
+			jobs = [self.scheduler.jobs[s.id] for s in schedules]
+			self.assertEqual([len(j.catchup_runs) for j in jobs], [catchup_count] * 2)
+			if catchup_count == 0:
+				self.assertTrue(all(j.next_run > now for j in jobs))
+		# catch-up runs of all schedules are rate limited
+		slots = sorted(j.next_run for j in jobs)
+		self.assertEqual(slots[1] - slots[0], datetime.timedelta(seconds = 60))
+		with mock.patch("replicator.base.ReplicationTaskRunner.add_task_for_replication") as add_task:
+			fired = self.scheduler.run_pending(slots[0])
+		self.assertEqual(len(fired), 1)
+		self.assertEqual(fired[0].last_run, last_fire + datetime.timedelta(hours = 1))
+		self.assertEqual(fired[0].next_run, slots[1] + datetime.timedelta(seconds = 60))
+		self.assertEqual(len(fired[0].catchup_runs), 4)
+		self.assertEqual(ReplicationSchedule.objects.get(pk = fired[0].schedule.id).last_fire, fired[0].last_run)
+	
+	
+	def test_every_n_days_keeps_phase_after_restart(self):
+		import datetime
+		from django.utils import timezone
+		settings = Settings.get_settings()
+		settings.misfire_policy = Settings.MISFIRE_SKIP
+		settings.save()
+		s1 = ReplicationSchedule.objects.create(name = "s1", replication = self.replication, time = datetime.time(1, 0), every_n_days = 3)
+		last_fire = s1.get_next_run(timezone.now() - datetime.timedelta(days = 2))
+		ReplicationSchedule.objects.filter(pk = s1.id).update(last_fire = last_fire)
+		self.scheduler.load_all_schedules()
+		self.assertEqual(self.scheduler.jobs[s1.id].next_run, last_fire + datetime.timedelta(days = 3))
+
+
+class StaggerTests(TestCase):
+	
+	def test_get_peak(self):
+		from .stagger import get_peak
+		self.assertEqual(get_peak([(0, 10), (5, 15), (10, 20)]), 2)
+		self.assertEqual(get_peak([(0, 10), (5, 15), (10, 20)], 15, 30), 1)
+		self.assertEqual(get_peak([]), 0)
+	
+	
+	def test_plan_offsets_lowers_peak(self):
+		from .stagger import plan_offsets, get_peak
+		items = [(i, 0, 1800) for i in range(4)]
+		self.assertEqual(get_peak([(0, 1800)] * 4), 4)
+		offsets = plan_offsets(items, 4 * 3600, step_s = 60)
+		self.assertEqual(get_peak([(offsets[k], offsets[k] + d) for k, s, d in items]), 1)
+		# window too short for all runs, they still stay in window
+		offsets = plan_offsets(items, 3600, step_s = 60)
+		self.assertEqual(get_peak([(offsets[k], offsets[k] + d) for k, s, d in items]), 2)
+		self.assertTrue(all(offsets[k] + d <= 3600 for k, s, d in items))
+	
+	
+	def test_plan_schedules_command(self):
+		import io
+		import datetime
+		from django.core.management import call_command
+		from django.utils import timezone
+		r1 = Replication.objects.create(name = "r1", src = "/tmp/src1/", dest = "/tmp/dest1/")
+		r2 = Replication.objects.create(name = "r2", src = "/tmp/src2/", dest = "/tmp/dest2/")
+		now = timezone.now()
+		ReplicationTask.objects.create(replication = r1, OK = True, start = now - datetime.timedelta(hours = 1), end = now)
+		s1 = ReplicationSchedule.objects.create(name = "s1", replication = r1, time = datetime.time(1, 0))
+		s2 = ReplicationSchedule.objects.create(name = "s2", replication = r2, time = datetime.time(1, 0), spread_seconds = 300)
+		out = io.StringIO()
+		call_command("plan_schedules", stdout = out)
+		self.assertIn("current 2, planned 1", out.getvalue())
+		self.assertEqual(ReplicationSchedule.objects.get(pk = s2.id).spread_seconds, 300)
+		call_command("plan_schedules", "--apply", stdout = out)
+		s1.refresh_from_db()
+		s2.refresh_from_db()
+		self.assertEqual((s1.offset_seconds, s2.offset_seconds, s2.spread_seconds), (0, 3600, 0))
+
+
+
+class PredictorTests(TestCase):
+	
+	def test_estimate_follows_durations(self):
+		from .predictor import Estimate, AUTO_TIMEOUT_MIN_S
+		estimate = Estimate()
+		self.assertIsNone(estimate.get_timeout_s())
+		for duration_s in (100, 110, 90, 100, 105):
+			estimate.update(duration_s, bytes = 1000)
+		self.assertAlmostEqual(estimate.duration_s, 100, delta = 5)
+		self.assertLess(estimate.duration_dev_s, 50)
+		self.assertEqual(estimate.bytes, 1000)
+		self.assertEqual(estimate.get_timeout_s(), AUTO_TIMEOUT_MIN_S)
+		for i in range(20):
+			estimate.update(7200)
+		self.assertAlmostEqual(estimate.duration_s, 7200, delta = 100)
+		self.assertGreater(estimate.get_timeout_s(), 3 * 7200)
+	
+	
+	def test_timeout_of_replication(self):
+		r1 = Replication(name = "r1", src = "/tmp/src1/", dest = "/tmp/dest1/", est_duration_s = 1200, est_duration_dev_s = 100, est_samples = 10)
+		self.assertEqual(r1.get_timeout_s(), 3 * (1200 + 400))
+		r1.timeout = 10
+		self.assertEqual(r1.get_timeout_s(), 600)
+		r1.timeout = -1
+		self.assertEqual(r1.get_timeout_s(), 0)
+	
+	
+	def test_get_etas(self):
+		import datetime
+		from django.utils import timezone
+		from .predictor import get_etas, DEFAULT_DURATION_S
+		now = timezone.now()
+		minute = datetime.timedelta(minutes = 1)
+		etas = get_etas([("r1", now - 5 * minute, 600), ("r2", now - 20 * minute, 600)], [("p1", 60, None), ("p2", None, None), ("p3", 60, now + 60 * minute)], 2, now)
+		self.assertEqual(etas["r1"][1], now + 5 * minute)
+		# overdue task is expected to end now
+		self.assertEqual(etas["r2"][1], now)
+		self.assertEqual(etas["p1"], (now, now + minute))
+		self.assertEqual(etas["p2"], (now + minute, now + minute + datetime.timedelta(seconds = DEFAULT_DURATION_S)))
+		self.assertEqual(etas["p3"][0], now + 60 * minute)
+
+
+
+class WorkerLockTests(TestCase):
+	
+	def setUp(self):
+		import os
+		import tempfile
+		from django.test import override_settings
+		from . import base
+		self.base = base
+		self.tmp_dir = tempfile.TemporaryDirectory()
+		self.lock_path = os.path.join(self.tmp_dir.name, "worker.lock")
+		self.settings_override = override_settings(REPLICATOR_WORKER_LOCK_FILE = self.lock_path)
+		self.settings_override.enable()
+		base.release_worker_lock()
+	
+	
+	def tearDown(self):
+		self.base.release_worker_lock()
+		self.settings_override.disable()
+		self.tmp_dir.cleanup()
+	
+	
+	def test_embedded_worker_is_not_started_when_worker_runs(self):
+		import fcntl
+		from django.apps import apps
+		from .base import ReplicationTaskRunner, ReplicationScheduler
+		config = apps.get_app_config("replicator")
+		with open(self.lock_path, "w") as other_worker:
+			# lock of other process
+			fcntl.flock(other_worker, fcntl.LOCK_EX | fcntl.LOCK_NB)
+			with mock.patch("sys.argv", ["manage.py", "runserver"]), mock.patch.object(ReplicationTaskRunner, "launch_startup") as runner_startup, \
+				mock.patch.object(ReplicationScheduler, "launch_startup") as scheduler_startup:
+				config.ready()
+				runner_startup.assert_not_called()
+				scheduler_startup.assert_not_called()
+				fcntl.flock(other_worker, fcntl.LOCK_UN)
+				config.ready()
+				runner_startup.assert_called_once()
+				scheduler_startup.assert_called_once()
+		self.assertTrue(self.base.acquire_worker_lock())
@@ -16,8 +16,9 @@ urlpatterns = [
 	path("scheduler/", views.scheduler, name = "scheduler"),
 	path("replication_task_runner/", views.replication_task_runner, name = "replication_task_runner"),
 	path("replication_task_runner/run_replication_task/<int:replication_id>", views.run_replication_task, name = "run_replication_task"),
-	# path("replication_task_runner/cancell_replication_task/<int:task_id>", views.cancel_replication_task, name = "cancel_replication_task"),
+	path("replication_task_runner/cancel_replication_task/<int:task_id>", views.cancel_replication_task, name = "cancel_replication_task"),
 	path("replication_task_runner/<int:pk>", views.ReplicationTaskDetailView.as_view(), name = "replication_task_detail"),
+	path("replication_task_runner/<int:pk>/log", views.task_log, name = "task_log"),
 	path("scheduler/<int:pk>", views.ReplicationScheduleDetailView.as_view(), name = "schedule_detail"),
 	path("scheduler/add_schedule", views.ReplicationScheduleAddView.as_view(), name = "add_schedule"),
 	path("scheduler/edit_schedule/<int:pk>", views.ReplicationScheduleEditView.as_view(), name = "edit_schedule"),
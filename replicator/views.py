@@ -2,12 +2,14 @@ from django.shortcuts import render, get_object_or_404
 from django.http import HttpResponse, HttpResponseRedirect, Http404
 from django.views import generic
 from django.urls import reverse
+from django.db.models import Count, Sum, Q
 
 import logging
 
 
 from .models import Replication, ReplicationSchedule, ReplicationTask, Settings
-from .base import ReplicationTaskRunner
+from .base import ReplicationTaskRunner, ReplicationScheduler
+from .ssh_pool import SshControlPool
 from .forms import ReplicationForm, ReplicationScheduleForm, SettingsForm
 
 
@@ -66,21 +68,32 @@ class ReplicationDeleteView(generic.edit.DeleteView):
 
 
 		
+RECENT_TASKS_SHOWN = 100
+
+
 def replication_task_runner(request):
 	all_replications = Replication.objects.filter(enabled = True)
-	context = {"all_replications": all_replications, "running_tasks": ReplicationTaskRunner.running_tasks}
+	# status is read from DB - tasks may be run by worker process
+	tasks = ReplicationTask.objects.select_related("replication", "schedule").defer("cmd_output_text", "error_text")
+	active_tasks = list(tasks.filter(complete = False, cancelled = False).order_by("id"))
+	etas = ReplicationTaskRunner.get_task_etas(active_tasks, Settings.get_settings().max_running_tasks)
+	for t in active_tasks:
+		t.eta_start, t.eta_end = etas.get(t.id, (None, None))
+	recent_tasks = list(tasks.exclude(id__in = [t.id for t in active_tasks]).order_by("-id")[:RECENT_TASKS_SHOWN])
+	ssh_metrics = ReplicationTask.objects.filter(ssh_reused__isnull = False).aggregate(reused = Count("id", filter = Q(ssh_reused = True)),
+		opened = Count("id", filter = Q(ssh_reused = False)), saved_s = Sum("ssh_handshake_s", filter = Q(ssh_reused = True)))
+	ssh_metrics["sockets"] = len(SshControlPool.list_sockets())
+	context = {"all_replications": all_replications, "running_tasks": active_tasks + recent_tasks, "ssh_metrics": ssh_metrics}
 	return render(request, "replicator/replication_task_runner.html", context = context)
 
 
 def run_replication_task(request, replication_id):
 	replication = get_object_or_404(Replication, pk = replication_id)
 	logger.debug(f"run_replication_task: will add task for replication {replication.name}")
-	ReplicationTaskRunner.start_loop_subthread()
 	ReplicationTaskRunner.add_task_for_replication(replication)
 	return HttpResponseRedirect(reverse("replicator:replication_task_runner"))
 
 
-# TODO: this does not work
 def cancel_replication_task(request, task_id):
 	task = get_object_or_404(ReplicationTask, pk = task_id)
 	logger.debug(f"cancel_replication_task: requested cancel of replication task: {task}")
@@ -99,8 +112,21 @@ class ReplicationTaskDetailView(generic.detail.DetailView):
 
 
 
+def task_log(request, pk):
+	"""full output of task from its log file"""
+	import os
+	from django.http import StreamingHttpResponse
+	from .task_log import TaskOutputLog
+	
+	task = get_object_or_404(ReplicationTask, pk = pk)
+	if task.log_file is None or not os.path.exists(task.log_file):
+		raise Http404(f"there is no log file for task {pk}")
+	return StreamingHttpResponse(TaskOutputLog.iter_file(task.log_file), content_type = "text/plain; charset=utf-8")
+
+
+
 def scheduler(request):
-	context = {"schedules": ReplicationSchedule.objects.all(), }
+	context = {"schedules": ReplicationSchedule.objects.all(), "next_runs": ReplicationScheduler.get_next_runs()}
 	return render(request, "replicator/scheduler.html", context = context)
 
 